@@ -0,0 +1,202 @@
+#! /usr/bin/env python
+
+# Batch solving for the flight routing problem.
+# Solves many problems -- each a city file, a ticket file, and the costs per mile and per takeoff --
+# on a pool of worker processes, writing each result as a line of JSON as soon as it's done, so the
+# results come out in the order the jobs finish and can be read before the batch is over.
+# A job that fails is written out with its error, and the others carry on.
+#
+# Usage: batch.py (MANIFEST | DIRECTORY) [--workers N] [--output results.jsonl] [--time-limit SECONDS]
+#
+# A manifest has a header row, then a row per job: city_file ticket_file [mile_cost [takeoff_cost]],
+# with the files relative to the manifest.  A directory's jobs are its NAME_cities.csv and
+# NAME_tickets.csv pairs.  Costs not given are --mile-cost and --takeoff-cost.
+
+import os
+import sys
+import json
+import time
+import argparse
+import itertools
+import multiprocessing
+
+import flightrouting
+import search
+import candidates
+import relaxation
+import branching
+
+MILE_COST    = 1.0
+TAKEOFF_COST = 0.2
+
+# A problem to solve.
+class Job:
+    def __init__(self, name, city_file, ticket_file, mile_cost = MILE_COST, takeoff_cost = TAKEOFF_COST):
+        self.name         = name
+        self.city_file    = city_file
+        self.ticket_file  = ticket_file
+        self.mile_cost    = mile_cost
+        self.takeoff_cost = takeoff_cost
+
+# Returns the Jobs listed in a manifest; see the top of this file for its rows.
+# Rows without two files, or with costs that aren't numbers, are skipped and counted in report (if given).
+def load_manifest(filename, mile_cost = MILE_COST, takeoff_cost = TAKEOFF_COST, report = None):
+    directory = os.path.dirname(filename)
+    jobs = []
+    for split in flightrouting.iter_rows(filename, report):
+        try:
+            city_file, ticket_file = split[0], split[1]
+            job_mile_cost    = float(split[2]) if len(split) > 2 else mile_cost
+            job_takeoff_cost = float(split[3]) if len(split) > 3 else takeoff_cost
+        except (IndexError, ValueError):
+            if report != None:
+                report.malformed += 1
+            continue
+
+        name = os.path.splitext(os.path.basename(ticket_file))[0]
+        jobs.append(Job(name, os.path.join(directory, city_file), os.path.join(directory, ticket_file),
+                        job_mile_cost, job_takeoff_cost))
+    return jobs
+
+# Returns a Job for each NAME_tickets.csv in directory, with NAME_cities.csv as its city file, in name order.
+def directory_jobs(directory, mile_cost = MILE_COST, takeoff_cost = TAKEOFF_COST):
+    jobs = []
+    for filename in sorted(os.listdir(directory)):
+        if filename.endswith("_tickets.csv"):
+            name = filename[:-len("_tickets.csv")]
+            jobs.append(Job(name, os.path.join(directory, name + "_cities.csv"), os.path.join(directory, filename),
+                            mile_cost, takeoff_cost))
+    return jobs
+
+# Returns a routing's legs, itineraries, miles, takeoffs and cost, as a dict ready for JSON.
+def solution_record(solution, tickets, mile_cost, takeoff_cost):
+    legs = sorted([str(leg.from_city), str(leg.to_city)] for leg in solution.legs())
+    itineraries = []
+    for ticket in sorted(tickets, key = lambda tt: (str(tt.from_city), str(tt.to_city))):
+        itineraries.append({'from': str(ticket.from_city), 'to': str(ticket.to_city),
+                            'multiplicity': ticket.multiplicity,
+                            'legs': [[str(leg.from_city), str(leg.to_city)] for leg in ticket.itinerary(solution)]})
+    return {'legs': legs, 'itineraries': itineraries,
+            'miles': solution.miles(tickets), 'takeoffs': solution.takeoffs(tickets),
+            'cost': solution.cost(mile_cost, takeoff_cost, tickets)}
+
+# Returns True if the legs a solve restricted to candidates (see candidates.restrict) left out were verified
+# not to matter, going by its candidates.CandidateReport: none could belong to a cheaper routing, or
+# searching every leg finished.
+def restriction_verified(candidate_report):
+    if candidate_report.suspects == None:
+        return False
+    return len(candidate_report.suspects) == 0 or (candidate_report.search != None and candidate_report.search.complete())
+
+# Loads and solves a job, returning its result as a dict ready for JSON: what the job was, its
+# status ('ok' or 'error'), its solution_record and how long it all took, or the error that stopped it.
+# It's only marked optimal if the search finished and, with nearest, verify showed the legs left out
+# didn't matter.  settings are passed on to flightrouting.solve_problem.
+def run_job(index, job, settings):
+    record = {'job': index, 'name': job.name, 'city_file': job.city_file, 'ticket_file': job.ticket_file,
+              'mile_cost': job.mile_cost, 'takeoff_cost': job.takeoff_cost}
+    start = time.time()
+    try:
+        city_report = flightrouting.LoadReport(job.city_file)
+        ticket_report = flightrouting.LoadReport(job.ticket_file)
+        cities = flightrouting.load_cities(job.city_file, city_report)
+        tickets = flightrouting.dedup_tickets(flightrouting.iter_tickets(job.ticket_file, flightrouting.make_city_dict(cities),
+                                                                         ticket_report))
+        record['skipped_rows'] = city_report.skipped() + ticket_report.skipped()
+        record['load_seconds'] = time.time() - start
+
+        report = search.SearchReport()
+        candidate_report = candidates.CandidateReport() if settings.get('nearest') != None else None
+        solve_start = time.time()
+        solution = flightrouting.solve_problem(cities, tickets, job.mile_cost, job.takeoff_cost, report = report,
+                                               candidate_report = candidate_report, **settings)
+        record['solve_seconds'] = time.time() - solve_start
+        record.update(solution_record(solution, tickets, job.mile_cost, job.takeoff_cost))
+        record['optimal'] = report.complete() and (candidate_report == None or restriction_verified(candidate_report))
+        if not report.complete():
+            record['lower_bound'] = report.lower_bound
+        record['status'] = 'ok'
+    except Exception as error:
+        record['status'] = 'error'
+        record['error'] = type(error).__name__ + ": " + str(error)
+    record['seconds'] = time.time() - start
+    return record
+
+def run_job_args(args):
+    return run_job(*args)
+
+# Solves jobs on a pool of workers processes (or in this one, for a single worker), writing each result
+# to out as a line of JSON as it comes in.  settings are passed on to flightrouting.solve_problem.
+# Returns the number of jobs that failed.
+def run_batch(jobs, out, workers = 1, settings = {}):
+    tasks = [(index, job, settings) for index, job in enumerate(jobs)]
+    pool = None
+    if workers > 1:
+        pool = multiprocessing.Pool(workers)
+        records = pool.imap_unordered(run_job_args, tasks)
+    else:
+        records = itertools.imap(run_job_args, tasks)
+
+    failures = 0
+    try:
+        for record in records:
+            if record['status'] != 'ok':
+                failures += 1
+            out.write(json.dumps(record, sort_keys = True) + "\n")
+            out.flush()
+    except:
+        if pool != None:
+            pool.terminate()
+        raise
+    if pool != None:
+        pool.close()
+        pool.join()
+    return failures
+
+def main(args):
+    parser = argparse.ArgumentParser(description = "Solve many flight routing problems, writing results as JSON lines.")
+    parser.add_argument('jobs', help = "a manifest of jobs, or a directory of NAME_cities.csv and NAME_tickets.csv pairs")
+    parser.add_argument('--workers', type = int, default = multiprocessing.cpu_count(),
+                        help = "how many jobs to solve at once (default: one per CPU)")
+    parser.add_argument('--output', help = "file to write the results to (default: stdout)")
+    parser.add_argument('--mile-cost', type = float, default = MILE_COST, help = "cost per mile, where a job doesn't say")
+    parser.add_argument('--takeoff-cost', type = float, default = TAKEOFF_COST, help = "cost per takeoff, where a job doesn't say")
+    parser.add_argument('--time-limit', type = float, metavar = 'SECONDS', help = "stop solving each job after this long (local search and --verify included)")
+    parser.add_argument('--node-limit', type = int, metavar = 'NODES', help = "stop searching each job after this many nodes")
+    parser.add_argument('--branching', choices = sorted(branching.STRATEGIES), default = 'longest',
+                        help = "how to pick the leg to branch on (default: longest)")
+    parser.add_argument('--lp', choices = ['simplex', 'scipy', 'off'], default = 'simplex',
+                        help = "how to solve the LP relaxation used as a lower bound, if at all (default: simplex)")
+    parser.add_argument('--nearest', type = int, metavar = 'K',
+                        help = "only consider legs between each city and its K nearest neighbours, and the ticket legs")
+    parser.add_argument('--verify', action = 'store_true', help = "with --nearest, check the legs left out")
+    options = parser.parse_args(args[1:])
+    if options.workers < 1:
+        parser.error("--workers must be at least 1")
+    if options.verify and options.nearest == None:
+        parser.error("--verify needs --nearest")
+    if options.lp == 'scipy' and relaxation.linprog == None:
+        parser.error("--lp scipy needs SciPy, which isn't installed")
+
+    if os.path.isdir(options.jobs):
+        jobs = directory_jobs(options.jobs, options.mile_cost, options.takeoff_cost)
+    else:
+        manifest_report = flightrouting.LoadReport(options.jobs)
+        jobs = load_manifest(options.jobs, options.mile_cost, options.takeoff_cost, manifest_report)
+        if manifest_report.skipped() > 0:
+            print >> sys.stderr, manifest_report
+
+    settings = {'time_limit': options.time_limit, 'node_limit': options.node_limit, 'branching': options.branching,
+                'lp': None if options.lp == 'off' else options.lp, 'nearest': options.nearest, 'verify': options.verify}
+    out = open(options.output, 'w') if options.output else sys.stdout
+    try:
+        failures = run_batch(jobs, out, options.workers, settings)
+    finally:
+        if options.output:
+            out.close()
+
+    print >> sys.stderr, "%d jobs, %d failed" % (len(jobs), failures)
+    return 1 if failures else 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,308 @@
+#! /usr/bin/env python
+
+# Benchmarks for the flight routing solver.
+# Generates reproducible (seeded) instances of several shapes at growing sizes, runs greedy and
+# solve on each, and records wall time, peak memory, nodes expanded and cost to a results file.
+# A results file can be kept as a baseline, and later runs compared against it.
+#
+# Usage: benchmark.py [--sizes 4,5,6] [--generators uniform,linear] [--output results.txt] [--baseline old.txt]
+#        benchmark.py [--sizes 4,5,6] [--generators uniform,linear] --write-instances DIRECTORY
+
+import os
+import sys
+import math
+import time
+import random
+import argparse
+import multiprocessing
+import Queue
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+import routing
+import flightrouting
+import localsearch
+import branching
+import stats
+
+MILE_COST    = 1.0
+TAKEOFF_COST = 0.2
+
+# Instance generators
+
+# Returns the id of the i'th generated city: a, b, ..., z, aa, ab, ...
+def city_name(i):
+    name = ""
+    i += 1
+    while i > 0:
+        i, remainder = divmod(i - 1, 26)
+        name = chr(ord('a') + remainder) + name
+    return name
+
+# Returns the given number of distinct tickets, none of them selfloops, drawn at random from the cities.
+def random_tickets(rng, cities, ticket_count):
+    pairs = [(from_city, to_city) for from_city in cities for to_city in cities if from_city is not to_city]
+    ticket_count = min(ticket_count, len(pairs))
+    return [routing.Ticket(from_city, to_city) for from_city, to_city in rng.sample(pairs, ticket_count)]
+
+# Cities scattered uniformly over a square.
+def uniform_instance(city_count, ticket_count, seed):
+    rng = random.Random(seed)
+    cities = [routing.City(city_name(i), rng.randint(0, 100), rng.randint(0, 100)) for i in range(city_count)]
+    return cities, random_tickets(rng, cities, ticket_count)
+
+# Cities in a few tight clusters far apart from each other.
+def clustered_instance(city_count, ticket_count, seed):
+    rng = random.Random(seed)
+    centers = [(rng.randint(0, 1000), rng.randint(0, 1000)) for i in range(max(2, city_count // 4))]
+    cities = []
+    for i in range(city_count):
+        x, y = rng.choice(centers)
+        cities.append(routing.City(city_name(i), int(rng.gauss(x, 10)), int(rng.gauss(y, 10))))
+    return cities, random_tickets(rng, cities, ticket_count)
+
+# Cities evenly spaced along a line, like linear_cities.csv.
+def linear_instance(city_count, ticket_count, seed):
+    rng = random.Random(seed)
+    cities = [routing.City(city_name(i), i, 0) for i in range(city_count)]
+    return cities, random_tickets(rng, cities, ticket_count)
+
+# One hub in the middle of a ring of spokes, with tickets only between spokes.
+def hub_and_spoke_instance(city_count, ticket_count, seed):
+    rng = random.Random(seed)
+    cities = [routing.City(city_name(0), 0, 0)]
+    for i in range(1, city_count):
+        angle = 2 * math.pi * i / (city_count - 1) + rng.uniform(-0.2, 0.2)
+        radius = rng.uniform(80, 120)
+        cities.append(routing.City(city_name(i), int(radius * math.cos(angle)), int(radius * math.sin(angle))))
+    return cities, random_tickets(rng, cities[1:], ticket_count)
+
+# Uniformly scattered cities with tickets between half of all pairs, whatever ticket_count says.
+def dense_instance(city_count, ticket_count, seed):
+    rng = random.Random(seed)
+    cities = [routing.City(city_name(i), rng.randint(0, 100), rng.randint(0, 100)) for i in range(city_count)]
+    return cities, random_tickets(rng, cities, city_count * (city_count - 1) // 2)
+
+GENERATORS = {
+    'uniform':   uniform_instance,
+    'clustered': clustered_instance,
+    'linear':    linear_instance,
+    'hub':       hub_and_spoke_instance,
+    'dense':     dense_instance,
+}
+
+# Returns the name an instance is written out under: generator, cities, tickets and seed.
+def instance_name(generator, city_count, ticket_count, seed):
+    return "%s_%d_%d_%d" % (generator, city_count, ticket_count, seed)
+
+# Writes an instance out as a city file and a ticket file that flightrouting.py can read.
+def write_instance(cities, tickets, city_file, ticket_file):
+    with open(city_file, 'w') as f:
+        f.write("city_id x y\n")
+        for city in cities:
+            f.write(" ".join([str(city), str(city.x), str(city.y)]) + "\n")
+    with open(ticket_file, 'w') as f:
+        f.write("from_city_id to_city_id\n")
+        for ticket in tickets:
+            f.write(" ".join([str(ticket.from_city), str(ticket.to_city)]) + "\n")
+
+# Running benchmarks
+
+# The columns of a results file, in order.
+COLUMNS = ['generator', 'cities', 'tickets', 'seed', 'branching', 'status',
+           'greedy_seconds', 'solve_seconds', 'peak_kb', 'nodes', 'greedy_cost', 'local_search_cost', 'cost']
+KEY_COLUMNS = ['generator', 'cities', 'tickets', 'seed', 'branching']
+INT_COLUMNS = ['cities', 'tickets', 'seed', 'peak_kb', 'nodes']
+FLOAT_COLUMNS = ['greedy_seconds', 'solve_seconds', 'greedy_cost', 'local_search_cost', 'cost']
+
+# Returns the peak resident memory of this process so far, in kilobytes (0 where that's unknown).
+def peak_kb():
+    if resource == None:
+        return 0
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+# Generates and solves one instance, returning its results as a dict keyed by COLUMNS.
+def run_case(generator, city_count, ticket_count, seed, branching = 'longest'):
+    cities, tickets = GENERATORS[generator](city_count, ticket_count, seed)
+    tickets = flightrouting.dedup_tickets(tickets)
+    unrouted = routing.Routing(cities).exclude_selfloops()
+
+    # greedy_seconds covers the local search too, as both go into the incumbent solve starts from.
+    start = time.time()
+    greedy = unrouted.greedy(MILE_COST, TAKEOFF_COST, tickets)
+    current_best = localsearch.improve(greedy, tickets, MILE_COST, TAKEOFF_COST)
+    greedy_seconds = time.time() - start
+
+    solve_stats = stats.Stats()
+    start = time.time()
+    solution = flightrouting.solve(unrouted, tickets, MILE_COST, TAKEOFF_COST, current_best, stats = solve_stats,
+                                   branching = branching)
+    solve_seconds = time.time() - start
+    nodes = solve_stats.counts.get('nodes expanded', 0)
+
+    return {'generator': generator, 'cities': city_count, 'tickets': ticket_count, 'seed': seed, 'branching': branching,
+            'status': 'ok' if solution.is_valid(tickets) else 'invalid',
+            'greedy_seconds': greedy_seconds, 'solve_seconds': solve_seconds, 'peak_kb': peak_kb(),
+            'nodes': nodes,
+            'greedy_cost': greedy.cost(MILE_COST, TAKEOFF_COST, tickets),
+            'local_search_cost': current_best.cost(MILE_COST, TAKEOFF_COST, tickets),
+            'cost': solution.cost(MILE_COST, TAKEOFF_COST, tickets)}
+
+# Runs a case and puts its results on the results queue; a case that raises gets an 'error' status,
+# with the exception under 'error'.
+def run_case_into(results, generator, city_count, ticket_count, seed, branching):
+    try:
+        result = run_case(generator, city_count, ticket_count, seed, branching)
+    except Exception as error:
+        result = {'generator': generator, 'cities': city_count, 'tickets': ticket_count, 'seed': seed,
+                  'branching': branching, 'status': 'error', 'error': type(error).__name__ + ": " + str(error)}
+    results.put(result)
+
+# Runs a case in a process of its own, so its peak memory is its own and it can be stopped after timeout seconds.
+# A process that dies without a result gets an 'error' status too, rather than counting as a timeout.
+def run_isolated(generator, city_count, ticket_count, seed, timeout, branching = 'longest'):
+    results = multiprocessing.Queue()
+    process = multiprocessing.Process(target = run_case_into,
+                                      args = (results, generator, city_count, ticket_count, seed, branching))
+    process.start()
+    try:
+        result = results.get(timeout = timeout)
+    except Queue.Empty:
+        result = {'generator': generator, 'cities': city_count, 'tickets': ticket_count, 'seed': seed,
+                  'branching': branching}
+        if process.exitcode != None:
+            result.update({'status': 'error', 'error': "exited with code %d" % process.exitcode})
+        else:
+            process.terminate()
+            result.update({'status': 'timeout', 'solve_seconds': float(timeout)})
+    process.join()
+
+    return result
+
+# Results files
+
+# Returns a result's value for a column as it appears in a results file; missing values are "-".
+def format_value(result, column):
+    value = result.get(column)
+    if value == None:
+        return "-"
+    if column in FLOAT_COLUMNS:
+        return "%.6f" % value
+    return str(value)
+
+def write_results(results, filename):
+    with open(filename, 'w') as f:
+        f.write(" ".join(COLUMNS) + "\n")
+        for result in results:
+            f.write(" ".join(format_value(result, column) for column in COLUMNS) + "\n")
+
+def read_results(filename):
+    results = []
+    with open(filename) as f:
+        header = f.readline().split()
+        for line in f:
+            fields = line.split()
+            if len(fields) != len(header):
+                continue
+            result = {}
+            for column, field in zip(header, fields):
+                if field == "-":
+                    continue
+                if column in INT_COLUMNS:
+                    result[column] = int(field)
+                elif column in FLOAT_COLUMNS:
+                    result[column] = float(field)
+                else:
+                    result[column] = field
+            result.setdefault('branching', 'longest')  # Results from before there was a choice
+            results.append(result)
+    return results
+
+def result_key(result):
+    return tuple(result[column] for column in KEY_COLUMNS)
+
+# Compares results against a baseline, printing a line for each case both ran.
+# A case regresses if its cost changed, or it now fails, or it's more than tolerance slower
+# (ignoring differences under min_seconds, which are mostly noise).  Returns the number of regressions.
+def compare(results, baseline, tolerance = 0.25, min_seconds = 0.05, out = sys.stdout):
+    baseline_by_key = dict((result_key(result), result) for result in baseline)
+    regressions = 0
+    for result in results:
+        old = baseline_by_key.get(result_key(result))
+        if old == None:
+            continue
+
+        problems = []
+        if result['status'] != 'ok' and old['status'] == 'ok':
+            problems.append(result['status'])
+        if 'cost' in result and 'cost' in old and abs(result['cost'] - old['cost']) > 1e-6:
+            problems.append("cost %.6f was %.6f" % (result['cost'], old['cost']))
+        new_seconds = result.get('solve_seconds', 0.0)
+        old_seconds = old.get('solve_seconds', 0.0)
+        if new_seconds - old_seconds > max(min_seconds, tolerance * old_seconds):
+            problems.append("slower")
+
+        ratio = new_seconds / old_seconds if old_seconds > 0 else float('inf')
+        label = " ".join(str(value) for value in result_key(result))
+        print >> out, "%-24s %9.4fs  (baseline %9.4fs, x%.2f)  %s" % (
+            label, new_seconds, old_seconds, ratio, ", ".join(problems) if problems else "ok")
+        if problems:
+            regressions += 1
+
+    return regressions
+
+def main(args):
+    parser = argparse.ArgumentParser(description = "Benchmark greedy and solve on generated instances.")
+    parser.add_argument('--generators', default = ",".join(sorted(GENERATORS)),
+                        help = "comma-separated instance shapes, from: " + ", ".join(sorted(GENERATORS)))
+    parser.add_argument('--sizes', default = "4,5,6,7", help = "comma-separated city counts")
+    parser.add_argument('--tickets', type = float, default = 1.0, help = "tickets per city (default 1)")
+    parser.add_argument('--seeds', type = int, default = 3, help = "instances of each shape and size")
+    parser.add_argument('--branching', default = 'longest',
+                        help = "comma-separated branching strategies to compare, from: " + ", ".join(sorted(branching.STRATEGIES)))
+    parser.add_argument('--timeout', type = float, default = 60.0, help = "seconds allowed per instance")
+    parser.add_argument('--output', default = "benchmark_results.txt", help = "results file to write")
+    parser.add_argument('--baseline', help = "results file to compare against")
+    parser.add_argument('--write-instances', metavar = 'DIRECTORY',
+                        help = "write the instances to DIRECTORY as NAME_cities.csv and NAME_tickets.csv pairs "
+                               "(as batch.py reads them) instead of running them")
+    options = parser.parse_args(args[1:])
+
+    results = []
+    for generator in options.generators.split(","):
+        for city_count in [int(size) for size in options.sizes.split(",")]:
+            ticket_count = max(1, int(round(city_count * options.tickets)))
+            for seed in range(options.seeds):
+                if options.write_instances:
+                    cities, tickets = GENERATORS[generator](city_count, ticket_count, seed)
+                    name = os.path.join(options.write_instances, instance_name(generator, city_count, ticket_count, seed))
+                    write_instance(cities, tickets, name + "_cities.csv", name + "_tickets.csv")
+                    continue
+                for strategy in options.branching.split(","):
+                    result = run_isolated(generator, city_count, ticket_count, seed, options.timeout, strategy)
+                    results.append(result)
+                    print " ".join(format_value(result, column) for column in COLUMNS)
+                    if 'error' in result:
+                        print >> sys.stderr, result['error']
+                    sys.stdout.flush()
+
+    if options.write_instances:
+        return 0
+
+    write_results(results, options.output)
+
+    if options.baseline:
+        print
+        print "Compared with", options.baseline + ":"
+        regressions = compare(results, read_results(options.baseline))
+        if regressions:
+            print regressions, "regression(s)"
+            return 1
+
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
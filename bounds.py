@@ -0,0 +1,116 @@
+# Lower bounds for the flight routing problem.
+# solve consults these at each node: if the cost of a partial routing plus a lower bound
+# on what it still has to spend is no better than the best known routing, the node is pruned.
+
+import routing
+import relaxation
+
+# A LowerBound estimates, without ever overestimating, the additional cost a partial Routing
+# must pay before it satisfies every ticket.  Subclasses override additional_cost.
+class LowerBound:
+    def __init__(self, route, tickets, mile_cost, takeoff_cost):
+        self.mile_cost    = mile_cost
+        self.takeoff_cost = takeoff_cost
+
+    # Returns a lower bound on the cost still to be added to route; float('inf') if route can't be completed.
+    # enough, if given, is as much as the caller needs to know: once the bound reaches it,
+    # it may stop working and return what it has so far.
+    def additional_cost(self, route, enough = None):
+        return 0.0
+
+# Every ticket's destination needs at least one included leg into it, and every ticket's origin
+# at least one included leg out of it.  For each such city that doesn't have one yet,
+# the cheapest leg that isn't excluded is a lower bound on what serving it will cost.
+# Distinct destinations need distinct in-legs (and distinct origins distinct out-legs), so the
+# in-leg costs can be summed, as can the out-leg costs; a single leg may serve an origin and a
+# destination at once, so the bound is the larger of the two sums, not their total.
+class EndpointBound(LowerBound):
+    def __init__(self, route, tickets, mile_cost, takeoff_cost):
+        LowerBound.__init__(self, route, tickets, mile_cost, takeoff_cost)
+
+        n = len(route.cities)
+        destinations = set(route.index[ticket.to_city] for ticket in tickets if ticket.from_city != ticket.to_city)
+        origins      = set(route.index[ticket.from_city] for ticket in tickets if ticket.from_city != ticket.to_city)
+
+        # The candidate legs for each city, cheapest first: those route hasn't already excluded, so the bound
+        # only holds for routings derived from route, as in a search of it.  These never change during a
+        # search; evaluating the bound just skips over the ones that have since been excluded.
+        excluded_rows = route.excluded_rows
+        self.in_legs  = dict((j, self.sorted_legs([(i, j) for i in range(n) if i != j and not (excluded_rows[i] >> j) & 1], route))
+                             for j in destinations)
+        self.out_legs = dict((i, self.sorted_legs([(i, j) for j in routing.bit_indices(route.full_row & ~excluded_rows[i]) if j != i], route))
+                             for i in origins)
+
+        self.destination_row = sum(1 << j for j in destinations)
+
+    # Returns (cost, from_index, to_index) for the given legs, cheapest first.
+    def sorted_legs(self, index_pairs, route):
+        distances = route.distances
+        return sorted((self.mile_cost * distances[i][j] + self.takeoff_cost, i, j) for i, j in index_pairs)
+
+    def additional_cost(self, route, enough = None):
+        excluded_rows = route.excluded_rows
+
+        in_cost = 0.0
+        for j in routing.bit_indices(self.destination_row):
+            if route.included_cols[j]:
+                continue  # Already has an included leg into it
+            cheapest = self.cheapest_open(self.in_legs[j], excluded_rows)
+            if cheapest is None:
+                return float('inf')  # Nothing can reach this destination any more
+            in_cost += cheapest
+
+        out_cost = 0.0
+        for i, legs in self.out_legs.items():
+            if route.included_rows[i]:
+                continue
+            cheapest = self.cheapest_open(legs, excluded_rows)
+            if cheapest is None:
+                return float('inf')  # This origin can't leave any more
+            out_cost += cheapest
+
+        return max(in_cost, out_cost)
+
+    # Returns the cost of the first leg in sorted_legs that isn't excluded, or None if they all are.
+    def cheapest_open(self, sorted_legs, excluded_rows):
+        for cost, i, j in sorted_legs:
+            if not (excluded_rows[i] >> j) & 1:
+                return cost
+        return None
+
+# The linear programming relaxation of what's left to do: see relaxation.py.  Far tighter than
+# EndpointBound, since it sees that each ticket needs a whole path and which legs tickets can share,
+# but each evaluation solves an LP, so it's best consulted after cheaper bounds have failed to prune.
+# The cuts found at one node are reused at the next, which is what keeps re-solving it affordable.
+class FlowBound(LowerBound):
+    def __init__(self, route, tickets, mile_cost, takeoff_cost, backend = 'simplex'):
+        LowerBound.__init__(self, route, tickets, mile_cost, takeoff_cost)
+        self.relaxation = relaxation.CutRelaxation(route, tickets, mile_cost, takeoff_cost, backend)
+
+    def additional_cost(self, route, enough = None):
+        return self.relaxation.bound(route, enough)
+
+# The most undecided legs a routing can have for default_bounds to include a FlowBound.  Its simplex
+# tableau has a row and a column per leg, so beyond this, each LP takes longer than it saves.
+FLOW_BOUND_LEGS = 120
+
+# Returns the bounds solve uses when it isn't given any: EndpointBound, then a FlowBound solved with
+# the given lp backend ('simplex' or 'scipy', as for relaxation.CutRelaxation) if route is small enough
+# for it to pay.  With lp None, just EndpointBound.
+def default_bounds(route, tickets, mile_cost, takeoff_cost, lp = 'simplex'):
+    lower_bounds = [EndpointBound(route, tickets, mile_cost, takeoff_cost)]
+    legs = sum(routing.bit_count(route.undecided_row(i)) for i in range(len(route.cities)))
+    if lp != None and legs <= FLOW_BOUND_LEGS:
+        lower_bounds.append(FlowBound(route, tickets, mile_cost, takeoff_cost, lp))
+    return lower_bounds
+
+# Returns the best (largest) of the given bounds on the cost still to be added to route.
+# If enough is given, stops as soon as one of them reaches it, so costly bounds listed after
+# cheap ones are only worked out when the cheap ones fall short.
+def additional_cost(bounds, route, enough = None):
+    best = 0.0
+    for bound in bounds:
+        best = max(best, bound.additional_cost(route, enough))
+        if enough != None and best >= enough:
+            break
+    return best
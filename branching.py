@@ -0,0 +1,107 @@
+# Branching strategies for the flight routing search.
+# At each node the search picks one undecided leg and branches on it: first including it, then excluding it.
+# Which leg it picks decides the shape (and often the size) of the whole search tree.
+
+import routing
+
+# A BranchingStrategy picks the leg to branch on.  Subclasses override choose.
+class BranchingStrategy:
+    def __init__(self, route, tickets, mile_cost, takeoff_cost):
+        self.mile_cost    = mile_cost
+        self.takeoff_cost = takeoff_cost
+
+    # Returns (from_index, to_index) of an undecided leg of route, or None if no leg is undecided.
+    def choose(self, route):
+        return longest_leg(route, range(len(route.cities)))
+
+# Returns the longest undecided leg out of the given cities (ties going to the last found), or None.
+# Only legs whose destinations are in to_row, if given, are considered.
+def longest_leg(route, from_indices, to_row = None):
+    distances = route.distances
+    best = None
+    best_miles = -1.0
+    for i in from_indices:
+        row = route.undecided_row(i)
+        if to_row != None:
+            row &= to_row
+        for j in routing.bit_indices(row):
+            if distances[i][j] >= best_miles:
+                best = (i, j)
+                best_miles = distances[i][j]
+    return best
+
+# Branch on the longest undecided leg, which costs the most to include; so its include branch
+# is pruned early, or else a long leg is settled near the root.
+class LongestLeg(BranchingStrategy):
+    pass
+
+# Branch on the shortest undecided leg, the cheapest to try including.
+class ShortestLeg(BranchingStrategy):
+    def choose(self, route):
+        distances = route.distances
+        best = None
+        best_miles = float('inf')
+        for i in range(len(route.cities)):
+            for j in routing.bit_indices(route.undecided_row(i)):
+                if distances[i][j] < best_miles:
+                    best = (i, j)
+                    best_miles = distances[i][j]
+        return best
+
+# Branch for the unsatisfied ticket with the fewest ways forward.  A ticket a->b that can't be flown yet
+# needs one of the undecided legs leaving the cities a already reaches; the ticket with the fewest such
+# legs is the most constrained, and of its legs, the one heading most directly to b is branched on.
+# Once every ticket is satisfied, falls back to the longest leg.
+class MostConstrainedTicket(BranchingStrategy):
+    def choose(self, route):
+        distances = route.distances
+        best = None
+        fewest = None
+        for a in range(len(route.cities)):
+            unsatisfied = route.ticket_rows[a] & ~route.reach_rows[a]
+            if not unsatisfied:
+                continue
+
+            reached = route.reach_rows[a]
+            legs = [(i, j) for i in routing.bit_indices(reached)
+                           for j in routing.bit_indices(route.undecided_row(i) & ~reached)]
+            if len(legs) == 0:
+                continue
+            if fewest == None or len(legs) < fewest:
+                fewest = len(legs)
+                b = unsatisfied.bit_length() - 1  # Any of a's unsatisfied destinations will do
+                best = min(legs, key = lambda leg: distances[leg[0]][leg[1]] + distances[leg[1]][b])
+
+        if best == None:
+            return BranchingStrategy.choose(self, route)
+        return best
+
+# Branch on legs out of ticket origins or into ticket destinations that don't have one yet, since every
+# one of those cities needs such a leg; the longest of them, as for LongestLeg.  Then on the longest leg of all.
+class RequiredAdjacent(BranchingStrategy):
+    def __init__(self, route, tickets, mile_cost, takeoff_cost):
+        BranchingStrategy.__init__(self, route, tickets, mile_cost, takeoff_cost)
+        real_tickets = [ticket for ticket in tickets if ticket.from_city != ticket.to_city]
+        self.origins      = sorted(set(route.index[ticket.from_city] for ticket in real_tickets))
+        self.destinations = sorted(set(route.index[ticket.to_city] for ticket in real_tickets))
+
+    def choose(self, route):
+        unserved_origins = [i for i in self.origins if not route.included_rows[i]]
+        unserved_destination_row = 0
+        for j in self.destinations:
+            if not route.included_cols[j]:
+                unserved_destination_row |= 1 << j
+
+        candidates = [leg for leg in [longest_leg(route, unserved_origins),
+                                      longest_leg(route, range(len(route.cities)), unserved_destination_row)]
+                      if leg != None]
+        if len(candidates) == 0:
+            return BranchingStrategy.choose(self, route)
+        return max(candidates, key = lambda leg: route.distances[leg[0]][leg[1]])
+
+STRATEGIES = {
+    'longest':     LongestLeg,
+    'shortest':    ShortestLeg,
+    'constrained': MostConstrainedTicket,
+    'adjacent':    RequiredAdjacent,
+}
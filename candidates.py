@@ -0,0 +1,186 @@
+# Candidate legs for large flight routing problems.
+# A Routing starts with every ordered pair of cities as an undecided leg, but a leg between two
+# far-apart cities is almost never worth flying: going by way of the cities in between costs little more.
+# Restricting the search to legs between near neighbours, plus the tickets' own legs, takes the number of
+# legs from n**2 down to about 2kn, which is what makes hundreds of cities possible at all.
+# The restriction can cut off the optimum, though, so verify() reports the cut legs that some
+# cheaper routing might still have used, and can search for one.
+
+import math
+from collections import defaultdict
+
+import routing
+import search
+
+# A grid of square cells over the cities, for finding a city's nearest neighbours without
+# measuring the distance to every other city.  Cells are sized to hold about per_cell cities each.
+class GridIndex:
+    def __init__(self, cities, per_cell = 2):
+        self.cities = list(cities)
+        self.min_x = min(city.x for city in self.cities)
+        self.min_y = min(city.y for city in self.cities)
+        width  = max(city.x for city in self.cities) - self.min_x
+        height = max(city.y for city in self.cities) - self.min_y
+
+        cell_count = max(1.0, len(self.cities) / float(per_cell))
+        self.size = max(width, height, 1) / math.sqrt(cell_count)
+        self.cells = defaultdict(list)
+        for city in self.cities:
+            self.cells[self.cell_of(city)].append(city)
+        self.max_ring = int(max(width, height) / self.size) + 1
+
+    def cell_of(self, city):
+        return (int(math.floor((city.x - self.min_x) / self.size)), int(math.floor((city.y - self.min_y) / self.size)))
+
+    # Yields the cells whose row and column are both within ring of cell, and one of them exactly ring away.
+    def ring_cells(self, cell, ring):
+        x, y = cell
+        if ring == 0:
+            yield cell
+            return
+        for dx in range(-ring, ring + 1):
+            yield (x + dx, y - ring)
+            yield (x + dx, y + ring)
+        for dy in range(-ring + 1, ring):
+            yield (x - ring, y + dy)
+            yield (x + ring, y + dy)
+
+    # Returns the k cities nearest to city (not counting city itself), nearest first; ties go by id.
+    # Searches rings of cells outward until the k'th nearest found is nearer than anything in the next ring.
+    def nearest(self, city, k):
+        cell = self.cell_of(city)
+        found = []
+        for ring in range(self.max_ring + 1):
+            for ring_cell in self.ring_cells(cell, ring):
+                for other in self.cells.get(ring_cell, []):
+                    if other is not city:
+                        found.append((city.distance_to(other), other.id, other))
+            # Every city within ring * size of city is in a cell no more than ring away.
+            if len(found) >= k:
+                found.sort()
+                if found[k - 1][0] <= ring * self.size:
+                    break
+        found.sort()
+        return [other for distance, id, other in found[:k]]
+
+# Records how a Routing's legs were restricted to candidates, and whether that could have cost anything.
+class CandidateReport:
+    def __init__(self):
+        self.cities     = 0
+        self.nearest    = 0     # Neighbours each city kept legs to and from
+        self.candidates = 0     # Legs left open
+        self.cut        = 0     # Open legs the restriction excluded
+        self.suspects   = None  # Once verified: the cut (from_city, to_city) legs a cheaper routing might use
+        self.search     = None  # If they were searched for: the search.SearchReport for the unrestricted problem
+        self.better     = None  # and the cheaper routing it found, if any
+
+    def __str__(self):
+        lines = ["Candidate legs: kept %d, cut %d (%d nearest neighbours of each of %d cities, and the ticket legs)" %
+                 (self.candidates, self.cut, self.nearest, self.cities)]
+        if self.suspects is not None:
+            if len(self.suspects) == 0:
+                lines.append("Verified: no cut leg could belong to a cheaper routing")
+            else:
+                legs = ", ".join(str(from_city) + " -> " + str(to_city) for from_city, to_city in self.suspects[:10])
+                if len(self.suspects) > 10:
+                    legs += ", ..."
+                lines.append("%d cut legs might belong to a cheaper routing: %s" % (len(self.suspects), legs))
+                if self.better != None:
+                    lines.append("Not verified: searching every leg found a routing costing %.6f" % self.search.best_cost)
+                elif self.search != None and self.search.complete():
+                    lines.append("Verified: searching every leg found nothing cheaper")
+                elif self.search != None:
+                    lines.append("Not verified: searching every leg stopped early (%s)" % self.search)
+        return "\n".join(lines)
+
+# Returns, for each city of route, the bitset of candidate legs out of it: legs to and from its
+# nearest k neighbours, every ticket's direct leg, and any leg route already includes.
+def candidate_rows(route, tickets, nearest):
+    rows = route.included_rows[:]
+    if len(route.cities) > 1 and nearest > 0:
+        index = GridIndex(route.cities)
+        for i, city in enumerate(route.cities):
+            for neighbour in index.nearest(city, nearest):
+                j = route.index[neighbour]
+                rows[i] |= 1 << j
+                rows[j] |= 1 << i
+    for ticket in tickets:
+        if ticket.from_city is not ticket.to_city:
+            rows[route.index[ticket.from_city]] |= 1 << route.index[ticket.to_city]
+    return rows
+
+# Returns a copy of route in which every open leg that isn't a candidate (see candidate_rows) is excluded.
+# The exclusions aren't propagated: they only narrow what the search will consider.
+# If given, report is filled in with how many legs were kept and cut.
+def restrict(route, tickets, nearest, report = None):
+    restricted = route.deepleg_copy()
+    rows = candidate_rows(route, tickets, nearest)
+    cut = 0
+    for i, row in enumerate(rows):
+        cut_row = restricted.full_row & ~row & ~restricted.excluded_rows[i]
+        if cut_row:
+            cut += routing.bit_count(cut_row)
+            restricted.set_state_row(restricted.excluded_rows, routing.EXCLUDED, i, restricted.excluded_rows[i] | cut_row)
+
+    if report != None:
+        report.cities     = len(route.cities)
+        report.nearest    = nearest
+        report.candidates = sum(routing.bit_count(restricted.full_row & ~row) for row in restricted.excluded_rows)
+        report.cut        = cut
+    return restricted
+
+# Checks whether restricting route to restricted (see restrict) could have cut off a routing cheaper than
+# best, the best routing found with the restriction.  Returns a cheaper routing if it finds one, else None.
+# A routing flying a cut leg i->j still needs a distinct leg into every other ticket destination, and one
+# out of every other ticket origin, so it costs at least the leg plus the cheapest such legs (as for
+# bounds.EndpointBound).  Legs for which that's already no cheaper than best are ruled out.
+# Any that aren't are then settled by searching route itself, starting from best; that can take as long
+# as not restricting at all, so time_limit and node_limit (as for flightrouting.solve) may cut it short;
+# branching is as for flightrouting.solve too.
+# If given, report is filled in with the legs that couldn't be ruled out, and how the search went.
+def verify(route, restricted, tickets, best, mile_cost, takeoff_cost, report = None, time_limit = None, node_limit = None,
+           branching = 'longest'):
+    best_cost = best.cost(mile_cost, takeoff_cost, tickets)
+    suspects = suspect_legs(route, restricted, tickets, best_cost, mile_cost, takeoff_cost)
+    if report != None:
+        report.suspects = suspects
+    if len(suspects) == 0:
+        return None
+
+    searcher = search.Search(route, tickets, mile_cost, takeoff_cost, best, branching = branching)
+    found = searcher.run(time_limit, node_limit)
+    better = None
+    if found is not best and found.cost(mile_cost, takeoff_cost, tickets) < best_cost - 1e-9:
+        better = found
+    if report != None:
+        report.search = search.SearchReport()
+        searcher.fill_report(report.search)
+        report.better = better
+    return better
+
+# Returns the cut legs, as (from_city, to_city) pairs, that the bound described for verify can't rule out.
+def suspect_legs(route, restricted, tickets, best_cost, mile_cost, takeoff_cost):
+    n = len(route.cities)
+    distances = route.distances
+    real_tickets = [ticket for ticket in tickets if ticket.from_city is not ticket.to_city]
+    destinations = set(route.index[ticket.to_city] for ticket in real_tickets)
+    origins      = set(route.index[ticket.from_city] for ticket in real_tickets)
+
+    def leg_cost(i, j):
+        return mile_cost * distances[i][j] + takeoff_cost
+
+    # The cheapest open leg into each destination and out of each origin, over all of route's open legs.
+    cheapest_in  = dict((j, min([leg_cost(i, j) for i in range(n) if i != j and not (route.excluded_rows[i] >> j) & 1] or [0.0]))
+                        for j in destinations)
+    cheapest_out = dict((i, min([leg_cost(i, j) for j in range(n) if j != i and not (route.excluded_rows[i] >> j) & 1] or [0.0]))
+                        for i in origins)
+    in_total  = sum(cheapest_in.values())
+    out_total = sum(cheapest_out.values())
+
+    suspects = []
+    for i in range(n):
+        for j in routing.bit_indices(restricted.excluded_rows[i] & ~route.excluded_rows[i]):
+            bound = leg_cost(i, j) + max(in_total - cheapest_in.get(j, 0.0), out_total - cheapest_out.get(i, 0.0))
+            if bound < best_cost - 1e-9:
+                suspects.append((route.cities[i], route.cities[j]))
+    return suspects
@@ -5,68 +5,103 @@
 # 2-22-13
 
 import sys
+import time
+import argparse
+from collections import OrderedDict
 import routing
+import search
+import bounds
+import relaxation
+import parallel
+import localsearch
+import reduction
+import branching
+import candidates
+import stats as search_stats
 
 # File I/O
 
-# Returns a list of City objects loaded from the given filename.
-# Expects a header row; does no format checking whatsoever.
-def load_cities(filename):
-    city_list = []
-    
+# Counts the rows a loader read, and the ones it had to skip.
+class LoadReport:
+    def __init__(self, filename):
+        self.filename = filename
+        self.rows           = 0  # Data rows read, not counting the header or blank lines
+        self.malformed      = 0  # Rows with missing or unreadable fields
+        self.unknown_cities = 0  # Ticket rows naming a city that isn't in the city file
+        
+    def skipped(self):
+        return self.malformed + self.unknown_cities
+        
+    def __str__(self):
+        return "".join([self.filename, ": read ", str(self.rows), " rows, skipped ",
+                        str(self.malformed), " malformed and ",
+                        str(self.unknown_cities), " with unknown cities"])
+
+# Yields the whitespace-separated fields of each data row of the given file,
+# skipping the header row and blank lines, and counting rows in report (if given).
+def iter_rows(filename, report = None):
     fp = open(filename)
     
     # I've never actually found the csv module terribly helpful.
-    header_line = True
-    for line in fp:
-        # Skip the header
-        if header_line:
-            header_line = False
+    try:
+        fp.readline()  # Skip the header
+        for line in fp:
+            split = line.split()
+            if len(split) == 0:
+                continue
+            if report != None:
+                report.rows += 1
+            yield split
+    finally:
+        fp.close()
+
+# Yields City objects loaded from the given filename, one row at a time.
+# Expects a header row.  Rows without an id and integer coordinates are skipped,
+# and counted in report (a LoadReport) if one is given.
+def iter_cities(filename, report = None):
+    for split in iter_rows(filename, report):
+        try:
+            id = split[0]
+            x  = int(split[1])
+            y  = int(split[2])
+        except (IndexError, ValueError):
+            if report != None:
+                report.malformed += 1
             continue
             
-        stripped = line.strip()
-        split    = stripped.split()
-        
-        id = split[0]
-        x  = int(split[1])  # does no format checking
-        y  = int(split[2])
-        
-        city_list.append(routing.City(id, x, y))
-    
-    fp.close()
-    
-    return city_list
+        yield routing.City(id, x, y)
 
-# Returns a list of Ticket objects loaded from the given filename;
+# Returns a list of City objects loaded from the given filename.
+# Expects a header row; see iter_cities for what happens to bad rows.
+def load_cities(filename, report = None):
+    return list(iter_cities(filename, report))
+
+# Yields Ticket objects loaded from the given filename, one row at a time;
 # requires a dictionary mapping city ids to City objects.    
-# Expects a header row; does no format checking.
-# If a ticket's origin or destination is a nonexistent city, that ticket is
-# ignored and not included in the final list of Tickets.
-def load_tickets(filename, city_dict):
-    tickets = []
-    
-    fp = open(filename)
-    
-    header_line = True
-    for line in fp:
-        # skip the header
-        if header_line:
-            header_line = False
+# Expects a header row.
+# If a ticket's origin or destination is a nonexistent city, or the row doesn't
+# have both, that ticket is skipped and counted in report (a LoadReport) if one is given.
+def iter_tickets(filename, city_dict, report = None):
+    for split in iter_rows(filename, report):
+        if len(split) < 2:
+            if report != None:
+                report.malformed += 1
             continue
             
-        stripped = line.strip()
-        split    = stripped.split()
-        
         from_id = split[0]
         to_id   = split[1]
         
-        # Ignore tickets with unknown origins or destinations
+        # Skip tickets with unknown origins or destinations
         if from_id in city_dict and to_id in city_dict:
-            tickets.append(routing.Ticket(city_dict[from_id], city_dict[to_id]))
-    
-    fp.close()
-    
-    return tickets
+            yield routing.Ticket(city_dict[from_id], city_dict[to_id])
+        elif report != None:
+            report.unknown_cities += 1
+
+# Returns a list of Ticket objects loaded from the given filename;
+# requires a dictionary mapping city ids to City objects.    
+# Expects a header row; see iter_tickets for what happens to bad rows.
+def load_tickets(filename, city_dict, report = None):
+    return list(iter_tickets(filename, city_dict, report))
     
 # Given a list of City objects, returns a dictionary mapping city ids to Cities
 def make_city_dict(cities):
@@ -76,14 +111,20 @@ def make_city_dict(cities):
         
     return city_dict
     
-# Returns a list of Tickets, sans duplicates
+# Returns a list of Tickets, sans duplicates, in order of first appearance.
+# tickets may be any iterable, e.g. from iter_tickets.
+# Each returned Ticket's multiplicity is the number of times it appeared (counting
+# the multiplicities of the Tickets given); the Tickets given are not changed.
 def dedup_tickets(tickets):
-    deduped_tickets = []
-    ticket_reprs = []
+    counts = OrderedDict()
     for ticket in tickets:
-        if not repr(ticket) in ticket_reprs:
-            deduped_tickets.append(ticket)
-            ticket_reprs.append(repr(ticket))
+        counts[ticket] = counts.get(ticket, 0) + ticket.multiplicity
+        
+    deduped_tickets = []
+    for ticket, multiplicity in counts.items():
+        deduped = routing.Ticket(ticket.from_city, ticket.to_city, set_required = False)
+        deduped.multiplicity = multiplicity
+        deduped_tickets.append(deduped)
             
     return deduped_tickets
     
@@ -92,88 +133,159 @@ def ticket_sorted_cities(tickets):
     ticket_cities = []
     for ticket in tickets:
         if ticket.from_city not in ticket_cities:
-            ticket_cities.append(from_city)
+            ticket_cities.append(ticket.from_city)
         if ticket.to_city not in ticket_cities:
-            ticket_cities.append(to_city)
+            ticket_cities.append(ticket.to_city)
             
     return sorted(ticket_cities, key = lambda city: city.id)
 
-# Recursively solves the flight routing problem, returning the current best solution.   
-def solve(route, tickets, mile_cost, takeoff_cost, current_best = None):
+# Solves the flight routing problem, returning the current best solution.
+# route itself is left untouched: the search works on a private copy.
+# lower_bounds is a list of bounds.LowerBound objects consulted at every node;
+# by default, bounds.default_bounds are used.
+# order is the node-selection order: 'depth' (depth-first), 'best' (best-bound-first) or 'hybrid'.
+# If workers is more than 1, the search is shared between that many processes (see parallel.solve).
+# stats, if given, is a stats.Stats that the search records its node counts, prunes and timings in.
+# time_limit (in seconds) and node_limit, if given, stop the search early with the best solution so far
+# (which may be current_best, or None if there was none); they need workers to be 1.
+# on_improvement, if given, is called as on_improvement(routing, cost) for each better routing found.
+# report, if given, is a search.SearchReport to fill in with the best cost, a proven lower bound and the gap.
+# table, if given, is a search.TranspositionTable shared by solves of the same problem (e.g. one
+# resumed after a time limit), so that states one of them has settled aren't searched again.
+# branching names the strategy for picking the leg to branch on: 'longest' (the default), 'shortest',
+# 'constrained' (for the ticket with the fewest ways forward) or 'adjacent' (to unserved ticket cities).
+def solve(route, tickets, mile_cost, takeoff_cost, current_best = None, lower_bounds = None, order = 'depth', workers = 1,
+          stats = None, time_limit = None, node_limit = None, on_improvement = None, report = None, table = None,
+          branching = 'longest'):
     # Have we even got any tickets to connect?  If not, we're done.
     if len(tickets) == 0:
         if current_best == None:
             current_best = route
-        return current_best
+        return solved(current_best, tickets, mile_cost, takeoff_cost, report)
             
     # If we only have one ticket, we simply use the direct route -- or no route if it's a selfloop.
     if len(tickets) == 1:
         if  tickets[0].from_city != tickets[0].to_city:
-            return route.include_leg(tickets[0].from_city, tickets[0].to_city)
+            return solved(route.include_leg(tickets[0].from_city, tickets[0].to_city), tickets, mile_cost, takeoff_cost, report)
         else:
-            return route
-        
-    # Backtracks when we've ruled out a ticket's route
-    for ticket in tickets:
-        if route.explicitly_excludes(ticket.from_city, ticket.to_city):
-            return current_best  # This certainly isn't better, it doesn't even work!
-
-    # Bounds when we already know a better solution.
-    if current_best != None:
-        best_cost = current_best.cost(mile_cost, takeoff_cost, tickets)
-        if route.cost(mile_cost, takeoff_cost, tickets) >= best_cost:
-            return current_best  # Since this one can't do better.
+            return solved(route, tickets, mile_cost, takeoff_cost, report)
             
-    undecided_legs = sorted(route.undecided_legs(), key = lambda leg: leg.miles)
-    
-    # We've run out of choices.  Update current_best if necessary, then return it.
-    if len(undecided_legs) == 0:
-        if route.is_valid(tickets):
-            cost = route.cost(mile_cost, takeoff_cost, tickets)
-            if current_best == None or cost < current_best.cost(mile_cost, takeoff_cost, tickets):
-                current_best = route
-        return current_best
+    if workers > 1:
+        if time_limit != None or node_limit != None:
+            raise ValueError("time and node limits need a single worker")
+        best = parallel.solve(route, tickets, mile_cost, takeoff_cost, current_best, lower_bounds, workers,
+                              stats = stats, on_improvement = on_improvement, branching = branching)
+        return solved(best, tickets, mile_cost, takeoff_cost, report)
             
-    branch_leg = undecided_legs[-1]
-        
-    # INCLUSION
-    skip_inclusion = False
+    searcher = search.Search(route, tickets, mile_cost, takeoff_cost, current_best, lower_bounds, order, stats, on_improvement, table,
+                             branching)
+    best = searcher.run(time_limit, node_limit)
+    if report != None:
+        searcher.fill_report(report)
+    return best
     
-    # Bounds when including the branch leg will be too costly
-    if current_best != None:
-        best_cost = current_best.cost(mile_cost, takeoff_cost, tickets)
-        route_cost = route.cost(mile_cost, takeoff_cost, tickets)
-        if route_cost + (branch_leg.miles * mile_cost) + takeoff_cost >= best_cost:
-            skip_inclusion = True  # Adding this leg can't do any better
+# Returns best, a solution known to be optimal, filling in report (if given) to say so.
+def solved(best, tickets, mile_cost, takeoff_cost, report):
+    if report != None:
+        report.best_cost   = best.cost(mile_cost, takeoff_cost, tickets)
+        report.lower_bound = report.best_cost
+        report.stop_reason = 'complete'
+    return best
     
-    if not skip_inclusion:
-        included = route.include_leg(branch_leg.from_city, branch_leg.to_city)
-        current_best = solve(included, tickets, mile_cost, takeoff_cost, current_best)
+# Solves the whole problem of flying tickets between cities, as main does once they're loaded:
+# leaves out the cities that can't help, restricts the search to the legs between each city and its
+# nearest neighbours if nearest is given (then checking the legs left out, if verify is set), and
+# searches from a greedy routing improved by local search.  Returns the best routing found, over all
+# of cities.  time_limit covers the local search, the search and the verification together.
+# stats, time_limit, node_limit, report and branching are as for solve, and lp as for
+# bounds.default_bounds; if given, reduction_report and candidate_report are filled in as by
+# reduction.reduce_cities and candidates.restrict (and candidates.verify).
+def solve_problem(cities, tickets, mile_cost, takeoff_cost, stats = None, time_limit = None, node_limit = None,
+                  report = None, branching = 'longest', lp = 'simplex', nearest = None, verify = False,
+                  reduction_report = None, candidate_report = None):
+    # Leave out the cities that can't help
+    reduced_cities = reduction.reduce_cities(cities, ticket_sorted_cities(tickets), mile_cost, takeoff_cost,
+                                             reduction_report)
     
-    # EXCLUSION
-    skip_exclusion = False
+    # With nearest, most pairs of cities are never looked at, so their distances aren't worked out
+    unrouted = routing.Routing(reduced_cities, sparse = nearest != None).exclude_selfloops()
     
-    if not skip_exclusion:
-        excluded = route.exclude_leg(branch_leg.from_city, branch_leg.to_city)
-        current_best = solve(excluded, tickets, mile_cost, takeoff_cost, current_best)
+    # Leave out the legs between far-apart cities, if asked to
+    searched = unrouted
+    if nearest != None:
+        searched = candidates.restrict(unrouted, tickets, nearest, candidate_report)
     
-    return current_best
+    greedy = unrouted.greedy(mile_cost, takeoff_cost, tickets, stats)
+    improve_start = time.time()
+    current_best = localsearch.improve(greedy, tickets, mile_cost, takeoff_cost, stats, time_limit)
+    if time_limit != None:
+        time_limit = max(0.0, time_limit - (time.time() - improve_start))
+    lower_bounds = bounds.default_bounds(searched, tickets, mile_cost, takeoff_cost, lp)
+    search_start = time.time()
+    solution = solve(searched, tickets, mile_cost, takeoff_cost, current_best, lower_bounds, stats = stats,
+                     time_limit = time_limit, node_limit = node_limit, report = report, branching = branching)
+    if time_limit != None:
+        time_limit = max(0.0, time_limit - (time.time() - search_start))
+    
+    # Check whether the legs left out could have done better, if asked to and there's time left
+    if nearest != None and verify and (time_limit == None or time_limit > 0):
+        better = candidates.verify(unrouted, searched, tickets, solution, mile_cost, takeoff_cost, candidate_report,
+                                   time_limit = time_limit, node_limit = node_limit, branching = branching)
+        if better != None:
+            solution = better
+    
+    if len(reduced_cities) < len(cities):
+        solution = reduction.restore_cities(solution, cities)
+    return solution
     
 def main(args):
-    if len(args) != 3:
-        print "  Usage: flightrouting.py <city_file> <ticket_file>\n"
-        return
+    parser = argparse.ArgumentParser(prog = "flightrouting.py")
+    parser.add_argument('city_file')
+    parser.add_argument('ticket_file')
+    parser.add_argument('--stats', action = 'store_true',
+                        help = "print search statistics (node counts, prunes, rule firings, timings) to stderr")
+    parser.add_argument('--time-limit', type = float, metavar = 'SECONDS',
+                        help = "stop after this long (local search and --verify included) and show the best routing found so far")
+    parser.add_argument('--node-limit', type = int, metavar = 'NODES',
+                        help = "stop searching after expanding this many nodes")
+    parser.add_argument('--branching', choices = sorted(branching.STRATEGIES), default = 'longest',
+                        help = "how to pick the leg to branch on (default: longest)")
+    parser.add_argument('--lp', choices = ['simplex', 'scipy', 'off'], default = 'simplex',
+                        help = "how to solve the LP relaxation used as a lower bound, if at all (default: simplex)")
+    parser.add_argument('--nearest', type = int, metavar = 'K',
+                        help = "only consider legs between each city and its K nearest neighbours, and the ticket legs")
+    parser.add_argument('--verify', action = 'store_true',
+                        help = "with --nearest, check whether a cut leg could have made a cheaper routing (which may mean searching them all)")
+    options = parser.parse_args(args[1:])
+    if options.verify and options.nearest == None:
+        parser.error("--verify needs --nearest")
+    if options.lp == 'scipy' and relaxation.linprog == None:
+        parser.error("--lp scipy needs SciPy, which isn't installed")
     
-    city_file = args[1]
-    ticket_file = args[2]
+    city_file = options.city_file
+    ticket_file = options.ticket_file
+    stats = search_stats.Stats() if options.stats else None
     
-    cities = load_cities(city_file)
-    all_tickets = load_tickets(ticket_file, make_city_dict(cities))
-    tickets = dedup_tickets(all_tickets)  # removes duplicates; they affect nothing.
+    city_report = LoadReport(city_file)
+    ticket_report = LoadReport(ticket_file)
+    cities = load_cities(city_file, city_report)
+    tickets = dedup_tickets(iter_tickets(ticket_file, make_city_dict(cities), ticket_report))  # duplicates affect nothing.
+    for report in [city_report, ticket_report]:
+        if report.skipped() > 0:
+            print >> sys.stderr, report
     
-    unrouted = routing.Routing(cities).exclude_selfloops()
-    current_best = unrouted.greedy(1.0, 0.2, tickets)
-    solution = solve(unrouted, tickets, 1.0, 0.2, current_best)
+    reduction_report = reduction.ReductionReport()
+    candidate_report = candidates.CandidateReport() if options.nearest != None else None
+    report = search.SearchReport()
+    solution = solve_problem(cities, tickets, 1.0, 0.2, stats = stats, time_limit = options.time_limit,
+                             node_limit = options.node_limit, report = report, branching = options.branching,
+                             lp = None if options.lp == 'off' else options.lp, nearest = options.nearest,
+                             verify = options.verify, reduction_report = reduction_report,
+                             candidate_report = candidate_report)
+    if len(reduction_report.removed) > 0:
+        print >> sys.stderr, reduction_report
+    if candidate_report != None:
+        print >> sys.stderr, candidate_report
     
     # Show the legs to fly
     print "Legs to fly:"
@@ -183,13 +295,21 @@ def main(args):
         
     # Show ticket itineraries
     print "Ticket itineraries:"
-    for ticket in sorted(all_tickets, key = lambda tt: str(tt.from_city) + str(tt.to_city)):
-        print str(ticket) + ": ", ", ".join([str(ll) for ll in ticket.itinerary(solution)])
+    for ticket in sorted(tickets, key = lambda tt: str(tt.from_city) + str(tt.to_city)):
+        label = str(ticket)
+        if ticket.multiplicity > 1:
+            label += " (x" + str(ticket.multiplicity) + ")"
+        print label + ": ", ", ".join([str(ll) for ll in ticket.itinerary(solution)])
     print
         
     # Show total miles and total takeoffs:
     print "Total miles:", solution.miles(tickets)
     print "Total takeoffs:", solution.takeoffs(tickets)
+    if not report.complete():
+        print report
+    
+    if stats != None:
+        print >> sys.stderr, stats
     
     return solution
     
@@ -0,0 +1,271 @@
+# Re-solving a flight routing problem when its tickets change a little.
+# Solving from scratch costs as much after a one-ticket change as it did the first time, but most of
+# the old routing is still as good as it was: only the legs near the tickets that came or went are worth
+# reconsidering.  So the old routing is repaired into one that flies the new tickets, and then only
+# the legs around the change are searched again, with the rest of the old routing held fixed.
+# That's a local optimum, not a proven global one; pass local = False to search every leg instead.
+#
+# What the last search learned is kept where it's still true.  The LP relaxation's cuts are sets of
+# cities that some ticket must leave, checked against the tickets at each use, so they always carry over.
+# A bound in a TranspositionTable, if one is kept, says no routing in some state flying the old tickets
+# costs less; a routing flying more tickets flies the old ones too, so the bound still holds after tickets
+# are only added.  Once any are removed, the table is cleared.
+
+from collections import OrderedDict
+
+import routing
+import search
+import bounds
+import candidates
+import flightrouting
+
+# What a re-solve did: the tickets that came and went, how much of the routing it reconsidered,
+# what the repaired old routing cost, and what it found.
+class ResolveReport:
+    def __init__(self):
+        self.added         = []    # The tickets new to the problem
+        self.removed       = []    # The tickets no longer in it (fewer passengers on a ticket isn't a change)
+        self.affected      = 0     # Cities whose legs were reconsidered
+        self.free_legs     = 0     # Legs left undecided for the search
+        self.repaired_cost = None  # The cost of the old routing, repaired to fly the new tickets
+        self.cost          = None  # The cost of the routing returned
+        self.table_kept    = False # Whether there was a TranspositionTable and it carried over
+        self.search        = None  # The search.SearchReport for the search of the affected legs, if there was one
+
+    def __str__(self):
+        lines = ["Re-solved after %d added and %d removed tickets: %d affected cities, %d legs searched" %
+                 (len(self.added), len(self.removed), self.affected, self.free_legs)]
+        if self.repaired_cost != None and self.cost != None:
+            lines.append("Repaired routing cost %.6f, re-solved cost %.6f" % (self.repaired_cost, self.cost))
+        if self.search != None:
+            lines.append(str(self.search))
+        return "\n".join(lines)
+
+# Keeps a solved problem, and the state worth keeping from solving it, so it can be re-solved as its
+# tickets change.  solution must be a Routing that flies every one of tickets (from flightrouting.solve,
+# say); table, if given, is a TranspositionTable (the one solve used for it, say) for the re-solves to share.
+# Without one, none is kept: hashing the states means making Zobrist keys for every pair of cities, which
+# on large problems takes longer than the re-solve it might save.
+# Each re-solve reconsiders the legs among the cities of the changed tickets, their nearest neighbours,
+# and the cities of the legs it had to add or could drop; lp is as for bounds.default_bounds.
+class Resolver:
+    def __init__(self, solution, tickets, mile_cost, takeoff_cost, table = None, neighbours = 3, lp = 'simplex'):
+        self.tickets      = flightrouting.dedup_tickets(tickets)
+        if not solution.is_valid(self.tickets):
+            raise ValueError("the solution doesn't fly every ticket")
+        mark_required(solution.cities, self.tickets)
+        self.mile_cost    = mile_cost
+        self.takeoff_cost = takeoff_cost
+        self.neighbours   = neighbours
+        self.lp           = lp
+        self.solution     = self.copy_legs(solution)
+        self.table        = table
+        self.cuts         = OrderedDict()  # The LP relaxation's cut pool, shared by every re-solve
+        self.grid         = candidates.GridIndex(solution.cities) if len(solution.cities) > 1 else None
+
+    # Returns a fresh Routing of the same cities holding just route's included legs, as undecided as possible.
+    def copy_legs(self, route):
+        copied = routing.Routing(route.cities, route.distances)
+        for i in range(len(route.cities)):
+            for j in routing.bit_indices(route.included_rows[i]):
+                copied.add(i, j)
+        return copied
+
+    def leg_cost(self, i, j):
+        return self.mile_cost * self.solution.distances[i][j] + self.takeoff_cost
+
+    # Updates the tickets by adding the Tickets in added and taking away the Tickets in removed
+    # (by origin and destination, with their multiplicities), and returns a Routing flying the new tickets.
+    # time_limit and node_limit are as for flightrouting.solve, for the search of the affected legs;
+    # branching too.  With local False, every leg is searched again, and the result is optimal.
+    # If given, report is filled in with what changed and how the re-solve went.
+    def resolve(self, added = (), removed = (), time_limit = None, node_limit = None, branching = 'longest',
+                local = True, report = None):
+        previous = self.solution
+        for ticket in list(added) + list(removed):
+            if ticket.from_city not in previous.index or ticket.to_city not in previous.index:
+                raise ValueError("ticket " + str(ticket) + " names a city the solution doesn't have")
+
+        counts = OrderedDict((ticket, ticket.multiplicity) for ticket in self.tickets)
+        for ticket in removed:
+            if ticket not in counts:
+                raise ValueError("ticket " + str(ticket) + " isn't one of the tickets")
+            counts[ticket] -= ticket.multiplicity
+            if counts[ticket] <= 0:
+                del counts[ticket]
+        for ticket in added:
+            counts[ticket] = counts.get(ticket, 0) + ticket.multiplicity
+        tickets = []
+        for ticket, multiplicity in counts.items():
+            kept = routing.Ticket(ticket.from_city, ticket.to_city, set_required = False)
+            kept.multiplicity = multiplicity
+            tickets.append(kept)
+        added_tickets   = [ticket for ticket in tickets if ticket not in self.tickets]
+        removed_tickets = [ticket for ticket in self.tickets if ticket not in counts]
+        self.tickets = tickets
+        mark_required(previous.cities, tickets)
+
+        # The old table's bounds don't hold once tickets are taken away
+        if len(removed_tickets) > 0 and self.table != None:
+            self.table = search.TranspositionTable(self.table.capacity)
+        if report != None:
+            report.added      = added_tickets
+            report.removed    = removed_tickets
+            report.table_kept = self.table != None and len(removed_tickets) == 0
+
+        if len(tickets) == 0:
+            return self.finish(routing.Routing(previous.cities, previous.distances), report)
+        repaired, repair_legs = self.repair(added_tickets)
+        if len(added_tickets) == 0 and len(removed_tickets) == 0:
+            return self.finish(repaired, report)
+
+        # The cities of the changed tickets and of the legs added for them are where the routing changed
+        changed = 0
+        for ticket in added_tickets + removed_tickets:
+            changed |= (1 << previous.index[ticket.from_city]) | (1 << previous.index[ticket.to_city])
+        for i, j in repair_legs:
+            changed |= (1 << i) | (1 << j)
+
+        # The legs the removed tickets flew, and those at changed cities, may not be needed any more
+        droppable = set()
+        for ticket in removed_tickets:
+            for leg in previous.included_route(ticket.from_city, ticket.to_city) or []:
+                droppable.add((previous.index[leg.from_city], previous.index[leg.to_city]))
+        for i in range(len(repaired.cities)):
+            for j in routing.bit_indices(repaired.included_rows[i]):
+                if (changed >> i) & 1 or (changed >> j) & 1:
+                    droppable.add((i, j))
+        repaired, dropped_legs = self.drop_unneeded(repaired, droppable)
+        if report != None:
+            report.repaired_cost = repaired.cost(self.mile_cost, self.takeoff_cost, tickets)
+
+        if local:
+            affected = self.affected_cities(changed, dropped_legs)
+        else:
+            affected = previous.full_row
+        route = self.restricted_route(repaired, affected, local)
+        if report != None:
+            report.affected  = routing.bit_count(affected)
+            report.free_legs = sum(routing.bit_count(route.undecided_row(i)) for i in range(len(route.cities)))
+
+        # The legs held fixed fly most tickets whatever the search does, so it only has to watch the rest
+        open_tickets = route.unconnected_tickets(tickets)
+        if len(open_tickets) == 0:
+            return self.finish(route, report)
+        lower_bounds = bounds.default_bounds(route, open_tickets, self.mile_cost, self.takeoff_cost, self.lp)
+        for lower_bound in lower_bounds:
+            if isinstance(lower_bound, bounds.FlowBound):
+                lower_bound.relaxation.cuts = self.cuts
+        searcher = search.Search(route, open_tickets, self.mile_cost, self.takeoff_cost, repaired, lower_bounds,
+                                 table = self.table, branching = branching)
+        best = searcher.run(time_limit, node_limit)
+        if report != None:
+            report.search = search.SearchReport()
+            searcher.fill_report(report.search)
+        return self.finish(best, report)
+
+    def finish(self, best, report):
+        self.solution = self.copy_legs(best)
+        if report != None:
+            report.cost = self.solution.cost(self.mile_cost, self.takeoff_cost, self.tickets)
+        return self.solution
+
+    # Returns a copy of the current solution that also flies the given tickets.  Each ticket it doesn't fly
+    # yet gets the cheapest single leg from somewhere its origin reaches to somewhere that reaches its destination.
+    # Also returns the legs added, as (from_index, to_index) pairs.
+    def repair(self, added_tickets):
+        repaired = self.copy_legs(self.solution)
+        repair_legs = []
+        for ticket in added_tickets:
+            a = repaired.index[ticket.from_city]
+            b = repaired.index[ticket.to_city]
+            if (repaired.reach_rows[a] >> b) & 1:
+                continue
+            cost, i, j = min((self.leg_cost(i, j), i, j) for i in routing.bit_indices(repaired.reach_rows[a])
+                                                         for j in routing.bit_indices(repaired.reached_rows[b]))
+            repaired.add(i, j)
+            repair_legs.append((i, j))
+        return repaired, repair_legs
+
+    # Returns the bitset of cities whose legs a re-solve reconsiders: the changed cities and their nearest
+    # neighbours, and the ends of the legs dropped.
+    def affected_cities(self, changed, dropped_legs):
+        affected = changed
+        for i, j in dropped_legs:
+            affected |= (1 << i) | (1 << j)
+        if self.grid != None and self.neighbours > 0:
+            for i in routing.bit_indices(changed):
+                for neighbour in self.grid.nearest(self.solution.cities[i], self.neighbours):
+                    affected |= 1 << self.solution.index[neighbour]
+        return affected
+
+    # Returns route without whichever of the given legs the tickets can do without, trying the costliest
+    # first, and the legs it dropped.  A leg is only needed by the tickets from cities that reach it to
+    # cities it reaches, so only their origins are searched from to see if they still get there without it.
+    def drop_unneeded(self, route, legs):
+        ticket_rows = [0] * len(route.cities)
+        for ticket in self.tickets:
+            ticket_rows[route.index[ticket.from_city]] |= 1 << route.index[ticket.to_city]
+
+        dropped = []
+        for cost, i, j in sorted([(self.leg_cost(i, j), i, j) for i, j in legs], reverse = True):
+            if not (route.included_rows[i] >> j) & 1:
+                continue
+            rows = route.included_rows[:]
+            rows[i] &= ~(1 << j)
+            needed = False
+            for a in routing.bit_indices(route.reached_rows[i]):
+                if ticket_rows[a] & route.reach_rows[j] & ~route.search_rows(a, rows):
+                    needed = True
+                    break
+            if not needed:
+                route = route.deepleg_copy()
+                route.remove(i, j)
+                dropped.append((i, j))
+        return self.copy_legs(route), dropped
+
+    # Returns a Routing to search: repaired's legs that don't touch an affected city are included, and
+    # the only legs left undecided are repaired's other legs, and the legs between affected cities that
+    # join near neighbours or are a ticket's own; with local False, every leg is left undecided.
+    # As for candidates.restrict, none of this is propagated.
+    def restricted_route(self, repaired, affected, local):
+        route = routing.Routing(repaired.cities, repaired.distances).exclude_selfloops()
+        n = len(route.cities)
+        if local:
+            near_rows = [0] * n
+            if self.grid != None and self.neighbours > 0:
+                for i in routing.bit_indices(affected):
+                    for neighbour in self.grid.nearest(route.cities[i], self.neighbours):
+                        j = route.index[neighbour]
+                        near_rows[i] |= 1 << j
+                        near_rows[j] |= 1 << i
+            for ticket in self.tickets:
+                near_rows[route.index[ticket.from_city]] |= 1 << route.index[ticket.to_city]
+        else:
+            near_rows = [route.full_row] * n
+
+        for i in range(n):
+            solution_row = repaired.included_rows[i]
+            if (affected >> i) & 1:
+                allowed = (affected & near_rows[i]) | solution_row
+            else:
+                allowed = affected & solution_row
+            for j in routing.bit_indices(solution_row & ~allowed):
+                route.add(i, j)
+            excluded = route.full_row & ~allowed & ~solution_row & ~route.excluded_rows[i]
+            if excluded:
+                route.set_state_row(route.excluded_rows, routing.EXCLUDED, i, route.excluded_rows[i] | excluded)
+        return route
+
+# Sets the required_origin and required_destination flags of cities to match tickets, as if the
+# Tickets had just been made: the Tickets taken away mustn't leave them set.
+# A ticket from a city to itself needs no leg, so it doesn't set them.
+def mark_required(cities, tickets):
+    for city in cities:
+        city.required_origin = False
+        city.required_destination = False
+    for ticket in tickets:
+        if ticket.from_city is ticket.to_city:
+            continue
+        ticket.from_city.required_origin = True
+        ticket.to_city.required_destination = True
@@ -0,0 +1,177 @@
+# Local search for the flight routing problem.
+# Starting from a valid routing (greedy's, say), repeatedly makes small changes to its legs, those that
+# save the most first, while still flying every ticket, until none of them helps.
+# The result is a tighter incumbent for solve, so its cost and bound tests prune more.
+# Moves only ever combine legs whose ends are near each other, through hubs near those ends, so a
+# round costs about the number of legs times NEIGHBOURS squared rather than legs squared times cities.
+
+import time
+
+import routing
+import candidates
+
+# How many of its nearest cities each city counts as near it.
+NEIGHBOURS = 12
+
+# Returns the included legs of route, as (from_index, to_index) pairs.
+def leg_pairs(route):
+    return [(i, j) for i in range(len(route.cities)) for j in routing.bit_indices(route.included_rows[i])]
+
+# Returns, for each city of route, the bitset of the cities near it: itself, its nearest neighbours
+# and the cities it is one of the nearest neighbours of.
+def near_rows(route, neighbours):
+    rows = [1 << i for i in range(len(route.cities))]
+    if len(route.cities) > 1 and neighbours > 0:
+        index = candidates.GridIndex(route.cities)
+        for i, city in enumerate(route.cities):
+            for neighbour in index.nearest(city, neighbours):
+                j = route.index[neighbour]
+                rows[i] |= 1 << j
+                rows[j] |= 1 << i
+    return rows
+
+# Yields the (a, b) index pairs, a < b, of legs whose origins or whose destinations are near each other.
+def near_pairs(legs, near):
+    by_origin, by_destination = {}, {}
+    for index, (u, v) in enumerate(legs):
+        by_origin.setdefault(u, []).append(index)
+        by_destination.setdefault(v, []).append(index)
+    for a, (u1, v1) in enumerate(legs):
+        partners = set()
+        for u in routing.bit_indices(near[u1]):
+            partners.update(by_origin.get(u, []))
+        for v in routing.bit_indices(near[v1]):
+            partners.update(by_destination.get(v, []))
+        for b in sorted(partners):
+            if b > a:
+                yield a, b
+
+# Each kind of move yields (removed, added) pairs of sets of legs to take out of and put into a routing.
+# near is as returned by near_rows.
+
+# Drop a leg, if the tickets using it can be rerouted through the legs that remain.
+def drop_moves(route, legs, near):
+    for leg in legs:
+        yield set([leg]), set()
+
+# Replace two legs u1->v1 and u2->v2 with a shared trunk h1->h2, where h1 is one of the origins and h2 one
+# of the destinations, fed by the other origin and feeding the other destination: u->h1->h2->v.
+# When the legs share an origin or destination, this reroutes one of them through the other.
+def trunk_moves(route, legs, near):
+    for a, b in near_pairs(legs, near):
+        (u1, v1), (u2, v2) = legs[a], legs[b]
+        for h1 in set([u1, u2]):
+            for h2 in set([v1, v2]):
+                if h1 == h2:
+                    continue
+                added = set([(u1, h1), (u2, h1), (h1, h2), (h2, v1), (h2, v2)])
+                yield set([legs[a], legs[b]]), set((i, j) for i, j in added if i != j)
+
+# Replace two legs u1->v1 and u2->v2 with legs through a hub city h: u1->h, u2->h, h->v1 and h->v2.
+# The hub may be any city near one of those four, including one that no ticket mentions.
+def hub_moves(route, legs, near):
+    for a, b in near_pairs(legs, near):
+        (u1, v1), (u2, v2) = legs[a], legs[b]
+        for h in routing.bit_indices(near[u1] | near[u2] | near[v1] | near[v2]):
+            added = set([(u1, h), (u2, h), (h, v1), (h, v2)])
+            yield set([legs[a], legs[b]]), set((i, j) for i, j in added if i != j)
+
+MOVES = [('drop', drop_moves), ('trunk', trunk_moves), ('hub', hub_moves)]
+
+# Returns how much the cost of route would change by taking out removed and putting in added,
+# where rows are the included rows of the legs route has now (route.included_rows, by default).
+def move_delta(route, removed, added, mile_cost, takeoff_cost, rows = None):
+    if rows == None:
+        rows = route.included_rows
+    delta = 0.0
+    for i, j in removed - added:
+        delta -= mile_cost * route.distances[i][j] + takeoff_cost
+    for i, j in added - removed:
+        if not (rows[i] >> j) & 1:
+            delta += mile_cost * route.distances[i][j] + takeoff_cost
+    return delta
+
+# Returns a dict from the index of each ticket origin in route to the bitset of its tickets' destinations.
+def ticket_targets(route, tickets):
+    targets = {}
+    for ticket in tickets:
+        if ticket.from_city is not ticket.to_city:
+            i = route.index[ticket.from_city]
+            targets[i] = targets.get(i, 0) | 1 << route.index[ticket.to_city]
+    return targets
+
+# Returns a copy of the included rows with the legs in removed taken out and those in added put in.
+def moved_rows(rows, removed, added):
+    moved = rows[:]
+    for i, j in removed - added:
+        moved[i] &= ~(1 << j)
+    for i, j in added - removed:
+        moved[i] |= 1 << j
+    return moved
+
+# Returns True if the legs in the included rows fly every ticket in targets (as returned by ticket_targets).
+# Only searches from the ticket origins, so it is much cheaper than rebuilding a routing's reachability.
+def flies_tickets(route, rows, targets):
+    for i, row in targets.items():
+        if row & ~route.search_rows(i, rows):
+            return False
+    return True
+
+# Returns a copy of route with the legs in removed taken out and those in added put in.
+def apply_move(route, removed, added):
+    moved = route.deepleg_copy()
+    for i, j in removed - added:
+        moved.remove(i, j)
+    for i, j in added - removed:
+        moved.add(i, j)
+    return moved
+
+# Returns a routing that satisfies the tickets at no more cost than route (which must satisfy them),
+# improved by moves until none of them lowers the cost any more.
+# Each round tries the moves that save the most first, keeping every one that still saves something and
+# keeps every ticket flown once the moves kept before it are made.
+# If time_limit (in seconds) is given, stops once it has passed and returns the best routing so far.
+# If given, stats counts the moves of each kind that were kept, and times the whole.
+def improve(route, tickets, mile_cost, takeoff_cost, stats = None, time_limit = None):
+    deadline = time.time() + time_limit if time_limit != None else None
+    if stats != None:
+        with stats.timer('local search'):
+            return improved_routing(route, tickets, mile_cost, takeoff_cost, stats, deadline)
+    return improved_routing(route, tickets, mile_cost, takeoff_cost, None, deadline)
+
+def improved_routing(route, tickets, mile_cost, takeoff_cost, stats, deadline):
+    near = near_rows(route, NEIGHBOURS)
+    targets = ticket_targets(route, tickets)
+    best = route
+    while deadline == None or time.time() < deadline:
+        legs = leg_pairs(best)
+        savings = []
+        for name, moves in MOVES:
+            for removed, added in moves(best, legs, near):
+                delta = move_delta(best, removed, added, mile_cost, takeoff_cost)
+                if delta < -1e-9:
+                    savings.append((delta, name, removed, added))
+
+        # Try the most promising moves first; a move is only kept if its legs are still there to
+        # take out, it still saves something, and the tickets can still all be flown.
+        savings.sort(key = lambda saving: saving[0])
+        rows = best.included_rows
+        for delta, name, removed, added in savings:
+            if deadline != None and time.time() >= deadline:
+                break
+            if not all((rows[i] >> j) & 1 for i, j in removed):
+                continue
+            if move_delta(best, removed, added, mile_cost, takeoff_cost, rows) >= -1e-9:
+                continue
+            moved = moved_rows(rows, removed, added)
+            if flies_tickets(best, moved, targets):
+                rows = moved
+                if stats is not None:
+                    stats.count('local search: ' + name)
+
+        if rows is best.included_rows:
+            return best
+        legs = set(leg_pairs(best))
+        kept = set((i, j) for i in range(len(rows)) for j in routing.bit_indices(rows[i]))
+        best = apply_move(best, legs - kept, kept - legs)
+    return best
@@ -0,0 +1,158 @@
+# Parallel branch-and-bound for the flight routing problem.
+# The top of the search tree is split into subproblems, which worker processes take from a
+# shared queue and search depth-first.  The cost of the best routing found anywhere is shared,
+# so every worker prunes against it, and a worker that sees others idle hands over the
+# shallowest (and so probably largest) of its open subtrees as a new subproblem.
+
+import multiprocessing
+import Queue
+
+import bounds
+import routing
+import search
+import stats
+
+# How many nodes a worker expands between checks for idle workers to hand work to.
+DONATION_INTERVAL = 64
+
+# A Search that prunes against the best cost found by any worker, and publishes its own improvements.
+class SharedIncumbentSearch(search.Search):
+    def __init__(self, route, tickets, mile_cost, takeoff_cost, lower_bounds, shared_cost, stats = None, branching = 'longest'):
+        self.shared_cost = shared_cost
+        search.Search.__init__(self, route, tickets, mile_cost, takeoff_cost, None, lower_bounds, 'depth', stats,
+                               branching = branching)
+
+    def incumbent_cost(self):
+        shared = self.shared_cost.value
+        if shared == float('inf'):
+            return self.best_cost
+        if self.best_cost == None or shared < self.best_cost:
+            return shared
+        return self.best_cost
+
+    def set_best(self, best, node = None):
+        search.Search.set_best(self, best, node)
+
+        with self.shared_cost.get_lock():
+            if self.best_cost < self.shared_cost.value:
+                self.shared_cost.value = self.best_cost
+
+# The body of each worker process.  Takes subproblems (lists of decisions from the root) from tasks
+# until every subproblem, including any handed over along the way, has been searched.
+# Puts (cost, rows) on results for each subproblem it improves on, where rows are the included rows of
+# the best routing it found there, then (None, stats) when it stops,
+# where stats is the worker's own stats.Stats if collect_stats is set, and None otherwise.
+# pending counts subproblems not yet finished; idle counts workers waiting for one.
+def work(route, tickets, mile_cost, takeoff_cost, lower_bounds, tasks, results, shared_cost, pending, idle, collect_stats = False,
+         branching = 'longest'):
+    worker_stats = stats.Stats() if collect_stats else None
+    waiting = False
+    while True:
+        try:
+            prefix = tasks.get(timeout = 0.01)
+        except Queue.Empty:
+            if not waiting:
+                waiting = True
+                with idle.get_lock():
+                    idle.value += 1
+            if pending.value == 0:
+                break
+            continue
+
+        if waiting:
+            waiting = False
+            with idle.get_lock():
+                idle.value -= 1
+
+        subproblem = route.deepleg_copy()
+        search.apply_decisions(subproblem, prefix)
+        searcher = SharedIncumbentSearch(subproblem, tickets, mile_cost, takeoff_cost, lower_bounds, shared_cost, worker_stats, branching)
+
+        while searcher.step():
+            if searcher.nodes_expanded % DONATION_INTERVAL == 0 and idle.value > 0 and len(searcher.frontier) > 1:
+                node = searcher.frontier.pop_shallowest()
+                with pending.get_lock():
+                    pending.value += 1
+                tasks.put(prefix + search.node_decisions(node))
+                if worker_stats != None:
+                    worker_stats.count('subtrees donated')
+
+        if searcher.best_node is not None:
+            results.put((searcher.best_cost, searcher.best.included_rows))
+
+        with pending.get_lock():
+            pending.value -= 1
+
+    results.put((None, worker_stats))
+
+# Returns a copy of route with every leg in the given included rows included.
+def with_legs(route, rows):
+    rebuilt = route.deepleg_copy()
+    for i, row in enumerate(rows):
+        for j in routing.bit_indices(row & ~rebuilt.included_rows[i]):
+            rebuilt.add(i, j)
+    return rebuilt
+
+# Solves the flight routing problem on several worker processes, returning the best solution.
+# Takes the same arguments as flightrouting.solve, plus the number of workers (by default,
+# one per CPU) and how many subproblems per worker to split the top of the tree into.
+# If given, stats collects the splitter's and every worker's counts,
+# and on_improvement is called as on_improvement(routing, cost) as better routings come back from the workers.
+# branching names the branching strategy every search uses.
+def solve(route, tickets, mile_cost, takeoff_cost, current_best = None, lower_bounds = None, workers = None, subproblems_per_worker = 4,
+          stats = None, on_improvement = None, branching = 'longest'):
+    if workers == None:
+        workers = multiprocessing.cpu_count()
+    if lower_bounds == None:
+        lower_bounds = bounds.default_bounds(route, tickets, mile_cost, takeoff_cost)
+
+    # Expand the top of the tree breadth-first until there's enough work to go round.
+    splitter = search.Search(route, tickets, mile_cost, takeoff_cost, current_best, lower_bounds, 'breadth', stats, on_improvement,
+                             branching = branching)
+    while not splitter.done() and len(splitter.frontier) < workers * subproblems_per_worker:
+        splitter.step()
+    if splitter.done():
+        return splitter.best
+
+    best = splitter.best
+    best_cost = splitter.best_cost
+
+    tasks   = multiprocessing.Queue()
+    results = multiprocessing.Queue()
+    shared_cost = multiprocessing.Value('d', float('inf') if best_cost == None else best_cost)
+    pending = multiprocessing.Value('i', len(splitter.frontier))
+    idle    = multiprocessing.Value('i', 0)
+
+    for node in splitter.frontier.nodes():
+        tasks.put(search.node_decisions(node))
+
+    processes = [multiprocessing.Process(target = work,
+                                         args = (route, tickets, mile_cost, takeoff_cost, lower_bounds,
+                                                 tasks, results, shared_cost, pending, idle, stats != None, branching))
+                 for i in range(workers)]
+    for process in processes:
+        process.start()
+
+    # Workers' routings are rebuilt here from their legs, so they refer to our own Cities.  Replaying their
+    # decisions instead would miss the legs that propagation included because of the tickets they watch.
+    stopped = 0
+    while stopped < workers:
+        result = results.get()
+        if result[0] == None:
+            stopped += 1
+            worker_stats = result[1]
+            if stats != None:
+                stats.merge(worker_stats)
+            continue
+
+        cost, rows = result
+        if best_cost == None or cost < best_cost:
+            best = with_legs(route, rows)
+            best_cost = cost
+            if on_improvement != None:
+                on_improvement(best, best_cost)
+
+    for process in processes:
+        process.join()
+
+    return best
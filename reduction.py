@@ -0,0 +1,107 @@
+# Pre-solve reduction for the flight routing problem.
+# A city that no ticket mentions is only worth visiting as a hub, and every city costs the search
+# 2n undecided legs.  These rules find unticketed cities that some optimal routing never uses,
+# so they can be left out of the Routing before the search starts.
+#
+# Both rules rest on replacing a hub's legs with others that are no more expensive:
+# - Dominance: if another city c is at least as close as hub h to every remaining city, then moving
+#   every leg of h over to c (and dropping legs between them) can only save miles.
+# - Remoteness: if h is used by k legs (k >= 3; with fewer, flying straight past h is never worse),
+#   they cost at least k * (takeoff_cost + mile_cost * r), r being h's distance to its nearest city.
+#   Routing them instead through one of h's neighbours takes k - 1 legs of at most D miles each,
+#   D being the greatest distance between the other cities.  When that's no more expensive for any
+#   k the remaining cities allow, h is never needed.
+
+import routing
+
+# Records which cities a reduction removed, and why.
+class ReductionReport:
+    def __init__(self):
+        self.cities  = 0   # Cities before the reduction
+        self.removed = []  # (city, reason) for each city removed
+
+    def __str__(self):
+        if len(self.removed) == 0:
+            return "Reduction: kept all %d cities" % self.cities
+        reasons = ", ".join(str(city) + " (" + reason + ")" for city, reason in self.removed)
+        return "Reduction: removed %d of %d cities as unprofitable hubs: %s" % (len(self.removed), self.cities, reasons)
+
+# Returns a city other than hub, among cities, that is at least as close as hub to every other city; or None.
+# Such a city is either hub's nearest neighbour, or as close as it to that neighbour and so within twice
+# its distance of hub; only those are checked against every city.
+def dominating_city(hub, cities):
+    others = [city for city in cities if city is not hub]
+    if len(others) == 0:
+        return None
+    neighbour = min(others, key = lambda city: hub.distance_to(city))
+    reach = 2 * hub.distance_to(neighbour)
+    for candidate in others:
+        if candidate is not neighbour and hub.distance_to(candidate) > reach:
+            continue
+        if all(candidate.distance_to(city) <= hub.distance_to(city)
+               for city in cities if city is not hub and city is not candidate):
+            return candidate
+    return None
+
+# Returns the two cities farthest apart, among at least two cities.
+def farthest_pair(cities):
+    return max(((a, b) for a in cities for b in cities), key = lambda pair: pair[0].distance_to(pair[1]))
+
+# Returns True if routing legs through hub can never beat routing them between the other cities.
+# far_pair, if given, is the farthest_pair of cities (or of a superset of them); if hub isn't one of
+# them, their distance stands in for that between the other cities, which is then never underestimated.
+def too_remote(hub, cities, mile_cost, takeoff_cost, far_pair = None):
+    others = [city for city in cities if city is not hub]
+    most_legs = 2 * len(others)  # Into hub from every other city, and out to every other city
+    if most_legs < 3:
+        return True
+
+    nearest  = min(hub.distance_to(city) for city in others)
+    if far_pair != None and hub not in far_pair:
+        diameter = far_pair[0].distance_to(far_pair[1])
+    else:
+        diameter = max(a.distance_to(b) for a in others for b in others)
+    for legs in range(3, most_legs + 1):
+        if legs * (takeoff_cost + mile_cost * nearest) < (legs - 1) * (takeoff_cost + mile_cost * diameter):
+            return False
+    return True
+
+# Returns the cities, less any unticketed ones that an optimal routing can do without.
+# required_cities are the cities the tickets mention (see flightrouting.ticket_sorted_cities);
+# they are always kept.  If given, report is filled in with what was removed.
+def reduce_cities(cities, required_cities, mile_cost, takeoff_cost, report = None):
+    if report != None:
+        report.cities = len(cities)
+
+    required = set(required_cities)
+    kept = list(cities)
+    changed = True
+    while changed:
+        changed = False
+        # Cities removed during a pass can only bring the others closer together, so the pair farthest
+        # apart at its start can only overstate them, which keeps a hub that might be needed.
+        far_pair = farthest_pair(kept) if len(kept) > 1 else None
+        for hub in sorted((city for city in kept if city not in required), key = lambda city: city.id):
+            reason = None
+            dominator = dominating_city(hub, kept)
+            if dominator != None:
+                reason = "dominated by " + str(dominator)
+            elif too_remote(hub, kept, mile_cost, takeoff_cost, far_pair):
+                reason = "too remote"
+
+            if reason != None:
+                kept.remove(hub)
+                if report != None:
+                    report.removed.append((hub, reason))
+                changed = True
+
+    return kept
+
+# Returns a Routing over all of cities (a superset of route's) flying the same legs as route,
+# to present a solution of the reduced problem in terms of the original one.
+# Only the distances of route's legs are worked out, however many cities there are.
+def restore_cities(route, cities):
+    restored = routing.Routing(cities, sparse = True)
+    for leg in route.legs():
+        restored.add_leg(leg.from_city, leg.to_city)
+    return restored
@@ -0,0 +1,298 @@
+# The linear programming relaxation of the flight routing problem.
+# Each ticket is a commodity: one unit of flow from its origin to its destination, over legs whose
+# inclusion is relaxed from 0 or 1 to anything from 0 up, with no more flow on a leg than its inclusion.
+# The cheapest relaxed routing costs no more than any real one, so its cost is a lower bound; and unlike
+# bounds.EndpointBound, it sees that the tickets need whole paths, which legs they can share.
+#
+# By max-flow/min-cut, a relaxed routing carries every ticket's flow exactly when, for every set S of
+# cities holding some ticket's origin but not its destination, the legs leaving S add up to at least 1.
+# So the same bound comes from the cut LP
+#     minimize    the sum of cost(e) * x(e)
+#     subject to  the sum of x(e) over the legs e leaving S  >=  1,   for every such S
+#                 x >= 0
+# and its dual, which packs cuts under the leg costs:
+#     maximize    the sum of y(S)
+#     subject to  the sum of y(S) over the S that leg e leaves  <=  cost(e),   for every leg e
+#                 y >= 0
+# The dual starts feasible (y = 0) and adding a cut only adds a column, so the simplex never needs
+# a first phase and carries on from where it was.  Any feasible y is a lower bound, so the simplex
+# may also stop early.  There are exponentially many cuts, so they're generated as they're needed:
+# the x that goes with y gives each ticket a maximum flow, and a ticket whose flow falls short of 1
+# has a minimum cut that x doesn't yet pay for.
+#
+# Cuts are kept as sets of cities, which stay valid however legs are later included or excluded,
+# so the cuts found at one node of a search start off the relaxation at the next.
+
+from collections import deque
+from collections import OrderedDict
+
+import routing
+
+# SciPy is optional; without it, the LP is solved by the simplex below.
+try:
+    from scipy.optimize import linprog
+except ImportError:
+    linprog = None
+
+EPSILON = 1e-9
+
+# How many degenerate pivots in a row the simplex makes before switching to Bland's rule.
+DEGENERATE_PIVOTS = 10
+
+# Bounds are shaded down by this fraction, so that rounding in the simplex never takes them past the optimum.
+SHADE = 1e-10
+
+# The dual of the cut LP, as a simplex tableau whose rows are legs, and whose columns are each leg's
+# slack and then the cuts added so far.  The slack columns start as the identity, so they always
+# hold the inverse of the basis, and a new cut's column can be worked out from them.
+class CutPacking:
+    def __init__(self, costs):
+        m = len(costs)
+        self.rows    = [[1.0 if column == row else 0.0 for column in range(m)] for row in range(m)]
+        self.rhs     = list(costs)
+        self.basis   = range(m)    # The column basic in each row
+        self.reduced = [0.0] * m   # The objective row: the slacks' entries are the primal x
+        self.value   = 0.0         # The sum of y so far, a lower bound on the LP
+        self.pivoted = False       # Until the first pivot, the slack columns are still the identity
+
+    # Returns x, the primal solution that goes with the current y: one value per leg.
+    def primal(self):
+        return self.reduced[:len(self.rhs)]
+
+    # Adds a cut covering the given legs (row numbers) as a new column, at y = 0.
+    def add_cut(self, legs):
+        reduced = sum(self.reduced[e] for e in legs) - 1.0
+        if self.pivoted:
+            for row in self.rows:
+                row.append(sum(row[e] for e in legs))
+        else:
+            for row in self.rows:
+                row.append(0.0)
+            for e in legs:
+                self.rows[e][-1] = 1.0
+        self.reduced.append(reduced)
+
+    # Pivots until no column can raise the value any more, or max_pivots have been made.
+    # Returns True if it's optimal.  Enters the column that raises the value fastest, until a run of
+    # degenerate pivots (which raise it not at all) suggests it might cycle; then falls back to
+    # Bland's rule, which can't.
+    def solve(self, max_pivots = 1000):
+        rows = self.rows
+        rhs = self.rhs
+        reduced = self.reduced
+        degenerate = 0
+        for pivot in range(max_pivots):
+            entering = None
+            if degenerate < DEGENERATE_PIVOTS:
+                lowest = -EPSILON
+                for column, entry in enumerate(reduced):
+                    if entry < lowest:
+                        entering = column
+                        lowest = entry
+            else:
+                for column, entry in enumerate(reduced):
+                    if entry < -EPSILON:
+                        entering = column
+                        break
+            if entering == None:
+                return True
+
+            leaving = None
+            best_ratio = None
+            for r, row in enumerate(rows):
+                entry = row[entering]
+                if entry > EPSILON:
+                    ratio = rhs[r] / entry
+                    if best_ratio == None or ratio < best_ratio - EPSILON or \
+                       (ratio < best_ratio + EPSILON and self.basis[r] < self.basis[leaving]):
+                        leaving = r
+                        best_ratio = ratio
+            if leaving == None:
+                return True  # Can't happen: every cut covers some leg, and every leg's cost bounds it
+
+            if best_ratio > EPSILON:
+                degenerate = 0
+            else:
+                degenerate += 1
+
+            scale = 1.0 / rows[leaving][entering]
+            pivot_row = [entry * scale for entry in rows[leaving]]
+            rows[leaving] = pivot_row
+            rhs[leaving] *= scale
+            for r, row in enumerate(rows):
+                factor = row[entering]
+                if r != leaving and factor != 0.0:
+                    rows[r] = [entry - factor * pivot_entry for entry, pivot_entry in zip(row, pivot_row)]
+                    rhs[r] -= factor * rhs[leaving]
+            factor = reduced[entering]
+            reduced[:] = [entry - factor * pivot_entry for entry, pivot_entry in zip(reduced, pivot_row)]
+            self.value -= factor * rhs[leaving]
+            self.basis[leaving] = entering
+            self.pivoted = True
+        return False
+
+# Returns the bitset of cities that a unit of flow from s can't be pushed beyond, if it can't reach t:
+# the source side of a minimum cut between them, under the given capacities (a dict from (i, j) legs).
+# If a whole unit can get through, returns None.
+def short_cut(n, capacities, s, t):
+    residual = dict(capacities)
+    out_legs = [[] for i in range(n)]
+    for i, j in capacities:
+        out_legs[i].append(j)
+        out_legs[j].append(i)
+        residual.setdefault((j, i), 0.0)
+
+    flow = 0.0
+    while flow < 1.0 - EPSILON:
+        parent = {s: None}
+        queue = deque([s])
+        while len(queue) != 0 and t not in parent:
+            i = queue.popleft()
+            for j in out_legs[i]:
+                if j not in parent and residual[(i, j)] > EPSILON:
+                    parent[j] = i
+                    queue.append(j)
+        if t not in parent:
+            side = 0
+            for i in parent:
+                side |= 1 << i
+            return side
+
+        path = []
+        j = t
+        while parent[j] != None:
+            path.append((parent[j], j))
+            j = parent[j]
+        pushed = min(1.0 - flow, min(residual[leg] for leg in path))
+        for i, j in path:
+            residual[(i, j)] -= pushed
+            residual[(j, i)] += pushed
+        flow += pushed
+    return None
+
+# The relaxation of one problem, keeping the cuts it has found from one routing to the next.
+# backend is 'simplex' (the default), or 'scipy' to solve each LP with SciPy instead, where it's installed.
+# Each bound makes at most max_rounds of finding cuts, each solved with at most max_pivots pivots;
+# whatever it has by then is still a bound, if a weaker one.
+class CutRelaxation:
+    def __init__(self, route, tickets, mile_cost, takeoff_cost, backend = 'simplex', max_pivots = 1000, max_rounds = 50,
+                 max_cuts = 1000):
+        if backend == 'scipy' and linprog == None:
+            raise ValueError("the scipy backend needs SciPy, which isn't installed")
+        self.mile_cost    = mile_cost
+        self.takeoff_cost = takeoff_cost
+        self.backend      = backend
+        self.max_pivots   = max_pivots
+        self.max_rounds   = max_rounds
+        self.max_cuts     = max_cuts
+        self.tickets = [(route.index[ticket.from_city], route.index[ticket.to_city])
+                        for ticket in tickets if ticket.from_city is not ticket.to_city]
+        self.cuts = OrderedDict()  # The pool: the bitset of cities on the source side of each cut found, oldest first
+
+    # Returns a lower bound on the cost still to be added to route; float('inf') if route can't be completed.
+    # Once it reaches enough, if that's given, it's returned without solving the LP any further.
+    # x, if given, is a dict to fill in with the relaxed inclusion of each undecided leg in the last LP solved.
+    def bound(self, route, enough = None, x = None):
+        n = len(route.cities)
+        open_tickets = [(s, t) for s, t in self.tickets if not (route.reach_rows[s] >> t) & 1]
+        if len(open_tickets) == 0:
+            return 0.0
+
+        legs = [(i, j) for i in range(n) for j in routing.bit_indices(route.undecided_row(i))]
+        row_of = dict((leg, row) for row, leg in enumerate(legs))
+        costs = [self.mile_cost * route.distances[i][j] + self.takeoff_cost for i, j in legs]
+
+        # A cut only counts if a ticket still has to cross it and no included leg already does
+        def cut_legs(side):
+            if not any((side >> s) & 1 and not (side >> t) & 1 for s, t in open_tickets):
+                return None
+            crossing = []
+            for i in routing.bit_indices(side):
+                if route.included_rows[i] & ~side:
+                    return None
+                crossing.extend(row_of[(i, j)] for j in routing.bit_indices(route.undecided_row(i) & ~side))
+            return crossing
+
+        cuts = []
+        for side in self.cuts:
+            crossing = cut_legs(side)
+            if crossing != None:
+                if len(crossing) == 0:
+                    return float('inf')  # Nothing left can take a ticket out of side
+                cuts.append(crossing)
+        if self.backend == 'simplex':
+            packing = CutPacking(costs)
+            for crossing in cuts:
+                packing.add_cut(crossing)
+
+        value, solution = 0.0, [0.0] * len(legs)
+        for round in range(self.max_rounds):
+            if self.backend == 'scipy':
+                solved = self.scipy_solve(costs, cuts)
+                if solved == None:
+                    break  # Keep the bound from the last LP SciPy did solve
+                value, solution = solved
+                if value == float('inf'):
+                    return value
+            else:
+                optimal = packing.solve(self.max_pivots)
+                value, solution = packing.value, packing.primal()
+                if not optimal:
+                    break
+            if enough != None and value >= enough:
+                break
+
+            capacities = dict((leg, solution[row]) for row, leg in enumerate(legs) if solution[row] > EPSILON)
+            for i in range(n):
+                for j in routing.bit_indices(route.included_rows[i]):
+                    capacities[(i, j)] = 1.0
+
+            added = False
+            for s, t in open_tickets:
+                side = short_cut(n, capacities, s, t)
+                if side == None:
+                    continue
+                crossing = cut_legs(side)
+                if len(crossing) == 0:
+                    return float('inf')
+                if self.backend == 'simplex':
+                    packing.add_cut(crossing)
+                cuts.append(crossing)
+                self.add_to_pool(side)
+                added = True
+                # Pay for it, so that the other tickets' cuts are found against the updated x
+                for row in crossing:
+                    capacities[legs[row]] = capacities.get(legs[row], 0.0) + 1.0
+            if not added:
+                break
+
+        if x != None:
+            x.clear()
+            x.update((legs[row], solution[row]) for row in range(len(legs)) if solution[row] > EPSILON)
+        return max(0.0, value * (1.0 - SHADE))
+
+    # Keeps a cut for later routings, forgetting the oldest once there are max_cuts.
+    def add_to_pool(self, side):
+        if side in self.cuts:
+            return
+        self.cuts[side] = True
+        if len(self.cuts) > self.max_cuts:
+            self.cuts.popitem(last = False)
+
+    # Solves the cut LP over the given cuts with SciPy; returns its value and x, float('inf') and None if
+    # the LP is infeasible, or None if SciPy couldn't solve it.
+    # The simplex method is used because it's in every SciPy that runs on Python 2, and gives a vertex,
+    # whose value SHADE covers as it does the simplex above.
+    def scipy_solve(self, costs, cuts):
+        if len(cuts) == 0:
+            return 0.0, [0.0] * len(costs)
+        matrix = [[0.0] * len(costs) for cut in cuts]
+        for row, cut in zip(matrix, cuts):
+            for e in cut:
+                row[e] = -1.0
+        result = linprog(costs, A_ub = matrix, b_ub = [-1.0] * len(cuts), bounds = (0, None), method = 'simplex')
+        if result.status == 2:
+            return float('inf'), None
+        if not result.success:
+            return None
+        return result.fun, list(result.x)
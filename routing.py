@@ -7,6 +7,14 @@ from collections import deque
 from collections import defaultdict
 import copy
 import heapq
+import random
+from array import array
+
+# NumPy is optional; without it, distances are worked out one pair at a time.
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 # The vertices in our graph are Cities, consisting of an id, x coordinate, and y coordinate.
 class City:
@@ -30,9 +38,55 @@ class City:
         y_diff = self.y - to_city.y
         return math.sqrt(x_diff ** 2 + y_diff ** 2)
         
+# The distances between every pair of a list of Cities, worked out once and then shared
+# (read-only) by every Routing and Leg built on those Cities.
+# distances[i][j] is the distance from cities[i] to cities[j].
+# With float32, each row is stored in single precision to halve the memory used.
+class DistanceMatrix:
+    def __init__(self, cities, float32 = False):
+        self.cities = cities
+        
+        if numpy != None and len(cities) > 0:
+            xs = numpy.array([city.x for city in cities], dtype = numpy.float64)
+            ys = numpy.array([city.y for city in cities], dtype = numpy.float64)
+            matrix = numpy.sqrt((xs[:, None] - xs[None, :]) ** 2 + (ys[:, None] - ys[None, :]) ** 2)
+            if float32:
+                self.rows = [array('f', row.astype(numpy.float32).tobytes()) for row in matrix]
+            else:
+                self.rows = matrix.tolist()
+        else:
+            typecode = 'f' if float32 else 'd'
+            self.rows = [array(typecode, [from_city.distance_to(to_city) for to_city in cities]) for from_city in cities]
+            
+    def __getitem__(self, i):
+        return self.rows[i]
+        
+# The same distances, worked out on demand and kept only for the pairs asked about.
+# For large sets of cities of which only a few legs are ever considered (see candidates.py),
+# this is much smaller than a DistanceMatrix, which is n**2 whatever the legs.
+class SparseDistances:
+    def __init__(self, cities):
+        self.cities = cities
+        self.rows = [SparseDistanceRow(cities, from_city) for from_city in cities]
+        
+    def __getitem__(self, i):
+        return self.rows[i]
+        
+class SparseDistanceRow(dict):
+    def __init__(self, cities, from_city):
+        dict.__init__(self)
+        self.cities    = cities
+        self.from_city = from_city
+        
+    def __missing__(self, j):
+        distance = self.from_city.distance_to(self.cities[j])
+        self[j] = distance
+        return distance
+        
 # The (directed) edges of our graph are Legs, consisting of a from_city and a to_city
+# miles may be given (e.g. from a DistanceMatrix) to save working it out again.
 class Leg:
-    def __init__(self, from_city, to_city, exists = True):
+    def __init__(self, from_city, to_city, exists = True, miles = None):
         self.from_city = from_city
         self.to_city   = to_city
         self.exists    = exists
@@ -43,7 +97,9 @@ class Leg:
         self.implicitly_included = False
         self.explicitly_excluded = False
                 
-        self.miles = from_city.distance_to(to_city)
+        if miles == None:
+            miles = from_city.distance_to(to_city)
+        self.miles = miles
         
     def __repr__(self):
         return "".join(["<Leg:", str(self.from_city), "->", str(self.to_city), ">"])
@@ -52,54 +108,176 @@ class Leg:
         return " -> ".join([str(self.from_city), str(self.to_city)])
         
 # A Ticket consists of an origin City, a destination City, and a list of Legs to fly.
+# Tickets with the same origin and destination are equal; multiplicity counts
+# how many passengers hold such a ticket (see flightrouting.dedup_tickets).
 class Ticket:
     def __init__(self, from_city, to_city, set_required = True):
         self.from_city = from_city
         self.to_city   = to_city
+        self.multiplicity = 1
         
         if set_required:
             self.from_city.required_origin = True
             self.to_city.required_destination = True
         
+    def __eq__(self, other):
+        return isinstance(other, Ticket) and self.from_city is other.from_city and self.to_city is other.to_city
+        
+    def __ne__(self, other):
+        return not self.__eq__(other)
+        
+    def __hash__(self):
+        return hash((self.from_city, self.to_city))
+        
     def __repr__(self):
         return "".join(["<Ticket:", str(self.from_city), "->", str(self.to_city), ">"])
         
     def __str__(self):
         return " -> ".join([str(self.from_city), str(self.to_city)])
     
-    # Returns a list of legs which connect from_city to to_city.
+    # Returns a list of legs which connect from_city to to_city: included legs, if they do,
+    # and otherwise legs that aren't excluded.
     def itinerary(self, routing):
-        route, discoveries = routing.possible_route(self.from_city, self.to_city)
+        route = routing.included_route(self.from_city, self.to_city)
+        if route == None:
+            route, discoveries = routing.possible_route(self.from_city, self.to_city)
         return route
 
+# Returns the number of bits set in the given integer.
+def bit_count(bits):
+    return bin(bits).count('1')
+
+# Yields the indices of the bits set in the given integer, lowest first.
+def bit_indices(bits):
+    while bits:
+        low_bit = bits & -bits
+        yield low_bit.bit_length() - 1
+        bits ^= low_bit
+
+# A read-only view which makes a Routing look like the old Leg matrix:
+# routing.matrix[from_city][to_city] builds the corresponding Leg on demand.
+class LegMatrix:
+    def __init__(self, routing):
+        self.routing = routing
+
+    def __getitem__(self, from_city):
+        return LegRow(self.routing, from_city)
+
+    def __iter__(self):
+        return iter(self.routing.cities)
+
+class LegRow:
+    def __init__(self, routing, from_city):
+        self.routing   = routing
+        self.from_city = from_city
+
+    def __getitem__(self, to_city):
+        return self.routing.leg(self.from_city, to_city)
+
+    def __iter__(self):
+        return iter(self.routing.cities)
+
+# Zobrist keys for hashing the leg states of Routings with n cities: ZOBRIST_KEYS[n][kind][i][j] is
+# the random key XORed into a Routing's state_hash while leg i->j is in the given kind of row
+# (INCLUDED, EXCLUDED, IMPLICIT or EXPLICIT).  Made on first use, from a fixed seed, and shared.
+INCLUDED, EXCLUDED, IMPLICIT, EXPLICIT = range(4)
+ZOBRIST_KEYS = {}
+
+def zobrist_keys(n):
+    if n not in ZOBRIST_KEYS:
+        rng = random.Random(n)
+        ZOBRIST_KEYS[n] = [[[rng.getrandbits(64) for j in range(n)] for i in range(n)] for kind in range(4)]
+    return ZOBRIST_KEYS[n]
+
 # The graph itself is a routing, a set of legs to be flown.
-# Since it is a weighted graph, it is most convenient to represent it as a Leg matrix.
+# Cities are numbered by their position in id order, and the state of the legs
+# leaving each city is held in integer bitsets, one per row of the old Leg matrix:
+# bit j of included_rows[i] is set when leg i->j is included, and so on.
+# A leg is undecided when it is neither included nor excluded.
+# Leg objects are only built on demand (see leg()).
+# The distances between cities come from a DistanceMatrix, which Routings derived from one another share.
+# Nothing else about a Routing is n**2 in size, so with sparse distances (see SparseDistances) its memory
+# and the time spent on it grow with the legs actually considered, not with every pair of cities.
 # Initially, the graph is unconnected: the legs don't exist    
 class Routing:
     # Initialize the empty routing
-    def __init__(self, city_list):
-        self.init_from_list(city_list)
+    # distances, if given, must be a DistanceMatrix (or SparseDistances) for the same cities (in id order).
+    # Otherwise one is made: SparseDistances if sparse is set.
+    def __init__(self, city_list, distances = None, sparse = False):
+        self.init_from_list(city_list, distances, sparse)
                 
-    def init_from_list(self, city_list):
+    def init_from_list(self, city_list, distances = None, sparse = False):
         self.cities = sorted(city_list, key = lambda city: city.id)
+        
+        if distances == None and sparse:
+            distances = SparseDistances(self.cities)
+        elif distances == None:
+            distances = DistanceMatrix(self.cities)
+        elif distances.cities != self.cities:
+            raise ValueError("distances were worked out for a different list of cities")
+        self.distances = distances
+        self.index  = dict((city, i) for i, city in enumerate(self.cities))
+        self.full_row = (1 << len(self.cities)) - 1
 
-        self.matrix = defaultdict(dict)
-        for from_city in self.cities:
-            for to_city in self.cities:
-                self.matrix[from_city][to_city] = Leg(from_city, to_city, exists = False)
+        self.included_rows = [0] * len(self.cities)
+        self.excluded_rows = [0] * len(self.cities)
+        self.implicit_rows = [0] * len(self.cities)
+        self.explicit_rows = [0] * len(self.cities)
+        
+        # The included legs again, by destination: bit i of included_cols[j] is set when leg i->j is included.
+        self.included_cols = [0] * len(self.cities)
+        
+        # Running totals over the included legs, kept up to date by add() and remove().
+        self.total_miles    = 0.0
+        self.total_takeoffs = 0
+        
+        # The transitive closure of the included legs, kept up to date by add() and remove():
+        # bit j of reach_rows[i] (and bit i of reached_rows[j]) is set when j is reachable from i.
+        # Every city reaches itself.
+        self.reach_rows   = [1 << i for i in range(len(self.cities))]
+        self.reached_rows = [1 << i for i in range(len(self.cities))]
+        
+        # The tickets being watched (see watch_tickets()): bit j of ticket_rows[i] is set for a ticket i->j.
+        # ticket_cols holds them again by destination.
+        # Also, how many of them can't be flown yet, and how many are explicitly excluded.
+        self.ticket_rows = [0] * len(self.cities)
+        self.ticket_cols = [0] * len(self.cities)
+        self.unsatisfied_tickets = 0
+        self.blocked_tickets     = 0
+        
+        # Set once propagation finds that no routing with these leg states can fly every ticket.
+        self.infeasible = False
+        
+        # For force_ticket_legs(): whether any leg has been excluded since it last looked, other than
+        # as implicitly included (which never cuts a path a ticket could take).
+        self.paths_cut = True
+        
+        # While searching in place, every change is recorded here so it can be undone.
+        self.trail = None
+        
+        # If set, a stats.Stats that counts the legs each optimization fixes.  Copies share it.
+        self.stats = None
+        
+        # A Zobrist hash of the leg states, once track_state_hash() has been called; None until then.
+        self.state_hash = None
+        
+        self.matrix = LegMatrix(self)
                 
-         
-    # Creates a copy with independent Legs but not independent Cities.            
+    # Creates a copy with independent leg states but not independent Cities.            
+    # The copy does not share (or record to) this Routing's trail.
     def deepleg_copy(self):
-        cities = self.sorted_cities()
-        new_routing = Routing(cities)
-        new_routing.undecided = []  # We don't want all legs undecided in the copy
-        
-        # Copy information from this routing into the new routing
-        for from_city in cities:
-            for to_city in cities:
-                leg = self.matrix[from_city][to_city]
-                new_routing.matrix[from_city][to_city] = copy.copy(leg)
+        new_routing = copy.copy(self)
+        new_routing.trail = None
+        
+        new_routing.included_rows = self.included_rows[:]
+        new_routing.excluded_rows = self.excluded_rows[:]
+        new_routing.implicit_rows = self.implicit_rows[:]
+        new_routing.explicit_rows = self.explicit_rows[:]
+        new_routing.included_cols = self.included_cols[:]
+        new_routing.reach_rows    = self.reach_rows[:]
+        new_routing.reached_rows  = self.reached_rows[:]
+        
+        new_routing.matrix = LegMatrix(new_routing)
                                         
         return new_routing
                 
@@ -114,9 +292,9 @@ class Routing:
         
         row_strs = [label_row]
 
-        for from_city in alpha_cities:
-            adj_dict = self.matrix[from_city]
-            adj_exists = [int(adj_dict[to_city].exists) for to_city in alpha_cities]
+        for i, from_city in enumerate(alpha_cities):
+            row = self.included_rows[i]
+            adj_exists = [(row >> j) & 1 for j in range(len(alpha_cities))]
             exists_str = " ".join([str(from_city)] + [str(exists) for exists in adj_exists])
             row_strs.append(exists_str)
                     
@@ -127,211 +305,648 @@ class Routing:
     def sorted_cities(self):
         return self.cities
         
+    # Builds a Leg object describing the current state of the leg from i to j.
+    def make_leg(self, i, j):
+        bit = 1 << j
+        leg = Leg(self.cities[i], self.cities[j], exists = bool(self.included_rows[i] & bit), miles = self.distances[i][j])
+        
+        leg.included  = leg.exists
+        leg.excluded  = bool(self.excluded_rows[i] & bit)
+        leg.undecided = not (leg.included or leg.excluded)
+        leg.implicitly_included = bool(self.implicit_rows[i] & bit)
+        leg.explicitly_excluded = bool(self.explicit_rows[i] & bit)
+        
+        return leg
+        
+    # Returns a Leg object describing the current state of the leg from from_city to to_city.
+    # The Leg is a snapshot: changing it does not change the Routing.
+    def leg(self, from_city, to_city):
+        return self.make_leg(self.index[from_city], self.index[to_city])
+        
+    # Returns the length of the leg from from_city to to_city.
+    def miles_between(self, from_city, to_city):
+        return self.distances[self.index[from_city]][self.index[to_city]]
+        
+    # Returns True if the leg from i to j is neither included nor excluded.
+    def is_undecided(self, i, j):
+        return not ((self.included_rows[i] | self.excluded_rows[i]) >> j) & 1
+        
+    # Returns True if j is known to be reachable from i: the leg i->j is included or implicitly included.
+    def reaches(self, i, j):
+        return bool(((self.included_rows[i] | self.implicit_rows[i]) >> j) & 1)
+        
+    # Returns the bitset of undecided legs leaving i.
+    def undecided_row(self, i):
+        return self.full_row & ~(self.included_rows[i] | self.excluded_rows[i])
+        
+    # Starts recording changes so that they can be undone.
+    def start_trail(self):
+        self.trail = []
+        
+    # Returns a position in the trail which undo() can later return to.
+    def trail_mark(self):
+        return len(self.trail)
+        
+    # Undoes every change recorded since the given trail mark.
+    # Each trail entry is a container (a row list, or this Routing's __dict__), a key, and the old value.
+    def undo(self, mark):
+        trail = self.trail
+        while len(trail) > mark:
+            container, key, old_value = trail.pop()
+            container[key] = old_value
+        
+    # Sets rows[i] to new_row, recording the old value if a trail is being kept.
+    def set_row(self, rows, i, new_row):
+        if self.trail is not None:
+            self.trail.append((rows, i, rows[i]))
+        rows[i] = new_row
+        
+    # Sets rows[i], one of the leg state rows of the given kind, to new_row, updating state_hash if it's tracked.
+    def set_state_row(self, rows, kind, i, new_row):
+        if self.state_hash is not None:
+            keys = zobrist_keys(len(self.cities))[kind][i]
+            new_hash = self.state_hash
+            for j in bit_indices(rows[i] ^ new_row):
+                new_hash ^= keys[j]
+            self.set_attribute('state_hash', new_hash)
+        self.set_row(rows, i, new_row)
+        
+    # Starts keeping state_hash, a hash of which legs are included, excluded, implicit and explicit,
+    # up to date.  Routings in the same leg states (however they got there) have the same hash.
+    def track_state_hash(self):
+        keys = zobrist_keys(len(self.cities))
+        state_hash = 0
+        for kind, rows in enumerate([self.included_rows, self.excluded_rows, self.implicit_rows, self.explicit_rows]):
+            for i, row in enumerate(rows):
+                for j in bit_indices(row):
+                    state_hash ^= keys[kind][i][j]
+        self.state_hash = state_hash
+        
+    # Sets the named attribute, recording the old value if a trail is being kept.
+    def set_attribute(self, name, value):
+        if self.trail is not None:
+            self.trail.append((self.__dict__, name, self.__dict__[name]))
+        self.__dict__[name] = value
+        
+    # Adds miles and takeoffs to the running totals, recording the old totals if a trail is being kept.
+    def add_to_totals(self, miles, takeoffs):
+        self.set_attribute('total_takeoffs', self.total_takeoffs + takeoffs)
+        if self.total_takeoffs == 0:
+            self.set_attribute('total_miles', 0.0)  # Don't let rounding errors pile up in an empty routing
+        else:
+            self.set_attribute('total_miles', self.total_miles + miles)
+            
+    # Updates the reachability index for a newly included leg i->j:
+    # everything that reaches i now reaches everything j reaches.
+    # Returns two bitsets: the cities that gained new descendants, and the cities that gained new ancestors.
+    def connect(self, i, j):
+        ancestors   = self.reached_rows[i]
+        descendants = self.reach_rows[j]
+        
+        gained_descendants = 0
+        newly_satisfied = 0
+        for a in bit_indices(ancestors):
+            new_bits = descendants & ~self.reach_rows[a]
+            if new_bits:
+                gained_descendants |= 1 << a
+                newly_satisfied += bit_count(self.ticket_rows[a] & new_bits)
+                self.set_row(self.reach_rows, a, self.reach_rows[a] | new_bits)
+                
+        gained_ancestors = 0
+        for b in bit_indices(descendants):
+            new_bits = ancestors & ~self.reached_rows[b]
+            if new_bits:
+                gained_ancestors |= 1 << b
+                self.set_row(self.reached_rows, b, self.reached_rows[b] | new_bits)
+                
+        if newly_satisfied:
+            self.set_attribute('unsatisfied_tickets', self.unsatisfied_tickets - newly_satisfied)
+            
+        return gained_descendants, gained_ancestors
+            
+    # Rebuilds the reachability index from scratch, which is needed when an included leg is removed.
+    def rebuild_reachability(self):
+        n = len(self.cities)
+        reach_rows   = [self.reachable_row(i) for i in range(n)]
+        reached_rows = [self.reaching_row(j) for j in range(n)]
+                
+        for i in range(n):
+            if reach_rows[i] != self.reach_rows[i]:
+                self.set_row(self.reach_rows, i, reach_rows[i])
+            if reached_rows[i] != self.reached_rows[i]:
+                self.set_row(self.reached_rows, i, reached_rows[i])
+        
+        unsatisfied = sum(bit_count(self.ticket_rows[i] & ~self.reach_rows[i]) for i in range(n))
+        if unsatisfied != self.unsatisfied_tickets:
+            self.set_attribute('unsatisfied_tickets', unsatisfied)
+            
+    # Starts keeping count of how many of the given tickets can't be flown yet
+    # (unsatisfied_tickets) and how many are explicitly excluded (blocked_tickets).
+    def watch_tickets(self, tickets):
+        self.ticket_rows = [0] * len(self.cities)
+        self.ticket_cols = [0] * len(self.cities)
+        for ticket in tickets:
+            i = self.index[ticket.from_city]
+            j = self.index[ticket.to_city]
+            self.ticket_rows[i] |= 1 << j
+            self.ticket_cols[j] |= 1 << i
+        self.paths_cut = True
+            
+        rows = range(len(self.cities))
+        self.unsatisfied_tickets = sum(bit_count(self.ticket_rows[i] & ~self.reach_rows[i]) for i in rows)
+        self.blocked_tickets     = sum(bit_count(self.ticket_rows[i] & self.explicit_rows[i]) for i in rows)
+        
+    # Removes the leg i->j from the graph, also excluding it
+    def remove(self, i, j):
+        bit = 1 << j
+        if self.included_rows[i] & bit:
+            self.set_state_row(self.included_rows, INCLUDED, i, self.included_rows[i] & ~bit)
+            self.set_row(self.included_cols, j, self.included_cols[j] & ~(1 << i))
+            self.add_to_totals(-self.distances[i][j], -1)
+            self.rebuild_reachability()
+        if not self.excluded_rows[i] & bit:
+            self.set_state_row(self.excluded_rows, EXCLUDED, i, self.excluded_rows[i] | bit)
+        
+    # Adds the leg i->j to the graph
+    # Returns the bitsets of cities that gained new descendants and new ancestors (see connect()).
+    def add(self, i, j):
+        bit = 1 << j
+        if self.excluded_rows[i] & bit:
+            self.set_state_row(self.excluded_rows, EXCLUDED, i, self.excluded_rows[i] & ~bit)
+            self.set_attribute('paths_cut', True)  # Paths opening up can change which legs they all use, too
+        if not self.included_rows[i] & bit:
+            self.set_state_row(self.included_rows, INCLUDED, i, self.included_rows[i] | bit)
+            self.set_row(self.included_cols, j, self.included_cols[j] | (1 << i))
+            self.add_to_totals(self.distances[i][j], 1)
+            if not self.reach_rows[i] & bit:
+                return self.connect(i, j)
+                
+        return 0, 0
+        
     # Removes a leg from the graph, also excluding it
     def remove_leg(self, from_city, to_city):
-        leg = self.matrix[from_city][to_city]
-        
-        leg.exists = False
-        if leg.undecided:
-            leg.undecided = False
-        leg.included = False
-        leg.excluded = True
+        self.remove(self.index[from_city], self.index[to_city])
                 
     # Adds a leg to the graph
+    # Returns the lists of cities that gained new descendants and new ancestors as a result.
     def add_leg(self, from_city, to_city):
-        leg = self.matrix[from_city][to_city]
+        gained_descendants, gained_ancestors = self.add(self.index[from_city], self.index[to_city])
+        return [self.cities[i] for i in bit_indices(gained_descendants)], [self.cities[i] for i in bit_indices(gained_ancestors)]
+                
+    # REMOVES the leg i->j from the graph, excluding it, but marks it as implicitly included
+    def add_implicit(self, i, j):
+        self.remove(i, j)
+        if not (self.implicit_rows[i] >> j) & 1:
+            self.set_state_row(self.implicit_rows, IMPLICIT, i, self.implicit_rows[i] | (1 << j))
         
-        leg.exists = True
-        if leg.undecided:
-            leg.undecided = False
-        leg.excluded = False
-        leg.included = True
+    # Removes the leg i->j from the graph, excluding it AND marking it explicitly excluded
+    def remove_explicit(self, i, j):
+        self.remove(i, j)
+        if not (self.explicit_rows[i] >> j) & 1:
+            self.set_state_row(self.explicit_rows, EXPLICIT, i, self.explicit_rows[i] | (1 << j))
+            if (self.ticket_rows[i] >> j) & 1:
+                self.set_attribute('blocked_tickets', self.blocked_tickets + 1)
                 
     # REMOVES a leg from the graph, excluding it, but marks it as implicitly included
     # i.e. to_city is reachable from from_city, just not directly.
     def add_implicit_leg(self, from_city, to_city):
-        self.remove_leg(from_city, to_city)
-        self.matrix[from_city][to_city].implicitly_included = True
+        self.add_implicit(self.index[from_city], self.index[to_city])
         
     # Removes a leg from the graph, excluding it AND marking it explicitly excluded
     # i.e. no indirect path is possible either
     def remove_explicit_leg(self, from_city, to_city):
-        self.remove_leg(from_city, to_city)
-        self.matrix[from_city][to_city].explicitly_excluded = True        
+        self.remove_explicit(self.index[from_city], self.index[to_city])
     
     # Returns a new Routing in which all the a->a edges are excluded from the graph 
     # and any consequences are realized    
     def exclude_selfloops(self):
         new_routing = self.deepleg_copy()
         
-        for city in new_routing.sorted_cities():
-            new_routing.add_implicit_leg(city, city)
+        for i in range(len(new_routing.cities)):
+            new_routing.add_implicit(i, i)
             
         return new_routing
         
     # Returns a new Routing, in which the given leg is excluded from the graph
     # and any consequences are also realized
-    def exclude_leg(self, from_city, to_city):
+    # If given, stats is set on the new Routing to count the optimizations applied.
+    def exclude_leg(self, from_city, to_city, stats = None):
         excluded_routing = self.deepleg_copy()
+        if stats != None:
+            excluded_routing.stats = stats
+        excluded_routing.exclude(self.index[from_city], self.index[to_city])
+        
+        return excluded_routing
+        
+    # Excludes the leg f->t from this Routing, in place, and realizes any consequences
+    def exclude(self, f, t):
+        queue = deque()
+        self.exclude_and_enqueue(f, t, queue)
+        self.propagate(queue)
+   
+    # Returns a new Routing, in which the given leg is included in the graph
+    # and any consequences are also realized
+    # If given, stats is set on the new Routing to count the optimizations applied.
+    def include_leg(self, from_city, to_city, stats = None):
+        included_routing = self.deepleg_copy()
+        if stats != None:
+            included_routing.stats = stats
+        included_routing.include(self.index[from_city], self.index[to_city])
+        
+        return included_routing
+        
+    # Includes the leg f->t in this Routing, in place, and realizes any consequences
+    def include(self, f, t):
+        queue = deque()
+        self.include_and_enqueue(f, t, queue)
+        self.propagate(queue)
+        
+    # The consequences of including or excluding a leg are realized by propagate(), which keeps applying
+    # the optimizations to each leg whose state changed -- including the legs the optimizations themselves
+    # include or exclude -- until nothing changes, or the Routing turns out to be infeasible.
+    # Every optimization only rules out routings that aren't minimal (that fly a leg they could do
+    # without) or that can't fly every ticket, so a minimal optimal routing always survives.
     
-        excluded_routing.remove_leg(from_city, to_city)
+    # Includes the leg f->t and queues it for propagation, with what reached and was reached before it.
+    def include_and_enqueue(self, f, t, queue):
+        if (self.included_rows[f] >> t) & 1:
+            return
+        reached_from_f = self.reach_rows[f]
+        reaching_t     = self.reached_rows[t]
+        self.add(f, t)
+        queue.append((True, f, t, reached_from_f, reaching_t))
+        
+    # Excludes the leg f->t (marking it implicitly included, if implicit) and queues it for propagation.
+    def exclude_and_enqueue(self, f, t, queue, implicit = False):
+        newly_excluded = not (self.excluded_rows[f] >> t) & 1
+        if implicit:
+            self.add_implicit(f, t)
+        else:
+            self.remove(f, t)
+        if newly_excluded:
+            if not implicit and not self.paths_cut:
+                self.set_attribute('paths_cut', True)
+            queue.append((False, f, t, None, None))
+            
+    # Excludes the undecided legs from f to the cities in row, counting them under rule, and queues them.
+    def exclude_row(self, f, row, queue, rule, implicit = False):
+        row &= self.full_row & ~(self.included_rows[f] | self.excluded_rows[f] | (1 << f))
+        if not row:
+            return
+        for t in bit_indices(row):
+            self.exclude_and_enqueue(f, t, queue, implicit)
+        if self.stats is not None:
+            self.stats.count(rule, bit_count(row))
+            
+    # Returns the bitset of cities i other than j for which the leg i->j is not excluded.
+    def open_col(self, j):
+        bit = 1 << j
+        col = 0
+        for i, row in enumerate(self.excluded_rows):
+            if not row & bit:
+                col |= 1 << i
+        return col & ~bit
+        
+    # Marks this Routing as unable to fly every ticket, whatever is decided about its remaining legs.
+    def set_infeasible(self):
+        self.set_attribute('infeasible', True)
+        if self.stats is not None:
+            self.stats.count('infeasible')
+        
+    # Applies the optimizations to the legs in queue, and to those they include or exclude in turn.
+    def propagate(self, queue):
+        while queue and not self.infeasible:
+            included, i, j, reached_from_i, reaching_j = queue.popleft()
+            if included:
+                self.propagate_inclusion(i, j, reached_from_i, reaching_j, queue)
+            else:
+                self.propagate_exclusion(i, j, queue)
+            
+    # Realizes the consequences of including the leg f->t, given what f reached and what reached t before.
+    def propagate_inclusion(self, f, t, reached_from_f, reaching_t, queue):
+        if f == t:
+            return
+        
+        # Optimization 1a: exclude redundant paths to to_city and beyond
+        # If A reaches from_city, we can exclude A->B for every B that to_city reaches (to_city included),
+        # since A->...->from_city->to_city->...->B is now a path.
+        # And we mark it implicitly included.
+        # Optimization 1b: exclude redundant paths from from_city
+        # The same, for A being from_city itself.
+        descendants = self.reach_rows[t]
+        for A in bit_indices(self.reached_rows[f]):
+            self.exclude_row(A, descendants, queue, 'rule 1b' if A == f else 'rule 1a', implicit = True)
+        
+        # Optimization 2a: exclude legs that would make an included one redundant
+        # If f already reached C without this leg, we can exclude C->t,
+        # since f->...->C->t would make f->t redundant.
+        # If f->C is itself included, we can exclude t->C,
+        # since f->t->C would make f->C redundant.
+        # They are NOT implicitly included, however.
+        # Nor can we rule out indirect paths C->...->t: they may pass through f->t.
+        others = self.full_row & ~(1 << f) & ~(1 << t)
+        for C in bit_indices(reached_from_f & others):
+            self.exclude_row(C, 1 << t, queue, 'rule 2a')
+        self.exclude_row(t, self.included_rows[f] & others, queue, 'rule 2a')
+        
+        # Optimization 2b: exclude legs that would make an included one redundant
+        # If D already reached t without this leg, we can exclude f->D,
+        # since f->D->...->t would make f->t redundant.
+        # If D->t is itself included, we can exclude D->f,
+        # since D->f->t would make D->t redundant.
+        self.exclude_row(f, reaching_t & others, queue, 'rule 2b')
+        for D in bit_indices(self.included_cols[t] & others):
+            self.exclude_row(D, 1 << f, queue, 'rule 2b')
+            
+        # Optimization 3 for the new leg, if nothing can fly into f.
+        if (self.ticket_rows[t] | self.ticket_cols[t]) and not self.open_col(f):
+            self.exclude_ticket_pairs(f, t, queue)
+            
+    # Optimization 3: exclude legs that would make an included one redundant, given the tickets
+    # If A->X is included, then for a ticket X->Y we can exclude A->Y, and for a ticket Y->X we can exclude A->Y,
+    # since the ticket's own path would make one of the two legs out of A redundant.
+    # The exception is a ticket path that goes through A, so this only applies when every leg into A is excluded.
+    def exclude_ticket_pairs(self, A, X, queue):
+        ticket_cities = self.ticket_rows[X] | self.ticket_cols[X]
+        self.exclude_row(A, ticket_cities & ~(1 << X), queue, 'rule 3')
+        
+    # Realizes the consequences of excluding the leg f->t.
+    def propagate_exclusion(self, f, t, queue):
+        from_city = self.cities[f]
+        to_city   = self.cities[t]
         
         # Optimization 4a: include necessary path to to_city
         # If to_city is a necessary destination, and only one leg
         # A->to_city is not excluded, we must include A->to_city.
+        # If there are none, and a ticket needs one, this Routing can't work.
+        open_froms = None
+        if to_city.required_destination or self.ticket_cols[t]:
+            open_froms = self.open_col(t)
         if to_city.required_destination:
-            legs_to_city = [excluded_routing.matrix[A][to_city] for A in excluded_routing.sorted_cities()]
-            undecided_legs_to_city = [leg for leg in legs_to_city if leg.undecided]
-            excluded_legs_to_city  = [leg for leg in legs_to_city if leg.excluded]
-            if len(undecided_legs_to_city) == 1 and len(excluded_legs_to_city) == len(legs_to_city) - 1:
-#                print to_city, "was a necessary destination, adding", undecided_legs_to_city[0].from_city
-                excluded_routing.add_leg(undecided_legs_to_city[0].from_city, to_city)
+            if open_froms & (open_froms - 1) == 0 and open_froms & ~self.included_cols[t]:
+                self.include_and_enqueue(open_froms.bit_length() - 1, t, queue)
+                if self.stats is not None:
+                    self.stats.count('rule 4a')
+        if self.ticket_cols[t] & ~(1 << t) and not open_froms:
+            self.set_infeasible()
+            return
             
         # Optimization 4b: include necessary path from from_city
         # If from_city is a necessary origin, and only one leg
         # from_city->B remains, we must include from_city->B.
+        # If there are none, and a ticket needs one, this Routing can't work.
+        open_tos = self.full_row & ~self.excluded_rows[f] & ~(1 << f)
         if from_city.required_origin:
-            legs_from_city = [excluded_routing.matrix[from_city][B] for B in excluded_routing.sorted_cities()]
-            undecided_legs_from_city = [leg for leg in legs_from_city if leg.undecided]
-            excluded_legs_from_city    = [leg for leg in legs_from_city if leg.excluded]
-            if len(undecided_legs_from_city) == 1 and len(excluded_legs_from_city) == len(legs_from_city) - 1:
-#                print from_city, "was a necessary origin, adding", undecided_legs_from_city[0].to_city
-                excluded_routing.add_leg(from_city, undecided_legs_from_city[0].to_city)
+            if open_tos & (open_tos - 1) == 0 and open_tos & ~self.included_rows[f]:
+                self.include_and_enqueue(f, open_tos.bit_length() - 1, queue)
+                if self.stats is not None:
+                    self.stats.count('rule 4b')
+        if not open_tos and self.ticket_rows[f] & ~(1 << f):
+            self.set_infeasible()
+            return
+            
+        # Optimization 3 for every leg out of t, now that nothing can fly into t.
+        if self.included_rows[t]:
+            if open_froms is None:
+                open_froms = self.open_col(t)
+            if not open_froms:
+                for X in bit_indices(self.included_rows[t]):
+                    self.exclude_ticket_pairs(t, X, queue)
+                
+    # Forced ticket legs
+    # Every path a ticket a->b can still take runs along legs that aren't excluded.  If all of them use
+    # some leg, then so must any routing found below here, and the leg can be included now; if there
+    # are none, no such routing exists.  Those legs are found from the dominator tree of the graph of
+    # non-excluded legs, rooted at a: one pass per ticket origin serves all of its tickets.
+    
+    # Includes every leg that all the remaining paths of some unsatisfied ticket use, and realizes
+    # the consequences, until there are no more; or marks this Routing infeasible if some unsatisfied
+    # ticket has no path left.  Returns the number of legs included.
+    # Which legs every path uses depends only on the legs that aren't excluded, so nothing is worked out
+    # again until some leg has been.
+    def force_ticket_legs(self):
+        forced = 0
+        while self.unsatisfied_tickets > 0 and not self.infeasible and self.paths_cut:
+            self.set_attribute('paths_cut', False)
+            legs = self.ticket_legs()
+            if not legs:
+                break
+            queue = deque()
+            for u, v in legs:
+                self.include_and_enqueue(u, v, queue)
+            self.propagate(queue)
+            forced += len(legs)
+            if self.stats is not None:
+                self.stats.count('forced ticket legs', len(legs))
+        return forced
+    
+    # Returns the set of undecided legs (u, v) that all the remaining paths of some unsatisfied ticket use.
+    # Marks this Routing infeasible (and returns an empty set) if some unsatisfied ticket has no path left.
+    def ticket_legs(self):
+        open_rows = [(self.full_row & ~row) & ~(1 << i) for i, row in enumerate(self.excluded_rows)]
+        legs = set()
+        for a, row in enumerate(self.ticket_rows):
+            reached = self.reach_rows[a]
+            unsatisfied = row & ~reached
+            if not unsatisfied or not unsatisfied & ~self.doubly_reached(reached, unsatisfied, open_rows):
+                continue
+            
+            found, dominators, preds = self.dominator_sets(a, reached, open_rows)
+            if unsatisfied & ~found:
+                self.set_infeasible()
+                return set()
+                
+            # The legs on every path from a to b are the legs u->v, v dominating b and u its immediate
+            # dominator, where every path from a reaches v for the first time along u->v: that is,
+            # v dominates every other predecessor of v.  (When u is a, the leg is from the one city
+            # a already reaches that leads to v.)
+            chains = 0
+            for b in bit_indices(unsatisfied):
+                chains |= dominators[b]
+            for v in bit_indices(chains & ~(1 << a)):
+                strict = dominators[v] & ~(1 << v)
+                u = a
+                for d in bit_indices(strict):
+                    if dominators[d] == strict:
+                        u = d
+                        break
+                if u == a:
+                    from_reached = preds[v] & reached
+                    if not from_reached or from_reached & (from_reached - 1):
+                        continue
+                    u = from_reached.bit_length() - 1
+                elif not (preds[v] >> u) & 1:
+                    continue
+                if not self.is_undecided(u, v):
+                    continue
+                bit = 1 << v
+                for p in bit_indices(preds[v] & ~reached & ~(1 << u)):
+                    if not dominators[p] & bit:
+                        break
+                else:
+                    legs.add((u, v))
+        return legs
         
-        return excluded_routing
-   
-    # Returns a new Routing, in which the given leg is included in the graph
-    # and any consequences are also realized
-    def include_leg(self, from_city, to_city):
-        included_routing = self.deepleg_copy()
+    # Returns the cities, of those in targets, that can be reached from the cities in reached along the
+    # legs in rows by two paths that share no leg, so that no leg is on every path to them.
+    # Those are the cities reached in two ways (by legs from two different cities, or through two
+    # different cities one leg further on) from cities in reached or already found to be so.
+    # This doesn't find them all, but it's much quicker than a dominator tree, and on all but
+    # sparse graphs it settles every target.
+    def doubly_reached(self, reached, targets, rows):
+        found = reached
+        while targets & ~found:
+            once = 0
+            twice = 0
+            for r in bit_indices(found):
+                twice |= once & rows[r]
+                once |= rows[r]
+            for c in bit_indices(once & ~found):
+                twice |= once & rows[c] & ~(1 << c)
+                once |= rows[c]
+            if not twice & ~found:
+                break
+            found |= twice
+        return found & targets
         
-        included_routing.add_leg(from_city, to_city)
-        
-        if from_city != to_city:
-            for A in [city for city in included_routing.sorted_cities() if city not in [from_city, to_city]]:
-                # Optimization 1a: exclude redundant paths to to_city
-                # If A->from_city is included (or implicitly included)
-                # we can exclude A->to_city, since A->from_city->to_city is now a path.
-                # And we mark it implicitly included.
-                leg = included_routing.matrix[A][from_city]
-                if leg.included or leg.implicitly_included:
-                    if included_routing.matrix[A][to_city].undecided:
-                        included_routing.add_implicit_leg(A, to_city)
+    # Works out which cities dominate which in the graph with adjacency bitsets rows, from root
+    # (taking the cities in reached, which root already reaches, to be root itself):
+    # i dominates j when every path from root to j goes through i.
+    # Returns the bitset of cities found from root; for each of them, the bitset of the cities
+    # that dominate it (itself included, and root, but none of the others in reached); and the
+    # bitset of its predecessors among the cities found.
+    # The dominators of a city are itself and those common to all its predecessors, which is
+    # worked out over the cities in breadth-first order until nothing changes.
+    def dominator_sets(self, root, reached, rows):
+        n = len(self.cities)
+        preds = [0] * n
+        pred_lists = [[] for v in range(n)]
+        dominators = [1 << root] * n
+        order = []
+        found = reached
+        frontier = reached
+        while frontier:
+            next_frontier = 0
+            while frontier:
+                low_bit = frontier & -frontier
+                frontier ^= low_bit
+                u = low_bit.bit_length() - 1
+                next_frontier |= rows[u]
+                if not reached & low_bit:
+                    order.append(u)
+            frontier = next_frontier & ~found
+            found |= frontier
+            
+        for u in bit_indices(found):
+            for v in bit_indices(rows[u] & found & ~reached):
+                preds[v] |= 1 << u
+                pred_lists[v].append(u)
+        for v in order:
+            dominators[v] = found
                 
-                # Optimization 1b: exclude redundant paths from from_city
-                # If to_city->B is included (or implicitly included)
-                # we can exclude from_city->B, since from_city->to_city->B is now a path.
-                # And we mark it implicitly included.
-                B = A
-                leg = included_routing.matrix[to_city][B]
-                if leg.included or leg.implicitly_included:
-                    if included_routing.matrix[from_city][B].undecided:
-                        included_routing.add_implicit_leg(from_city, B)
-                        
-                # Optimization 2a: exclude paths that would make this one redundant
-                # If from_city->C is included (or implicitly included)
-                # we can exclude C->to_city and to_city->C, since they would make from_city->to_city redundant.
-                # They are NOT implicitly included, however.
-                # In fact, no indirect connection corresponding to those legs should be allowed either,
-                # so we mark them unreachable.
-                C = A
-                leg = included_routing.matrix[from_city][C]
-                if leg.included or leg.implicitly_included:
-                    if included_routing.matrix[C][to_city].undecided:
-                        included_routing.remove_explicit_leg(C, to_city)
-                    
-                    if included_routing.matrix[to_city][C].undecided:
-                        included_routing.remove_explicit_leg(to_city, C)
-                        
-                # Optimization 2b: exclude paths that would make this one redundant
-                # If D->to_city is included (or implicitly included)
-                # we can exclude from_city->D and D->from_city, since they would make from_city->to_city redundant.
-                # And we mark them unreachable.
-                D = A
-                leg = included_routing.matrix[D][to_city]
-                if leg.included or leg.implicitly_included:
-                    if included_routing.matrix[from_city][D].undecided:
-                        included_routing.remove_explicit_leg(from_city, D)
+        changed = True
+        while changed:
+            changed = False
+            for v in order:
+                common = found
+                for p in pred_lists[v]:
+                    common &= dominators[p]
+                common |= 1 << v
+                if common != dominators[v]:
+                    dominators[v] = common
+                    changed = True
                     
-                    if included_routing.matrix[D][from_city].undecided:
-                        included_routing.remove_explicit_leg(D, from_city)
-    
-        return included_routing
+        return found, dominators, preds
         
     # Returns a list of legs, by default only those which exist.
     # Warning: setting existing_only to False will return a list that's n**2 in the number of cities.    
     def legs(self, existing_only = True):
-        # "Incomprehensible list comprehension" to flatten the matrix, taken from 
-        # http://stackoverflow.com/questions/952914/making-a-flat-list-out-of-list-of-lists-in-python
-        legs = [leg for from_legs in self.matrix.values() for leg in from_legs.values()]
-        
         if existing_only:
-            return [leg for leg in legs if leg.exists]
+            return self.included_legs()
         else:
-            return legs
+            n = len(self.cities)
+            return [self.make_leg(i, j) for i in range(n) for j in range(n)]
+            
+    # Returns a list of Legs for every bit set in the given per-row bitsets
+    def legs_from_rows(self, rows):
+        return [self.make_leg(i, j) for i, row in enumerate(rows) for j in bit_indices(row)]
             
     # Returns a list of undecided legs
     def undecided_legs(self):
-        return [leg for leg in self.legs(existing_only = False) if leg.undecided]
+        return self.legs_from_rows([self.undecided_row(i) for i in range(len(self.cities))])
         
     # Returns a list of excluded legs
     def excluded_legs(self):
-        return [leg for leg in self.legs(existing_only = False) if leg.excluded]
+        return self.legs_from_rows(self.excluded_rows)
         
     # Returns a list of included legs
     def included_legs(self):
-        return [leg for leg in self.legs(existing_only = False) if leg.included]
+        return self.legs_from_rows(self.included_rows)
         
     # Returns True if the route from from_city to to_city is marked explicitly excluded
     # i.e. impossible.
     def explicitly_excludes(self, from_city, to_city):
-        leg = self.matrix[from_city][to_city]
-        if leg.explicitly_excluded:
-            return True
-            
-        return False 
+        return bool((self.explicit_rows[self.index[from_city]] >> self.index[to_city]) & 1)
         
     # Returns a list of legs from from_city to to_city along non-excluded edges,
     # along with a dictionary counting how many times each city was discovered during
     # the BFS.
     def possible_route(self, from_city, to_city):
         cities = self.sorted_cities()
-     
-        discovered = {}
-        processed  = {}
-        parent     = {}
-        for city in cities:
-            discovered[city] = 0
-            processed[city]  = False
-            parent[city]     = None
+        start  = self.index[from_city]
+        
+        discovered = [0] * len(cities)
+        parent     = [None] * len(cities)
             
-        discovered[from_city] = 1
-        queue = deque([from_city])
+        discovered[start] = 1
+        queue = deque([start])
         while len(queue) != 0:
-            current_city = queue.popleft()
+            current = queue.popleft()
 
             # Process
-            connections = [next_city for next_city in self.matrix[current_city] if not self.matrix[current_city][next_city].excluded]
-            for next_city in connections:
-                if not discovered[next_city]:
-                    discovered[next_city] += 1
-                    parent[next_city] = current_city
-                    queue.append(next_city)
-                elif next_city != current_city:
-                    discovered[next_city] += 1
-            
-            processed[current_city] = True
+            for next_index in bit_indices(self.full_row & ~self.excluded_rows[current]):
+                if not discovered[next_index]:
+                    discovered[next_index] += 1
+                    parent[next_index] = current
+                    queue.append(next_index)
+                elif next_index != current:
+                    discovered[next_index] += 1
         
         # Trace parent cities backward to create a list of legs
         reversed_legs = []
-        current_city = to_city
-        while current_city != from_city:
-            reversed_legs.append(self.matrix[parent[current_city]][current_city])
-            current_city = parent[current_city]
+        current = self.index[to_city]
+        while current != start:
+            reversed_legs.append(self.make_leg(parent[current], current))
+            current = parent[current]
             
-        return list(reversed(reversed_legs)), discovered
+        return list(reversed(reversed_legs)), dict(zip(cities, discovered))
         
      
+    # Returns a list of included legs from from_city to to_city, with as few legs as possible,
+    # or None if the included legs don't connect them.
+    def included_route(self, from_city, to_city):
+        start = self.index[from_city]
+        end   = self.index[to_city]
+        if not (self.reach_rows[start] >> end) & 1:
+            return None
+        
+        parent = {start: None}
+        queue = deque([start])
+        while end not in parent:
+            current = queue.popleft()
+            for next_index in bit_indices(self.included_rows[current]):
+                if next_index not in parent:
+                    parent[next_index] = current
+                    queue.append(next_index)
+        
+        reversed_legs = []
+        current = end
+        while current != start:
+            reversed_legs.append(self.make_leg(parent[current], current))
+            current = parent[current]
+            
+        return list(reversed(reversed_legs))
+     
     # Returns None if there are zero or at least two possible routes on non-excluded edges.
     # If there is only one possible route, returns a list of that route's legs.
     def single_possible_route(self, from_city, to_city): 
@@ -344,59 +959,48 @@ class Routing:
     
     # Returns True if a path from from_city to to_city exists.
     # Uses what included/excluded information it has, then
-    # falls back on BFS.    
+    # falls back on the reachability index.
     def are_connected(self, from_city, to_city):
-        cities = self.sorted_cities()
-        
-        leg = self.matrix[from_city][to_city]
+        i = self.index[from_city]
+        j = self.index[to_city]
         
-        if leg.included or leg.implicitly_included:
+        if self.reaches(i, j):
             # Yay, we know there's a path!
             return True
-        elif leg.explicitly_excluded:
+        elif (self.explicit_rows[i] >> j) & 1:
             # Yay, we know there's no such path!
             return False
         else:
-            return to_city in self.connected_cities(from_city)
-                
-    # Returns a list of Cities to which the given City can connect.
-    def connected_cities(self, from_city):
-        cities = self.sorted_cities()
-        
-        discovered = {}
-        processed = {}
-        for city in cities:
-            discovered[city] = False
-            processed[city] = False
+            return bool((self.reach_rows[i] >> j) & 1)
             
-        discovered[from_city] = True
-        queue = deque([from_city])
-        while len(queue) != 0:
-            current_city = queue.popleft()
-            
-            connections = [next_city for next_city in self.matrix[current_city] if self.matrix[current_city][next_city].exists]
-            for next_city in connections:
-                if not discovered[next_city]:
-                    discovered[next_city] = True
-                    queue.append(next_city)
-                    
-            processed[current_city] = True
+    # Returns the bitset of city indices reachable from i along existing legs, including i itself.
+    def reachable_row(self, i):
+        return self.search_rows(i, self.included_rows)
+        
+    # Returns the bitset of city indices from which j is reachable along existing legs, including j itself.
+    def reaching_row(self, j):
+        return self.search_rows(j, self.included_cols)
+        
+    # Breadth-first search from start over the adjacency bitsets in rows; returns the bitset of cities found.
+    def search_rows(self, start, rows):
+        discovered = 1 << start
+        frontier   = discovered
+        while frontier:
+            next_frontier = 0
+            for current in bit_indices(frontier):
+                next_frontier |= rows[current]
+            frontier = next_frontier & ~discovered
+            discovered |= frontier
             
-        return [city for city in cities if discovered[city] == True]
+        return discovered
+        
+    # Returns a list of Cities to which the given City can connect.
+    def connected_cities(self, from_city):
+        return [self.cities[i] for i in bit_indices(self.reach_rows[self.index[from_city]])]
         
     # Returns a list of cities which connect to the given City
     def connecting_cities(self, to_city):
-        # We need a backwards BFS.  \
-        # No problem, we'll look at connectED cities in a Routing with reversed edges.
-        reversed_routing = Routing(self.sorted_cities())
-        cities = reversed_routing.sorted_cities()
-        
-        for old_from_city in cities:
-            for old_to_city in cities:
-                if self.matrix[old_from_city][old_to_city].exists:
-                    reversed_routing.add_leg(old_to_city, old_from_city)
-                                        
-        return reversed_routing.connected_cities(to_city)
+        return [self.cities[i] for i in bit_indices(self.reached_rows[self.index[to_city]])]
                 
     # Given a list of tickets, returns a list of those tickets that can't be satisfied.
     def unconnected_tickets(self, tickets):
@@ -409,16 +1013,12 @@ class Routing:
     # Returns the total number of miles flown to satisfy the given Tickets
     # Currently assumes each leg of the routing is flown exactly once.
     def miles(self, tickets):
-        miles = sum([leg.miles for leg in self.legs()])
-        
-        return miles
+        return self.total_miles
         
     # Returns the total number of takeoffs flown to satisfy the given Tickets.
     # Currently assumes each leg of the routing is flown exactly once.
     def takeoffs(self, tickets):
-        takeoffs = len(self.legs())
-        
-        return takeoffs
+        return self.total_takeoffs
             
     # Given costs per mile and per takeoff, and a list of Tickets, 
     # returns the cost of flying those flights with this routing.
@@ -430,7 +1030,7 @@ class Routing:
                 
     # Returns a new Routing holding a simple solution to the problem: just take all the ticket legs.
     def simple(self, tickets):
-        simple_routing = Routing(self.sorted_cities())
+        simple_routing = Routing(self.sorted_cities(), self.distances)
         
         for ticket in tickets:
             simple_routing.add_leg(ticket.from_city, ticket.to_city)
@@ -438,70 +1038,151 @@ class Routing:
         return simple_routing
         
     # Returns a new Routing holding a greedy solution to the problem.
-    def greedy(self, miles_cost, takeoff_cost, tickets):
-        greedy_routing = Routing(self.sorted_cities())
+    # If given (or set on this Routing), stats counts the legs added and tickets rerouted, and times the whole.
+    def greedy(self, miles_cost, takeoff_cost, tickets, stats = None):
+        if stats == None:
+            stats = self.stats
+        if stats != None:
+            with stats.timer('greedy'):
+                return self.greedy_routing(miles_cost, takeoff_cost, tickets, stats)
+        return self.greedy_routing(miles_cost, takeoff_cost, tickets, None)
+        
+    def greedy_routing(self, miles_cost, takeoff_cost, tickets, stats):
+        greedy_routing = Routing(self.sorted_cities(), self.distances)
         if len(tickets) == 0:
             return greedy_routing
                 
-        cities = greedy_routing.sorted_cities()
-        
-        ticket_queue = tickets[:]
-        for ticket in ticket_queue:
+        ticket_queue = TicketQueue()
+        for ticket in tickets:
             if ticket.from_city == ticket.to_city:
-                ticket.cost = 0
+                ticket_queue.push(ticket, 0)
             else:
-                ticket.cost = takeoff_cost + \
-                              miles_cost * greedy_routing.matrix[ticket.from_city][ticket.to_city].miles
+                ticket_queue.push(ticket, takeoff_cost + \
+                                          miles_cost * greedy_routing.miles_between(ticket.from_city, ticket.to_city))
         
         while len(ticket_queue) != 0:
-            ticket = min(ticket_queue, key = lambda tt: tt.cost)
-            ticket_queue.remove(ticket)
+            ticket = ticket_queue.pop()
 #            print ticket
             
             # Add this shortest ticket directly.
             if ticket.from_city == ticket.to_city:
                 greedy_routing.add_implicit_leg(ticket.from_city, ticket.to_city)
             else:
-                greedy_routing.add_leg(ticket.from_city, ticket.to_city)
+                from_index = greedy_routing.index[ticket.from_city]
+                to_index   = greedy_routing.index[ticket.to_city]
+                greedy_routing.add(from_index, to_index)
+                if stats is not None:
+                    stats.count('greedy legs')
                 # Now update the other tickets based on this newly available leg.
                 
                 # For all tickets from cities A which reach from_city,
                 # compare the cost of A->B to the cost of to_city->B
                 # (since the cost of A->from_city->to_city is already covered).
                 # Update the ticket if necessary.
-                reaching_from_city = greedy_routing.connecting_cities(ticket.from_city)
-                for earlier_city in reaching_from_city:
-                    candidate_tickets = [tt for tt in ticket_queue if tt.from_city == earlier_city]
-                    for candidate in candidate_tickets:
+                for earlier_index in bit_indices(greedy_routing.reached_rows[from_index]):
+                    earlier_city = greedy_routing.cities[earlier_index]
+                    for entry in ticket_queue.entries_from(earlier_city):
+                        candidate = entry.ticket
                         direct_cost = takeoff_cost + \
-                                      miles_cost * greedy_routing.matrix[candidate.from_city][candidate.to_city].miles
+                                      miles_cost * greedy_routing.miles_between(candidate.from_city, candidate.to_city)
                         additional_cost = takeoff_cost + \
-                                      miles_cost * greedy_routing.matrix[ticket.to_city][candidate.to_city].miles
+                                      miles_cost * greedy_routing.miles_between(ticket.to_city, candidate.to_city)
                         if additional_cost < direct_cost:  # Poor customer, no direct flight for you!
                             # Do NOT change the requirement status of the cities!
                             new_ticket = Ticket(ticket.to_city, candidate.to_city, set_required = False)
-                            new_ticket.cost = additional_cost 
-                            ticket_queue.remove(candidate)
-                            ticket_queue.append(new_ticket)
+                            ticket_queue.replace(entry, new_ticket, additional_cost)
+                            if stats is not None:
+                                stats.count('greedy reroutes')
                             
                 
                 # For all tickets to cities B which are reachable from to_city,
                 # compare the cost A->B to the cost of A->from_city
                 # (since the cost of from_city->to_city->B is already covered).
                 # Update the ticket if necessary.
-                to_city_reaches = greedy_routing.connected_cities(ticket.to_city)
-                for later_city in to_city_reaches:
-                    candidate_tickets = [tt for tt in ticket_queue if tt.to_city == later_city]
-                    for candidate in candidate_tickets:
+                for later_index in bit_indices(greedy_routing.reach_rows[to_index]):
+                    later_city = greedy_routing.cities[later_index]
+                    for entry in ticket_queue.entries_to(later_city):
+                        candidate = entry.ticket
                         direct_cost = takeoff_cost + \
-                                      miles_cost * greedy_routing.matrix[candidate.from_city][candidate.to_city].miles
+                                      miles_cost * greedy_routing.miles_between(candidate.from_city, candidate.to_city)
                         additional_cost = takeoff_cost + \
-                                      miles_cost * greedy_routing.matrix[candidate.from_city][ticket.from_city].miles
+                                      miles_cost * greedy_routing.miles_between(candidate.from_city, ticket.from_city)
                         if additional_cost < direct_cost:  # No direct flight for you!
                             # Again, do NOT change the required status of the cities!
                             new_ticket = Ticket(candidate.from_city, ticket.from_city, set_required = False)
-                            new_ticket.cost = additional_cost
-                            ticket_queue.remove(candidate)
-                            ticket_queue.append(new_ticket)                                
+                            ticket_queue.replace(entry, new_ticket, additional_cost)
+                            if stats is not None:
+                                stats.count('greedy reroutes')
                                 
-        return greedy_routing
\ No newline at end of file
+        return greedy_routing
+
+# An entry in a TicketQueue: a ticket, its cost, and whether it is still waiting to be popped.
+class TicketQueueEntry:
+    def __init__(self, ticket, cost, sequence):
+        self.ticket   = ticket
+        self.cost     = cost
+        self.sequence = sequence
+        self.live     = True
+
+# The priority queue of tickets used by Routing.greedy.
+# pop() returns the cheapest ticket, the earliest pushed among equally cheap ones.
+# Tickets are also indexed by origin and by destination.  Removed entries are only
+# marked dead and skipped (or dropped) later, so replacing a ticket costs O(log T).
+class TicketQueue:
+    def __init__(self):
+        self.heap = []
+        self.by_origin      = defaultdict(list)
+        self.by_destination = defaultdict(list)
+        self.live_count = 0
+        self.pushed     = 0
+        
+    def __len__(self):
+        return self.live_count
+        
+    # Adds ticket to the queue with the given cost, returning its entry.
+    def push(self, ticket, cost):
+        entry = TicketQueueEntry(ticket, cost, self.pushed)
+        self.pushed += 1
+        self.live_count += 1
+        
+        heapq.heappush(self.heap, (cost, entry.sequence, entry))
+        self.by_origin[ticket.from_city].append(entry)
+        self.by_destination[ticket.to_city].append(entry)
+        
+        return entry
+        
+    # Removes and returns the cheapest ticket.
+    def pop(self):
+        while True:
+            cost, sequence, entry = heapq.heappop(self.heap)
+            if entry.live:
+                self.remove(entry)
+                return entry.ticket
+                
+    def remove(self, entry):
+        entry.live = False
+        self.live_count -= 1
+        
+    # Replaces the ticket in entry with new_ticket, at the given cost.
+    def replace(self, entry, new_ticket, cost):
+        self.remove(entry)
+        return self.push(new_ticket, cost)
+        
+    # Returns a list of the live entries in index[city], in the order they were pushed,
+    # dropping dead ones from the index along the way.
+    def live_entries(self, index, city):
+        live = [entry for entry in index.get(city, []) if entry.live]
+        if len(live) > 0:
+            index[city] = live
+        elif city in index:
+            del index[city]
+            
+        return list(live)
+        
+    # Returns the live entries for tickets from city, in the order they were pushed.
+    def entries_from(self, city):
+        return self.live_entries(self.by_origin, city)
+        
+    # Returns the live entries for tickets to city, in the order they were pushed.
+    def entries_to(self, city):
+        return self.live_entries(self.by_destination, city)
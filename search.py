@@ -0,0 +1,472 @@
+# Iterative branch-and-bound search for the flight routing problem.
+# The search keeps its open nodes in an explicit frontier instead of on the call stack,
+# so its depth isn't limited by Python's recursion limit, and it can be stepped,
+# paused and inspected.  The order in which open nodes are taken is up to the frontier.
+
+import heapq
+import itertools
+import time
+from collections import deque
+from collections import OrderedDict
+
+import bounds
+import branching as branching_strategies
+
+# A node is pruned once its bound comes within this fraction of the best cost: an LP bound
+# (see bounds.FlowBound) that proves the best optimal may otherwise fall a rounding error short of it.
+BOUND_TOLERANCE = 1e-9
+
+# A node of the search tree: the routing obtained from its parent's by including
+# (or excluding) the leg from_index->to_index.  The root has no parent and no leg.
+# bound is a lower bound on the cost of any routing found beneath the node.
+class SearchNode:
+    def __init__(self, parent, from_index, to_index, include, bound):
+        self.parent     = parent
+        self.from_index = from_index
+        self.to_index   = to_index
+        self.include    = include
+        self.bound      = bound
+
+        # Only kept up when the search has a TranspositionTable: the node's state_hash once expanded,
+        # how many of its children are still open, and the least lower bound proven for those settled so far.
+        self.state_hash    = None
+        self.open_children = 0
+        self.proven        = float('inf')
+
+        if parent is None:
+            self.depth = 0
+        else:
+            self.depth = parent.depth + 1
+
+    def __repr__(self):
+        if self.parent is None:
+            return "<SearchNode:root>"
+        action = "include" if self.include else "exclude"
+        return "".join(["<SearchNode:", action, " ", str(self.from_index), "->", str(self.to_index), ">"])
+
+# Returns the list of decisions (from_index, to_index, include) leading from the root of the search to node.
+def node_decisions(node):
+    decisions = []
+    while node.parent is not None:
+        decisions.append((node.from_index, node.to_index, node.include))
+        node = node.parent
+
+    return list(reversed(decisions))
+
+# Includes or excludes, in place, each of the legs in a list of decisions as returned by node_decisions.
+def apply_decisions(route, decisions):
+    for from_index, to_index, include in decisions:
+        if include:
+            route.include(from_index, to_index)
+        else:
+            route.exclude(from_index, to_index)
+
+# Frontiers hold the open nodes of a search.  Children are pushed excluded-then-included,
+# so the included child is the last one pushed.
+
+# Depth-first: always expand the most recently pushed node.
+# This explores the tree in the same order as the old recursive solver.
+class DepthFirstFrontier:
+    def __init__(self):
+        self.stack = []
+
+    def push(self, node):
+        self.stack.append(node)
+
+    def pop(self):
+        return self.stack.pop()
+
+    def __len__(self):
+        return len(self.stack)
+
+    # Returns the open nodes, next to be expanded first.
+    def nodes(self):
+        return list(reversed(self.stack))
+
+    # Removes and returns the open node nearest the root, the one that would be expanded last.
+    def pop_shallowest(self):
+        return self.stack.pop(0)
+
+# Breadth-first: expand nodes in the order they were pushed.
+# Mostly useful for splitting the top of the tree into many subproblems.
+class BreadthFirstFrontier:
+    def __init__(self):
+        self.queue = deque()
+
+    def push(self, node):
+        self.queue.append(node)
+
+    def pop(self):
+        return self.queue.popleft()
+
+    def __len__(self):
+        return len(self.queue)
+
+    def nodes(self):
+        return list(self.queue)
+
+# Best-bound-first: always expand the open node with the lowest bound, deepest first on ties.
+class BestFirstFrontier:
+    def __init__(self):
+        self.heap    = []
+        self.counter = itertools.count()
+
+    def push(self, node):
+        heapq.heappush(self.heap, (node.bound, -node.depth, next(self.counter), node))
+
+    def pop(self):
+        return heapq.heappop(self.heap)[-1]
+
+    def __len__(self):
+        return len(self.heap)
+
+    def nodes(self):
+        return [entry[-1] for entry in sorted(self.heap)]
+
+# Hybrid: dive depth-first along the most recently pushed children, and when a dive ends
+# (a node is pruned or reaches a leaf), jump to the open node with the lowest bound.
+class HybridFrontier(BestFirstFrontier):
+    def __init__(self):
+        BestFirstFrontier.__init__(self)
+        self.dive = None
+
+    def push(self, node):
+        if self.dive is not None:
+            BestFirstFrontier.push(self, self.dive)
+        self.dive = node
+
+    def pop(self):
+        if self.dive is not None:
+            node = self.dive
+            self.dive = None
+            return node
+        return BestFirstFrontier.pop(self)
+
+    def __len__(self):
+        return BestFirstFrontier.__len__(self) + int(self.dive is not None)
+
+    def nodes(self):
+        dive = [self.dive] if self.dive is not None else []
+        return dive + BestFirstFrontier.nodes(self)
+
+# What became of a search: the cost of the best routing it found, a proven lower bound on the
+# cost of any routing, and why it stopped -- 'complete', or 'time' or 'nodes' if a budget ran out.
+class SearchReport:
+    def __init__(self):
+        self.best_cost      = None
+        self.lower_bound    = None
+        self.nodes_expanded = 0
+        self.stop_reason    = None
+
+    def complete(self):
+        return self.stop_reason == 'complete'
+
+    # Returns how far the best cost might be above the optimum, as a fraction of the best cost.
+    def gap(self):
+        if self.best_cost == None:
+            return float('inf')
+        if self.best_cost <= self.lower_bound:
+            return 0.0
+        return (self.best_cost - self.lower_bound) / self.best_cost
+
+    def __str__(self):
+        if self.complete():
+            return "Search complete after %d nodes: cost %s is optimal" % (self.nodes_expanded, self.best_cost)
+        return "Search stopped by %s limit after %d nodes: cost %s, lower bound %s, gap %.2f%%" % (
+            self.stop_reason, self.nodes_expanded, self.best_cost, self.lower_bound, 100 * self.gap())
+
+# A bounded table of lower bounds proven for Routing states, keyed by their state_hash:
+# once a node's whole subtree has been searched (or pruned), no routing beneath it can cost less than
+# the bound recorded for it, so a later search reaching the same state can prune it straight away.
+# The bounds only hold for the tickets and costs they were proven with, so a table mustn't be shared
+# between different problems.  When full, the least recently used entry is evicted.
+class TranspositionTable:
+    def __init__(self, capacity = 100000):
+        self.capacity = capacity
+        self.entries  = OrderedDict()
+
+    def __len__(self):
+        return len(self.entries)
+
+    # Returns the bound recorded for state_hash, or None.
+    def get(self, state_hash):
+        bound = self.entries.pop(state_hash, None)
+        if bound != None:
+            self.entries[state_hash] = bound  # Now the most recently used
+        return bound
+
+    def put(self, state_hash, bound):
+        self.entries.pop(state_hash, None)
+        self.entries[state_hash] = bound
+        if len(self.entries) > self.capacity:
+            self.entries.popitem(last = False)
+
+FRONTIERS = {
+    'depth':   DepthFirstFrontier,
+    'breadth': BreadthFirstFrontier,
+    'best':    BestFirstFrontier,
+    'hybrid':  HybridFrontier,
+}
+
+# A branch-and-bound search over the legs of a Routing.
+# route is left untouched; the search includes and excludes legs on a private copy,
+# moving between nodes by undoing and replaying decisions on its trail.
+# order chooses the frontier: 'depth', 'best', 'hybrid' or 'breadth'.
+# stats, if given, is a stats.Stats to record node counts, prunes, timings and depths in.
+# on_improvement, if given, is called as on_improvement(routing, cost) whenever the search finds a better routing.
+# table, if given, is a TranspositionTable to prune states already settled by earlier searches of the
+# same problem, and to record the states this one settles.
+# branching names the strategy for picking the leg to branch on (see branching.STRATEGIES).
+class Search:
+    def __init__(self, route, tickets, mile_cost, takeoff_cost, current_best = None, lower_bounds = None, order = 'depth',
+                 stats = None, on_improvement = None, table = None, branching = 'longest'):
+        self.tickets      = tickets
+        self.mile_cost    = mile_cost
+        self.takeoff_cost = takeoff_cost
+        self.stats        = stats
+        self.on_improvement = on_improvement
+        self.table        = table
+
+        if lower_bounds == None:
+            lower_bounds = bounds.default_bounds(route, tickets, mile_cost, takeoff_cost)
+        self.lower_bounds = lower_bounds
+        self.branching = branching_strategies.STRATEGIES[branching](route, tickets, mile_cost, takeoff_cost)
+
+        self.route = route.deepleg_copy()
+        self.route.stats = stats
+        self.route.watch_tickets(tickets)
+        if table != None:
+            self.route.track_state_hash()
+        self.route.start_trail()
+
+        self.best = None
+        self.best_cost = None
+        self.best_node = None  # The node the best solution was found at, if this search found it
+        if current_best != None:
+            self.set_best(current_best)
+
+        self.frontier = FRONTIERS[order]()
+        root = SearchNode(None, None, None, None, self.cost(self.route))
+        self.frontier.push(root)
+
+        # The nodes whose decisions are currently applied to self.route, root first,
+        # each with the trail mark from just before its decision was applied.
+        self.path = [(root, 0)]
+
+        self.nodes_expanded = 0
+        self.stop_reason = None  # Set to 'time' or 'nodes' when a budget stops the search
+
+    def cost(self, route):
+        return route.cost(self.mile_cost, self.takeoff_cost, self.tickets)
+
+    # Records best, found at node (if it was found by this search), as the best known solution.
+    def set_best(self, best, node = None):
+        self.best = best
+        self.best_cost = self.cost(best)
+        self.best_node = node
+
+        if node is not None and self.on_improvement != None:
+            self.on_improvement(best, self.best_cost)
+
+    # Returns the cost that a routing has to beat to be worth exploring, or None if anything goes.
+    # This is the cost of the best solution, but subclasses may know of better ones elsewhere.
+    def incumbent_cost(self):
+        return self.best_cost
+
+    # Returns True if the search has no open nodes left.
+    def done(self):
+        return len(self.frontier) == 0
+
+    # Runs the search to completion, or until it has run for time_limit seconds or expanded
+    # node_limit nodes, returning the best solution found.
+    def run(self, time_limit = None, node_limit = None):
+        if self.stats != None:
+            with self.stats.timer('search'):
+                for best in self.improvements(time_limit, node_limit):
+                    pass
+        else:
+            for best in self.improvements(time_limit, node_limit):
+                pass
+
+        return self.best
+
+    # Runs the search like run, yielding each better routing as soon as it's found.
+    def improvements(self, time_limit = None, node_limit = None):
+        if time_limit != None:
+            deadline = time.time() + time_limit
+        while not self.done():
+            if node_limit != None and self.nodes_expanded >= node_limit:
+                self.stop_reason = 'nodes'
+                return
+            if time_limit != None and time.time() >= deadline:
+                self.stop_reason = 'time'
+                return
+
+            best = self.best
+            self.step()
+            if self.best is not best:
+                yield self.best
+
+    # Returns a lower bound on the cost of any routing: the optimal cost once the search is done,
+    # or while it is still running, the least of the best cost and the bounds of the open nodes.
+    # float('inf') if the search is done and found nothing.
+    def lower_bound(self):
+        lowest = float('inf') if self.best_cost == None else self.best_cost
+        for node in self.frontier.nodes():
+            lowest = min(lowest, node.bound)
+        return lowest
+
+    # Fills in a SearchReport on how the search went.
+    def fill_report(self, report):
+        report.best_cost      = self.best_cost
+        report.lower_bound    = self.lower_bound()
+        report.nodes_expanded = self.nodes_expanded
+        report.stop_reason    = 'complete' if self.done() else self.stop_reason
+
+    # Expands the next open node.  Returns False if there was none.
+    def step(self):
+        if self.done():
+            return False
+
+        node = self.frontier.pop()
+        if self.stats != None:
+            self.stats.record_depth('nodes expanded', node.depth)
+            start = time.time()
+            self.move_to(node)
+            self.stats.add_time('propagation', time.time() - start)
+        else:
+            self.move_to(node)
+        self.expand(node)
+        self.nodes_expanded += 1
+
+        return True
+
+    # Applies node's decisions to self.route, undoing only as far back as the
+    # deepest ancestor that is already applied.
+    def move_to(self, node):
+        pending = []
+        ancestor = node
+        while ancestor.depth >= len(self.path) or self.path[ancestor.depth][0] is not ancestor:
+            pending.append(ancestor)
+            ancestor = ancestor.parent
+
+        # Undo whatever was applied below that ancestor
+        if len(self.path) > ancestor.depth + 1:
+            self.route.undo(self.path[ancestor.depth + 1][1])
+            del self.path[ancestor.depth + 1:]
+
+        for pending_node in reversed(pending):
+            self.path.append((pending_node, self.route.trail_mark()))
+            if pending_node.include:
+                self.route.include(pending_node.from_index, pending_node.to_index)
+            else:
+                self.route.exclude(pending_node.from_index, pending_node.to_index)
+
+    # Evaluates the routing at node (which must be applied to self.route):
+    # prunes it, records it as the new best, or pushes its children.
+    def expand(self, node):
+        route = self.route
+        stats = self.stats
+        best_cost = self.incumbent_cost()
+
+        # Prunes states that an earlier search has shown can't beat the best.
+        if self.table != None:
+            node.state_hash = route.state_hash
+            known = self.table.get(node.state_hash)
+            if known != None and best_cost != None and known >= best_cost:
+                if stats != None:
+                    stats.record_depth('pruned: transposition', node.depth)
+                self.settle(node, known)
+                return
+
+        # The cost and bound tests are made again if the legs some ticket can't do without are included.
+        forced = False
+        while True:
+            # Backtracks when we've ruled out a ticket's route
+            if route.blocked_tickets > 0 or route.infeasible:
+                if stats != None:
+                    stats.record_depth('pruned: ticket blocked', node.depth)
+                self.settle(node, float('inf'))
+                return  # This certainly isn't better, it doesn't even work!
+
+            route_cost = self.cost(route)
+            bound = route_cost
+
+            # Bounds when we already know a better solution.
+            if best_cost != None:
+                if route_cost >= best_cost:
+                    if stats != None:
+                        stats.record_depth('pruned: cost', node.depth)
+                    self.settle(node, route_cost)
+                    return  # Since this one can't do better.
+
+                # Nor can it if what it must still spend takes it past the best.
+                target = best_cost * (1.0 - BOUND_TOLERANCE)
+                if stats != None:
+                    start = time.time()
+                    bound = route_cost + bounds.additional_cost(self.lower_bounds, route, target - route_cost)
+                    stats.add_time('bound', time.time() - start)
+                else:
+                    bound = route_cost + bounds.additional_cost(self.lower_bounds, route, target - route_cost)
+                if bound >= target:
+                    if stats != None:
+                        stats.record_depth('pruned: bound', node.depth)
+                    self.settle(node, bound)
+                    return
+
+            # Includes those legs once the cheaper tests have passed, and backtracks if a ticket can't be flown at all.
+            if forced or route.unsatisfied_tickets == 0:
+                break
+            forced = True
+            if route.force_ticket_legs() == 0 and not route.infeasible:
+                break
+
+        branch_leg = self.branching.choose(route)
+
+        # We've run out of choices.  Update the best if necessary.
+        if branch_leg == None:
+            if stats != None:
+                stats.record_depth('leaves', node.depth)
+            if route.unsatisfied_tickets == 0:
+                if best_cost == None or route_cost < best_cost:
+                    if stats != None:
+                        stats.record_depth('improvements', node.depth)
+                    self.set_best(route.deepleg_copy(), node)
+                self.settle(node, route_cost)
+            else:
+                self.settle(node, float('inf'))
+            return
+
+        from_index, to_index = branch_leg
+
+        # EXCLUSION
+        self.frontier.push(SearchNode(node, from_index, to_index, False, bound))
+        node.open_children = 1
+
+        # INCLUSION
+        # Bounds when including the branch leg will be too costly
+        include_cost = route_cost + (route.distances[from_index][to_index] * self.mile_cost) + self.takeoff_cost
+        if best_cost == None or include_cost < best_cost:
+            self.frontier.push(SearchNode(node, from_index, to_index, True, max(bound, include_cost)))
+            node.open_children = 2
+        else:
+            node.proven = include_cost
+            if stats != None:
+                stats.record_depth('pruned: include cost', node.depth)
+
+    # Records, if there's a TranspositionTable, that no routing beneath node costs less than proven.
+    # Once all its siblings are settled too, so is its parent, with the least of their bounds.
+    def settle(self, node, proven):
+        if self.table == None:
+            return
+
+        while True:
+            self.table.put(node.state_hash, proven)
+            parent = node.parent
+            if parent is None:
+                return
+            parent.proven = min(parent.proven, proven)
+            parent.open_children -= 1
+            if parent.open_children > 0:
+                return
+            node, proven = parent, parent.proven
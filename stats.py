@@ -0,0 +1,63 @@
+# Instrumentation for the flight routing solver.
+# A Stats object is handed to solve (or greedy, include_leg, exclude_leg) to find out where the
+# work goes: how many nodes were expanded and why branches were cut, how many legs each
+# propagation rule fixed, how long each phase took, and at what depths it all happened.
+# Everything is opt-in: code that isn't given a Stats only pays for an `is not None` check.
+
+import time
+from contextlib import contextmanager
+
+class Stats:
+    def __init__(self):
+        self.counts  = {}  # name -> number of times it happened
+        self.seconds = {}  # phase -> cumulative wall time spent in it
+        self.depths  = {}  # name -> {search depth -> number of times it happened at that depth}
+
+    def count(self, name, n = 1):
+        self.counts[name] = self.counts.get(name, 0) + n
+
+    def add_time(self, phase, seconds):
+        self.seconds[phase] = self.seconds.get(phase, 0.0) + seconds
+
+    # Counts name, and records that it happened at the given search depth.
+    def record_depth(self, name, depth):
+        self.count(name)
+        histogram = self.depths.setdefault(name, {})
+        histogram[depth] = histogram.get(depth, 0) + 1
+
+    # Times the body of a with statement as part of phase.
+    @contextmanager
+    def timer(self, phase):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add_time(phase, time.time() - start)
+
+    # Adds another Stats' counts, times and histograms to these (e.g. from another worker).
+    def merge(self, other):
+        for name, n in other.counts.items():
+            self.count(name, n)
+        for phase, seconds in other.seconds.items():
+            self.add_time(phase, seconds)
+        for name, histogram in other.depths.items():
+            mine = self.depths.setdefault(name, {})
+            for depth, n in histogram.items():
+                mine[depth] = mine.get(depth, 0) + n
+
+    def __str__(self):
+        lines = ["Counts:"]
+        for name in sorted(self.counts):
+            lines.append("  %-28s %10d" % (name, self.counts[name]))
+
+        lines.append("Seconds:")
+        for phase in sorted(self.seconds):
+            lines.append("  %-28s %10.4f" % (phase, self.seconds[phase]))
+
+        for name in sorted(self.depths):
+            lines.append("Depths (" + name + "):")
+            histogram = self.depths[name]
+            for depth in sorted(histogram):
+                lines.append("  %4d %10d" % (depth, histogram[depth]))
+
+        return "\n".join(lines)
@@ -2,9 +2,25 @@
 # Bess L. Walker
 # 2-22-13
 
+import os
 import math
+import json
+import shutil
+import tempfile
+import StringIO
 import routing
 import flightrouting
+import bounds
+import search
+import stats
+import benchmark
+import localsearch
+import reduction
+import branching
+import candidates
+import relaxation
+import incremental
+import batch
 
 # Initialize some basic points & edges
 p1 = routing.City('a', 0, 0)
@@ -148,6 +164,49 @@ assert str(tri_route.unconnected_tickets(tickets + [routing.Ticket(city_dict["d"
 
 assert str(tri_route.cost(1.0, 0.2, tickets)) == str((1 + 2 * math.sqrt(2)) * 1.0 + 3 * 0.2)
 
+# Check the per-row leg state bitsets and the Legs built from them
+assert tri_route.included_rows == [0b1000, 0, 0, 0b0110]
+assert tri_route.excluded_rows == [0b0110, 0, 0, 0]
+assert tri_route.matrix[city_dict["a"]][city_dict["d"]].included == True
+assert tri_route.leg(city_dict["a"], city_dict["b"]).excluded == True
+assert tri_route.leg(city_dict["d"], city_dict["a"]).undecided == True
+assert len(tri_route.undecided_legs()) == 16 - 5
+
+# Test the shared distance matrix
+assert tri_route.distances[0][3] == 1.0
+assert tri_route.miles_between(city_dict["b"], city_dict["d"]) == math.sqrt(2)
+assert tri_route.simple(tickets).distances is tri_route.distances
+assert tri_route.greedy(1.0, 0.2, tickets).distances is tri_route.distances
+single = routing.DistanceMatrix(tri_route.cities, float32 = True)
+assert abs(single[1][3] - math.sqrt(2)) < 1e-6
+assert abs(routing.Routing(cities, single).leg(city_dict["b"], city_dict["d"]).miles - math.sqrt(2)) < 1e-6
+sparse = routing.Routing(cities, sparse = True)
+assert len(sparse.distances[1]) == 0
+assert sparse.miles_between(city_dict["b"], city_dict["d"]) == tri_route.miles_between(city_dict["b"], city_dict["d"])
+assert sparse.distances[1].keys() == [3]
+assert sparse.greedy(1.0, 0.2, tickets).distances is sparse.distances
+
+# Test the reachability index and the watched-ticket counts
+assert tri_route.reach_rows == [0b1111, 0b0010, 0b0100, 0b1110]
+assert tri_route.reached_rows == [0b0001, 0b1011, 0b1101, 0b1001]
+watched = tri_route.deepleg_copy()
+watched.watch_tickets(tickets + [routing.Ticket(city_dict["d"], city_dict["a"], set_required = False)])
+assert watched.unsatisfied_tickets == 1
+assert watched.add_leg(city_dict["b"], city_dict["a"]) == ([city_dict["b"], city_dict["d"]], [city_dict["a"], city_dict["c"], city_dict["d"]])
+assert watched.included_cols[0] == 0b0010
+assert watched.add_leg(city_dict["b"], city_dict["c"]) == ([], [])
+assert watched.unsatisfied_tickets == 0
+assert watched.reach_rows[3] == 0b1111
+assert watched.reached_rows[0] == 0b1011
+watched.remove_leg(city_dict["b"], city_dict["a"])
+watched.remove_leg(city_dict["b"], city_dict["c"])
+assert watched.reach_rows == tri_route.reach_rows
+assert watched.reached_rows == tri_route.reached_rows
+assert watched.included_cols == tri_route.included_cols
+assert watched.unsatisfied_tickets == 1
+watched.remove_explicit_leg(city_dict["d"], city_dict["a"])
+assert watched.blocked_tickets == 1
+
 # Test Routing's copy method and leg independence
 h = tri_route.deepleg_copy()
 
@@ -177,6 +236,30 @@ d 0 0 1 0"""
 assert excluded.is_valid(tickets) == True
 assert excluded.cost(1.0, 0.2, tickets) == 1.0 * (math.sqrt(5) + 1 + math.sqrt(2)) + 0.2 * 3
 
+# Test including and excluding in place, then undoing via the trail
+trailed = tri_route.deepleg_copy()
+trailed.start_trail()
+mark = trailed.trail_mark()
+trailed.include(trailed.index[city_dict["a"]], trailed.index[city_dict["b"]])
+inner_mark = trailed.trail_mark()
+trailed.exclude(trailed.index[city_dict["d"]], trailed.index[city_dict["b"]])
+assert str(trailed) == str(excluded)
+trailed.undo(inner_mark)
+assert str(trailed) == str(included)
+assert trailed.explicit_rows == included.explicit_rows
+trailed.undo(mark)
+assert trailed.included_rows == tri_route.included_rows
+assert trailed.excluded_rows == tri_route.excluded_rows
+assert trailed.implicit_rows == tri_route.implicit_rows
+assert trailed.explicit_rows == tri_route.explicit_rows
+assert trailed.trail_mark() == 0
+
+# Test the running miles and takeoff totals through copies and undo
+assert excluded.takeoffs(tickets) == 3
+assert included.takeoffs(tickets) == 4
+assert trailed.miles(tickets) == tri_route.miles(tickets)
+assert trailed.takeoffs(tickets) == tri_route.takeoffs(tickets) == 3
+
 # Test possible-route counter
 one_city = flightrouting.load_cities("1_city.csv")
 d = flightrouting.make_city_dict(one_city)
@@ -197,6 +280,30 @@ assert four.single_possible_route(d["a"], d["d"]) == None
 four.remove_leg(d["b"], d["d"])
 assert str(four.single_possible_route(d["a"], d["d"])) == "[<Leg:a->b>, <Leg:b->c>, <Leg:c->d>]"
 
+# Itineraries follow the included legs where they connect the ticket, whatever else is still open
+chain = routing.Routing(four_cities)
+chain.add_leg(d["a"], d["b"])
+chain.add_leg(d["b"], d["c"])
+assert str(routing.Ticket(d["a"], d["c"], set_required = False).itinerary(chain)) == "[<Leg:a->b>, <Leg:b->c>]"
+assert chain.included_route(d["a"], d["d"]) == None
+assert str(routing.Ticket(d["a"], d["d"], set_required = False).itinerary(chain)) == "[<Leg:a->d>]"
+
+# Test forcing the legs every path of a ticket uses
+five_cities = [routing.City(name, x, 0) for x, name in enumerate("abcde")]
+five = routing.Routing(five_cities).exclude_selfloops()
+five.watch_tickets([routing.Ticket(five_cities[0], five_cities[4], set_required = False)])
+open_legs = [(0, 1), (0, 2), (1, 3), (2, 3), (3, 4)]  # a->b->d->e and a->c->d->e
+for i in range(5):
+    for j in range(5):
+        if i != j and (i, j) not in open_legs:
+            five.exclude(i, j)
+assert five.force_ticket_legs() == 1 and five.included_legs()[0].to_city is five_cities[4]  # d->e
+assert five.force_ticket_legs() == 0  # Nothing cut since
+five.exclude(2, 3)
+assert five.force_ticket_legs() == 2 and five.unsatisfied_tickets == 0  # a->b and b->d
+five.watch_tickets([routing.Ticket(five_cities[4], five_cities[0], set_required = False)])
+assert five.force_ticket_legs() == 0 and five.infeasible  # Nothing leaves e
+
 
 # Test solver
 best = flightrouting.solve(routing.Routing([]), [], 1.0, 0.2)
@@ -259,6 +366,48 @@ c 0 0 0 0
 d 0 1 1 0"""
 assert str(best.cost(1.0, 0.2, tri_tickets)) == str(1.0 * (1 + 2 * math.sqrt(2)) + 0.2 * 3)
 
+# Test the endpoint lower bound: b and c each still need a leg in, a a leg out
+tri_bound = bounds.EndpointBound(tri_routing, tri_tickets, 1.0, 0.2)
+assert tri_bound.additional_cost(tri_routing.exclude_selfloops()) == 2 * (math.sqrt(2) + 0.2)
+assert tri_bound.additional_cost(best) == 0.0
+blocked = tri_routing.exclude_selfloops()
+for city in tri_cities:
+    blocked.remove_leg(city, tri_cities[1])
+assert tri_bound.additional_cost(blocked) == float('inf')
+
+# Test the LP relaxation.  Packing cuts {0, 1} and {1, 2} under leg costs 1, 2, 3 gives 2, all of it from leg 1.
+packing = relaxation.CutPacking([1.0, 2.0, 3.0])
+packing.add_cut([0, 1])
+packing.add_cut([1, 2])
+assert packing.solve() and abs(packing.value - 2.0) < 1e-9
+assert [round(x, 9) for x in packing.primal()] == [0.0, 1.0, 0.0]
+assert relaxation.short_cut(3, {(0, 1): 0.5, (1, 2): 1.0}, 0, 2) == 0b001
+assert relaxation.short_cut(3, {(0, 1): 0.5, (0, 2): 0.5, (1, 2): 1.0}, 0, 2) == None
+# Here it finds the optimum: both tickets share a->d, which the endpoint bound can't see
+tri_flow = bounds.FlowBound(tri_routing, tri_tickets, 1.0, 0.2)
+tri_lp = tri_flow.additional_cost(tri_routing.exclude_selfloops())
+assert abs(tri_lp - best.cost(1.0, 0.2, tri_tickets)) < 1e-6
+assert tri_lp > tri_bound.additional_cost(tri_routing.exclude_selfloops())
+assert len(tri_flow.relaxation.cuts) > 0
+relaxed = {}
+tri_flow.relaxation.bound(tri_routing.exclude_selfloops(), x = relaxed)
+assert sorted(relaxed) == [(0, 3), (3, 1), (3, 2)]
+assert tri_flow.additional_cost(best) == 0.0
+assert tri_flow.additional_cost(blocked) == float('inf')
+assert tri_flow.additional_cost(tri_routing.exclude_selfloops(), enough = 1.0) >= 1.0
+# The same with SciPy, where it's installed; a cut no leg crosses makes the LP infeasible
+if relaxation.linprog != None:
+    scipy_flow = bounds.FlowBound(tri_routing, tri_tickets, 1.0, 0.2, 'scipy')
+    assert abs(scipy_flow.additional_cost(tri_routing.exclude_selfloops()) - tri_lp) < 1e-6
+    assert scipy_flow.additional_cost(blocked) == float('inf')
+    scipy_value, scipy_x = scipy_flow.relaxation.scipy_solve([1.0, 2.0, 3.0], [[0, 1], [1, 2]])
+    assert abs(scipy_value - 2.0) < 1e-6
+    assert scipy_flow.relaxation.scipy_solve([1.0, 2.0, 3.0], [[0, 1], []]) == (float('inf'), None)
+assert [bound.__class__ for bound in bounds.default_bounds(tri_routing, tri_tickets, 1.0, 0.2)] == [bounds.EndpointBound, bounds.FlowBound]
+assert len(bounds.default_bounds(tri_routing, tri_tickets, 1.0, 0.2, lp = None)) == 1
+endpoint_only = flightrouting.solve(tri_routing.exclude_selfloops(), tri_tickets, 1.0, 0.2, lower_bounds = [tri_bound])
+assert str(endpoint_only) == str(best)
+
 print "TRIANGLE+CENTER CITIES, GREEDY SOLUTION"
 greedy = tri_routing.greedy(1.0, 0.2, tri_tickets)
 assert str(greedy) == \
@@ -279,6 +428,146 @@ b 0 0 0 0
 c 0 0 0 0
 d 0 1 1 0"""
 
+print "TRIANGLE+CENTER CITIES, EACH SEARCH ORDER"
+for order in ["depth", "best", "hybrid"]:
+    best = flightrouting.solve(tri_routing.exclude_selfloops(), tri_tickets, 1.0, 0.2, tri_routing.greedy(1.0, 0.2, tri_tickets), order = order)
+    assert str(best) == \
+"""  a b c d
+a 0 0 0 1
+b 0 0 0 0
+c 0 0 0 0
+d 0 1 1 0"""
+
+# Test stepping through a search by hand
+tri_search = search.Search(tri_routing.exclude_selfloops(), tri_tickets, 1.0, 0.2)
+assert tri_search.step() == True
+assert tri_search.nodes_expanded == 1
+assert len(tri_search.frontier.nodes()) == 2
+assert tri_search.frontier.nodes()[0].include == True
+while tri_search.step():
+    pass
+assert tri_search.done()
+assert str(tri_search.best) == str(best)
+
+# Test search budgets, improvement callbacks and reports
+found = []
+tri_report = search.SearchReport()
+complete_best = flightrouting.solve(tri_routing.exclude_selfloops(), tri_tickets, 1.0, 0.2, on_improvement = lambda routing, cost: found.append(cost), report = tri_report)
+assert str(complete_best) == str(best)
+assert found == sorted(found, reverse = True) and found[-1] == tri_report.best_cost
+assert tri_report.complete() and tri_report.gap() == 0.0
+short_report = search.SearchReport()
+flightrouting.solve(tri_routing.exclude_selfloops(), tri_tickets, 1.0, 0.2, tri_routing.greedy(1.0, 0.2, tri_tickets), node_limit = 2, report = short_report)
+assert short_report.stop_reason == 'nodes' and short_report.nodes_expanded == 2
+assert short_report.lower_bound <= tri_report.best_cost <= short_report.best_cost
+timed_search = search.Search(tri_routing.exclude_selfloops(), tri_tickets, 1.0, 0.2)
+improvements = list(timed_search.improvements(time_limit = 60))
+assert timed_search.done() and improvements[-1] is timed_search.best
+assert timed_search.lower_bound() == timed_search.best_cost
+
+# Test state hashing and the transposition table
+hashed = tri_routing.exclude_selfloops()
+hashed.track_state_hash()
+unhashed_state = hashed.state_hash
+one_way = hashed.include_leg(tri_routing.cities[0], tri_routing.cities[3]).exclude_leg(tri_routing.cities[3], tri_routing.cities[2])
+other_way = hashed.exclude_leg(tri_routing.cities[3], tri_routing.cities[2]).include_leg(tri_routing.cities[0], tri_routing.cities[3])
+assert one_way.state_hash == other_way.state_hash != unhashed_state
+fresh = one_way.deepleg_copy()
+fresh.track_state_hash()
+assert fresh.state_hash == one_way.state_hash
+hashed.start_trail()
+hashed.include(0, 3)
+hashed.undo(0)
+assert hashed.state_hash == unhashed_state
+table = search.TranspositionTable()
+first_report = search.SearchReport()
+flightrouting.solve(tri_routing.exclude_selfloops(), tri_tickets, 1.0, 0.2, node_limit = 3, report = first_report, table = table)
+second_report = search.SearchReport()
+table_best = flightrouting.solve(tri_routing.exclude_selfloops(), tri_tickets, 1.0, 0.2, report = second_report, table = table)
+assert str(table_best) == str(best) and second_report.complete()
+third_report = search.SearchReport()
+flightrouting.solve(tri_routing.exclude_selfloops(), tri_tickets, 1.0, 0.2, table_best, report = third_report, table = table)
+assert third_report.nodes_expanded == 1  # The root is already settled
+small_table = search.TranspositionTable(capacity = 2)
+for state in [1, 2, 1, 3]:
+    small_table.put(state, 0.0)
+assert len(small_table) == 2 and small_table.get(2) == None and small_table.get(1) == 0.0
+
+# Test the branching strategies: they all find the same optimum, including on instances
+# with round-trip tickets where over-eager propagation used to cut the optimum off
+for strategy in sorted(branching.STRATEGIES):
+    assert str(flightrouting.solve(tri_routing.exclude_selfloops(), tri_tickets, 1.0, 0.2, branching = strategy)) == str(best)
+for seed in [3, 17, 22]:
+    seed_cities, seed_tickets = benchmark.uniform_instance(4, 3, seed)
+    seed_routing = routing.Routing(seed_cities).exclude_selfloops()
+    costs = [flightrouting.solve(seed_routing, seed_tickets, 1.0, 0.2, branching = strategy).cost(1.0, 0.2, seed_tickets)
+             for strategy in sorted(branching.STRATEGIES)]
+    assert max(costs) - min(costs) < 1e-9
+assert branching.LongestLeg(tri_routing, tri_tickets, 1.0, 0.2).choose(tri_routing.exclude_selfloops()) == (2, 0)  # c->a, the last of the longest
+
+# Test the search statistics
+tri_stats = stats.Stats()
+stats_best = flightrouting.solve(tri_routing.exclude_selfloops(), tri_tickets, 1.0, 0.2, tri_routing.greedy(1.0, 0.2, tri_tickets, tri_stats), stats = tri_stats)
+assert str(stats_best) == str(best)
+assert tri_stats.counts['nodes expanded'] > 0
+assert sum(tri_stats.depths['nodes expanded'].values()) == tri_stats.counts['nodes expanded']
+assert tri_stats.depths['nodes expanded'][0] == 1
+assert tri_stats.counts['greedy legs'] > 0
+assert 'search' in tri_stats.seconds and 'greedy' in tri_stats.seconds
+rule_stats = stats.Stats()
+tri_routing.exclude_selfloops().include_leg(tri_routing.cities[0], tri_routing.cities[3], rule_stats).include(3, 1)
+assert rule_stats.counts['rule 1a'] == 1  # a->b, via a->d->b
+assert 'rule 2b' not in rule_stats.counts  # d->a stays open: a ticket d->a would need it
+rule_stats = stats.Stats()
+tri_routing.exclude_selfloops().include_leg(tri_routing.cities[0], tri_routing.cities[3], rule_stats).include(0, 1)
+assert rule_stats.counts['rule 2a'] == 2  # d->b and b->d, either of which would make a->b or a->d redundant
+
+# Rules 2a and 2b only count paths that were there before the new leg: with b->c included, including
+# a->b puts c in a's reach through b->c itself, but c->b must stay open, since a round trip b->c, c->b
+# can still fly c->a->b
+round_trip = tri_routing.exclude_selfloops()
+round_trip.watch_tickets([routing.Ticket(tri_cities[1], tri_cities[2]), routing.Ticket(tri_cities[2], tri_cities[1])])
+round_trip.include(1, 2)
+round_trip.include(0, 1)
+assert not (round_trip.excluded_rows[2] >> 1) & 1 and not (round_trip.explicit_rows[2] >> 1) & 1
+round_trip.include(2, 0)
+assert round_trip.unsatisfied_tickets == 0 and not round_trip.infeasible
+
+# Test that propagation runs to a fixpoint, and finds dead ends
+rule_stats = stats.Stats()
+propagated = tri_routing.exclude_selfloops()
+propagated.stats = rule_stats
+propagated.watch_tickets(tri_tickets)
+propagated.include(3, 0)
+propagated.exclude(2, 1)
+propagated.exclude(0, 1)
+assert rule_stats.counts['rule 4a'] == 1 and propagated.included_rows[3] == 0b0011  # d->b, the only way left into b
+assert rule_stats.counts['rule 2a'] == 1 and (propagated.excluded_rows[1] >> 0) & 1  # b->a, through the forced d->b
+assert not propagated.infeasible
+propagated.exclude(3, 1)
+assert propagated.infeasible  # Nothing flies into b any more
+stranded = tri_routing.exclude_selfloops()
+stranded.watch_tickets(tri_tickets)
+for i, j in [(0, 1), (3, 1), (0, 2), (3, 2)]:
+    stranded.exclude(i, j)
+assert (stranded.included_rows[0], stranded.included_rows[2]) == (0b1000, 0b0010)  # a->d and c->b are forced
+assert not stranded.infeasible
+stranded.force_ticket_legs()
+assert stranded.infeasible  # but a->d leads nowhere
+rule_stats = stats.Stats()
+closed = tri_routing.exclude_selfloops()
+closed.stats = rule_stats
+closed.watch_tickets(tri_tickets)
+for i in range(3):
+    closed.exclude(i, 3)
+closed.include(3, 0)
+assert rule_stats.counts['rule 3'] == 2 and closed.excluded_rows[3] == 0b1110  # d->b and d->c: a->b and a->c fly on from a
+merged = stats.Stats()
+merged.merge(tri_stats)
+merged.merge(tri_stats)
+assert merged.counts['nodes expanded'] == 2 * tri_stats.counts['nodes expanded']
+assert "nodes expanded" in str(merged)
+
 print "TRIANGLE+CENTER CITIES, CALLING MAIN"
 best = flightrouting.main(["flightrouting.py", "triangle_cities.csv", "triangle_tickets.csv"])
 assert str(best) == \
@@ -304,6 +593,23 @@ dup_tickets = flightrouting.load_tickets("dup_tickets.csv", flightrouting.make_c
 assert repr(dup_tickets) == "[<Ticket:a->b>, <Ticket:a->c>, <Ticket:a->b>]"
 deduped_tickets = flightrouting.dedup_tickets(dup_tickets)
 assert repr(deduped_tickets) == "[<Ticket:a->b>, <Ticket:a->c>]"
+assert [ticket.multiplicity for ticket in deduped_tickets] == [2, 1]
+assert [ticket.multiplicity for ticket in dup_tickets] == [1, 1, 1]
+assert [ticket.multiplicity for ticket in flightrouting.dedup_tickets(deduped_tickets + dup_tickets[:1])] == [3, 1]
+
+# Test ticket equality and hashing
+assert dup_tickets[0] == dup_tickets[2]
+assert dup_tickets[0] != dup_tickets[1]
+assert len(set(dup_tickets)) == 2
+
+# Test that bad rows are skipped and counted
+bad_report = flightrouting.LoadReport("bad_tickets.csv")
+bad_tickets = flightrouting.iter_tickets("bad_tickets.csv", flightrouting.make_city_dict(tri_cities), bad_report)
+assert repr(list(bad_tickets)) == "[<Ticket:a->b>, <Ticket:a->c>]"
+assert bad_report.rows == 4
+assert bad_report.malformed == 1
+assert bad_report.unknown_cities == 1
+assert bad_report.skipped() == 2
 
 # Test simple heuristic (just take the tickets)
 simple = routing.Routing(tri_cities).simple(tri_tickets)
@@ -326,6 +632,19 @@ assert str(routing.Routing(one_city).greedy(1.0, 0.2, [routing.Ticket(d["c"], d[
 """  c
 c 0"""
 
+# Test the greedy ticket queue: cheapest first, earliest pushed on ties, lazy replacement
+queue = routing.TicketQueue()
+d = flightrouting.make_city_dict(tri_cities)
+ab = queue.push(routing.Ticket(d["a"], d["b"], set_required = False), 2.0)
+ac = queue.push(routing.Ticket(d["a"], d["c"], set_required = False), 1.0)
+db = queue.push(routing.Ticket(d["d"], d["b"], set_required = False), 1.0)
+queue.replace(ab, routing.Ticket(d["c"], d["b"], set_required = False), 0.5)
+assert len(queue) == 3
+assert [entry.ticket for entry in queue.entries_from(d["a"])] == [ac.ticket]
+assert repr([entry.ticket for entry in queue.entries_to(d["b"])]) == "[<Ticket:d->b>, <Ticket:c->b>]"
+assert repr([queue.pop(), queue.pop(), queue.pop()]) == "[<Ticket:c->b>, <Ticket:a->c>, <Ticket:d->b>]"
+assert len(queue) == 0
+
 # Greedy algorithm gives good solution that ignores city d.
 print "GREEDY TRIANGLE TICKETS"
 tri_cities = flightrouting.load_cities("triangle_cities.csv")
@@ -352,6 +671,113 @@ c 0 0 0 1 0
 d 0 0 0 0 1
 e 0 0 0 0 0"""
 
+# Local search finds the chain a->b->c->d->e that greedy misses
+improved = localsearch.improve(greedy, linear_tickets, 1.0, 0.2)
+assert improved.is_valid(linear_tickets)
+assert str(improved) == \
+"""  a b c d e
+a 0 1 0 0 0
+b 0 0 1 0 0
+c 0 0 0 1 0
+d 0 0 0 0 1
+e 0 0 0 0 0"""
+assert str(greedy) != str(improved)  # greedy itself is left alone
+assert localsearch.improve(improved, linear_tickets, 1.0, 0.2) is improved
+assert localsearch.improve(greedy, linear_tickets, 1.0, 0.2, time_limit = 0) is greedy  # out of time at once
+
+# Test the pre-solve reduction
+six_cities = flightrouting.load_cities("6_cities.csv")
+six_dict = flightrouting.make_city_dict(six_cities)
+vee_tickets = flightrouting.load_tickets("vee_tickets.csv", six_dict)
+assert flightrouting.ticket_sorted_cities(vee_tickets) == [six_dict["a"], six_dict["d"], six_dict["e"]]
+reduction_report = reduction.ReductionReport()
+reduced = reduction.reduce_cities(six_cities, flightrouting.ticket_sorted_cities(vee_tickets), 1.0, 0.2, reduction_report)
+assert [str(city) for city in reduced] == ["a", "c", "d", "e"]
+assert [(str(city), reason) for city, reason in reduction_report.removed] == [("b", "dominated by d"), ("f", "dominated by c")]
+remote = routing.City('z', 1000, 1000)
+assert reduction.reduce_cities(reduced + [remote], flightrouting.ticket_sorted_cities(vee_tickets), 1.0, 0.2) == reduced
+assert reduction.too_remote(remote, reduced + [remote], 1.0, 0.2)
+assert not reduction.too_remote(six_dict["c"], reduced, 1.0, 0.2)
+reduced_best = flightrouting.solve(routing.Routing(reduced).exclude_selfloops(), vee_tickets, 1.0, 0.2)
+restored = reduction.restore_cities(reduced_best, six_cities)
+assert len(restored.cities) == 6 and restored.is_valid(vee_tickets)
+assert abs(restored.cost(1.0, 0.2, vee_tickets) - reduced_best.cost(1.0, 0.2, vee_tickets)) < 1e-9
+assert sum(len(row) for row in restored.distances.rows) == len(list(restored.legs()))  # only the legs' distances
+
+# Test the candidate legs: nearest neighbours from the grid, and restricting and verifying a solve
+grid_cities, grid_tickets = benchmark.uniform_instance(40, 10, 3)
+grid = candidates.GridIndex(grid_cities)
+for city in grid_cities:
+    by_distance = sorted((other for other in grid_cities if other is not city), key = lambda other: (city.distance_to(other), other.id))
+    assert grid.nearest(city, 4) == by_distance[:4]
+assert len(grid.nearest(grid_cities[0], 100)) == 39
+six_routing = routing.Routing(six_cities).exclude_selfloops()
+candidate_report = candidates.CandidateReport()
+restricted = candidates.restrict(six_routing, vee_tickets, 1, candidate_report)
+for ticket in vee_tickets:
+    assert restricted.is_undecided(six_routing.index[ticket.from_city], six_routing.index[ticket.to_city])
+assert candidate_report.candidates + candidate_report.cut == 30 and candidate_report.cut > 0
+assert restricted.excluded_rows != six_routing.excluded_rows and six_routing.excluded_rows == routing.Routing(six_cities).exclude_selfloops().excluded_rows
+restricted_best = flightrouting.solve(restricted, vee_tickets, 1.0, 0.2, six_routing.greedy(1.0, 0.2, vee_tickets))
+assert candidates.verify(six_routing, restricted, vee_tickets, restricted_best, 1.0, 0.2, candidate_report) == None
+assert len(candidate_report.suspects) > 0 and candidate_report.search.complete()
+assert "Verified: searching every leg found nothing cheaper" in str(candidate_report)
+whole = candidates.restrict(six_routing, vee_tickets, 5)
+assert whole.excluded_rows == six_routing.excluded_rows
+whole_report = candidates.CandidateReport()
+assert candidates.verify(six_routing, whole, vee_tickets, restricted_best, 1.0, 0.2, whole_report) == None
+assert whole_report.suspects == [] and whole_report.search == None
+sparse_six = routing.Routing(six_cities, sparse = True).exclude_selfloops()
+sparse_best = flightrouting.solve(candidates.restrict(sparse_six, vee_tickets, 1), vee_tickets, 1.0, 0.2, sparse_six.greedy(1.0, 0.2, vee_tickets))
+assert str(sparse_best) == str(restricted_best)
+assert sum(len(row) for row in sparse_six.distances.rows) < 30
+# The endpoint bound only looks at the legs the restriction kept, so it can only be tighter
+restricted_bound = bounds.EndpointBound(restricted, vee_tickets, 1.0, 0.2)
+assert sum(len(legs) for legs in restricted_bound.out_legs.values()) < 5 * len(restricted_bound.out_legs)
+assert restricted_bound.additional_cost(restricted) >= bounds.EndpointBound(six_routing, vee_tickets, 1.0, 0.2).additional_cost(restricted)
+# Given a worse routing than the restricted optimum, searching every leg finds a better one
+far_legs = routing.Routing(six_cities).exclude_selfloops()
+for ticket in vee_tickets:
+    far_legs.add(far_legs.index[ticket.from_city], far_legs.index[ticket.to_city])
+better = candidates.verify(six_routing, restricted, vee_tickets, far_legs, 1.0, 0.2, candidate_report)
+assert better is candidate_report.better and str(better) == str(restricted_best)
+assert "Not verified" in str(candidate_report)
+# The time limit covers verifying too: with none left after the search, the legs left out aren't checked
+for limit, checked in [(0, False), (60, True)]:
+    timed_report = candidates.CandidateReport()
+    timed = flightrouting.solve_problem(six_cities, vee_tickets, 1.0, 0.2, time_limit = limit, nearest = 1, verify = True,
+                                        candidate_report = timed_report)
+    assert timed.is_valid(vee_tickets) and (timed_report.suspects != None) == checked
+
+# Test re-solving as the tickets change: the old routing is repaired, then searched again near the change
+six_by_id = flightrouting.make_city_dict(six_cities)
+corner_tickets = [routing.Ticket(six_by_id['a'], six_by_id[id], set_required = False) for id in "bef"]
+resolver = incremental.Resolver(restricted_best, vee_tickets, 1.0, 0.2, table = search.TranspositionTable())
+resolve_report = incremental.ResolveReport()
+resolved = resolver.resolve(corner_tickets[:2], [], local = False, report = resolve_report)
+assert len(resolve_report.added) == 2 and resolve_report.removed == [] and resolve_report.table_kept
+fresh = flightrouting.solve(six_routing, vee_tickets + corner_tickets[:2], 1.0, 0.2)
+assert resolved.is_valid(vee_tickets + corner_tickets[:2])
+assert abs(resolved.cost(1.0, 0.2, []) - fresh.cost(1.0, 0.2, [])) < 1e-9 <= resolve_report.repaired_cost - resolve_report.cost + 1e-9
+resolved = resolver.resolve(corner_tickets[2:], vee_tickets, report = resolve_report)
+assert len(resolve_report.removed) == 2 and not resolve_report.table_kept and resolve_report.affected > 0
+assert resolved.is_valid(corner_tickets) and resolve_report.cost <= resolve_report.repaired_cost
+assert not six_by_id['d'].required_destination and six_by_id['f'].required_destination
+# More passengers on a ticket changes nothing; tickets that aren't there can't be removed
+assert str(resolver.resolve(corner_tickets[:1], report = resolve_report)) == str(resolved) and resolve_report.added == []
+# Without a table, none is kept, and the states aren't hashed
+untabled = incremental.Resolver(restricted_best, vee_tickets, 1.0, 0.2)
+untabled_report = incremental.ResolveReport()
+untabled.resolve(corner_tickets[:2], [], report = untabled_report)
+assert untabled.table == None and not untabled_report.table_kept and untabled_report.search.complete()
+incremental.mark_required(six_cities, [routing.Ticket(six_by_id['b'], six_by_id['b'], set_required = False)])
+assert not six_by_id['b'].required_origin and not six_by_id['b'].required_destination  # a self-loop needs no leg
+try:
+    resolver.resolve([], vee_tickets)
+    assert False
+except ValueError:
+    pass
+
 # Test six cities
 print "SIX CITES VEE"
 best = flightrouting.main(["flightrouting.py", "6_cities.csv", "vee_tickets.csv"])
@@ -364,6 +790,75 @@ d 0 0 0 0 0 0
 e 0 0 1 0 0 0
 f 0 0 0 0 0 0"""
 
+# Test the benchmark generators and a single benchmark run
+first_cities, first_tickets = benchmark.uniform_instance(6, 5, 7)
+again_cities, again_tickets = benchmark.uniform_instance(6, 5, 7)
+assert [repr(city) for city in first_cities] == [repr(city) for city in again_cities]
+assert [str(ticket) for ticket in first_tickets] == [str(ticket) for ticket in again_tickets]
+assert benchmark.city_name(0) == "a" and benchmark.city_name(26) == "aa"
+hub_cities, hub_tickets = benchmark.hub_and_spoke_instance(5, 4, 0)
+assert all(ticket.from_city is not hub_cities[0] and ticket.to_city is not hub_cities[0] for ticket in hub_tickets)
+run = benchmark.run_case('linear', 4, 3, 0)
+crashed = benchmark.run_isolated('no_such_shape', 4, 3, 0, 30)
+assert crashed['status'] == 'error' and crashed['error'].startswith("KeyError")  # not a timeout
+assert run['status'] == 'ok' and run['cost'] <= run['greedy_cost']
+assert benchmark.compare([run], [dict(run, cost = run['cost'] + 1.0)], out = StringIO.StringIO()) == 1
+instance_dir = tempfile.mkdtemp()
+assert benchmark.main(["benchmark.py", "--generators", "uniform", "--sizes", "6", "--tickets", "0.8", "--seeds", "1",
+                       "--write-instances", instance_dir]) == 0
+written_cities = flightrouting.load_cities(os.path.join(instance_dir, "uniform_6_5_0_cities.csv"))
+written_tickets = flightrouting.load_tickets(os.path.join(instance_dir, "uniform_6_5_0_tickets.csv"), flightrouting.make_city_dict(written_cities))
+assert [repr(city) for city in written_cities] == [repr(city) for city in benchmark.uniform_instance(6, 5, 0)[0]]
+assert [str(ticket) for ticket in written_tickets] == [str(ticket) for ticket in benchmark.uniform_instance(6, 5, 0)[1]]
+shutil.rmtree(instance_dir)
+
+# Test batch solving: a job per manifest row, results as JSON lines, and a failing job doesn't stop the others
+batch_dir = tempfile.mkdtemp()
+with open(os.path.join(batch_dir, "jobs.txt"), 'w') as f:
+    f.write("city_file ticket_file mile_cost takeoff_cost\n")
+    f.write(os.path.abspath("triangle_cities.csv") + " " + os.path.abspath("triangle_tickets.csv") + "\n")
+    f.write("missing_cities.csv missing_tickets.csv 2.0\n")
+    f.write(os.path.abspath("6_cities.csv") + " " + os.path.abspath("vee_tickets.csv") + " 1.0 5.0\n")
+    f.write("too_few_fields\n")
+manifest_report = flightrouting.LoadReport("jobs.txt")
+jobs = batch.load_manifest(os.path.join(batch_dir, "jobs.txt"), report = manifest_report)
+assert len(jobs) == 3 and manifest_report.malformed == 1
+assert jobs[1].city_file == os.path.join(batch_dir, "missing_cities.csv") and (jobs[1].mile_cost, jobs[1].takeoff_cost) == (2.0, 0.2)
+batch_out = StringIO.StringIO()
+assert batch.run_batch(jobs, batch_out, workers = 2) == 1
+records = sorted([json.loads(line) for line in batch_out.getvalue().splitlines()], key = lambda record: record['job'])
+assert [record['status'] for record in records] == ['ok', 'error', 'ok'] and "IOError" in records[1]['error']
+assert records[0]['legs'] == [["a", "d"], ["d", "b"], ["d", "c"]] and records[0]['optimal']
+assert records[0]['itineraries'][0] == {'from': "a", 'to': "b", 'multiplicity': 1, 'legs': [["a", "d"], ["d", "b"]]}
+assert abs(records[2]['cost'] - (records[2]['miles'] + 5.0 * records[2]['takeoffs'])) < 1e-9
+# Restricted to near neighbours, a finished search is only optimal once the legs left out are verified
+assert not batch.run_job(0, jobs[0], {'nearest': 1})['optimal']
+assert batch.run_job(0, jobs[0], {'nearest': 1, 'verify': True})['optimal']
+shutil.rmtree(batch_dir)
+assert [job.name for job in batch.directory_jobs(".") if os.path.exists(job.city_file)] == ["linear", "triangle"]
+
+print "SIX CITES VEE, TWO WORKERS"
+six_cities = flightrouting.load_cities("6_cities.csv")
+vee_tickets = flightrouting.load_tickets("vee_tickets.csv", flightrouting.make_city_dict(six_cities))
+six_routing = routing.Routing(six_cities).exclude_selfloops()
+parallel_best = flightrouting.solve(six_routing, vee_tickets, 1.0, 0.2, six_routing.greedy(1.0, 0.2, vee_tickets), workers = 2)
+assert str(parallel_best) == str(best)
+assert parallel_best.cost(1.0, 0.2, vee_tickets) == best.cost(1.0, 0.2, vee_tickets)
+# The legs the workers' propagation and forcing included come back too: here f->e, the only leg into e
+forced_cities, forced_tickets = benchmark.uniform_instance(6, 6, 19)
+forced_routing = routing.Routing(forced_cities).exclude_selfloops()
+forced_best = flightrouting.solve(forced_routing, forced_tickets, 1.0, 0.2, workers = 2)
+assert forced_best.is_valid(forced_tickets) and (forced_best.included_rows[5] >> 4) & 1
+assert str(forced_best) == str(flightrouting.solve(forced_routing, forced_tickets, 1.0, 0.2))
+# Without an incumbent, the workers' routings are what comes back: they must fly every ticket, at the serial cost
+for seed in range(8):
+    seed_cities, seed_tickets = benchmark.uniform_instance(5 + seed % 3, 5 + seed % 3, seed)
+    seed_routing = routing.Routing(seed_cities).exclude_selfloops()
+    parallel_seed = flightrouting.solve(seed_routing, seed_tickets, 1.0, 0.2, workers = 2)
+    serial_seed = flightrouting.solve(seed_routing, seed_tickets, 1.0, 0.2)
+    assert parallel_seed.is_valid(seed_tickets)
+    assert abs(parallel_seed.cost(1.0, 0.2, seed_tickets) - serial_seed.cost(1.0, 0.2, seed_tickets)) < 1e-9
+
 print "SIX CITIES FOUR CORNERS"
 best = flightrouting.main(["flightrouting.py", "6_cities.csv", "corner_tickets.csv"])
 print best